@@ -1,3 +1,6 @@
 from django.contrib import admin
 
+from discord.models import OutboxEvent
+
 # Register your models here.
+admin.site.register(OutboxEvent)
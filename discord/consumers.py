@@ -1,28 +1,99 @@
-import json
+import logging
+from urllib.parse import parse_qs
 
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
+from asgiref.sync import sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
 from django.conf import settings
 
+from discord import events
 
-class DiscordRegistrationConsumer(WebsocketConsumer):
-    def connect(self):
-        async_to_sync(self.channel_layer.group_add)(settings.CHANNELS_DISCORD_WS_GROUP_NAME, self.channel_name)
-        self.accept()
 
-    def disconnect(self, close_code):
-        async_to_sync(self.channel_layer.group_discard)(settings.CHANNELS_DISCORD_WS_GROUP_NAME, self.channel_name)
+logger = logging.getLogger(__name__)
+BATCH_SUBPROTOCOL = "batch"
 
-    def _forward_event_message(self, event):
-        payload = event["message"]
 
-        self.send(text_data=json.dumps({"message": payload}))
+class DiscordRegistrationConsumer(AsyncWebsocketConsumer):
+    """
+    Forwards registration events to websocket listeners.
 
-    def registration_new(self, event):
-        self._forward_event_message(event)
+    Clients opt into batched delivery with the `batch` subprotocol or a `?batch=1` query flag. Batched clients always
+    receive a JSON array of frames, other clients receive one frame per event.
 
-    def registration_delete(self, event):
-        self._forward_event_message(event)
+    Clients reconnecting with `?since=<id>` (the `id` of the last frame they received) are first sent every event they
+    missed, then the live feed. If the missed events are no longer all retained, or the replay stream is disabled, a
+    `resync` action is sent instead and the client should re-list registrants.
+    """
+    batched = False
+    last_event_id: tuple[int, int] | None = None
 
-    def registration_discord_switch(self, event):
-        self._forward_event_message(event)
+    async def connect(self):
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        subprotocols = self.scope.get("subprotocols", [])
+        self.batched = BATCH_SUBPROTOCOL in subprotocols or query.get("batch", ["0"])[-1] in ("1", "true")
+
+        # join the group before reading the stream so nothing slips between replay and live feed;
+        # live events already covered by the replay are dropped using last_event_id
+        await self.channel_layer.group_add(settings.CHANNELS_DISCORD_WS_GROUP_NAME, self.channel_name)
+        await self.accept(subprotocol=BATCH_SUBPROTOCOL if BATCH_SUBPROTOCOL in subprotocols else None)
+
+        if (since := query.get("since", [None])[-1]) is not None:
+            await self.replay(since)
+
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(settings.CHANNELS_DISCORD_WS_GROUP_NAME, self.channel_name)
+
+    async def replay(self, since: str):
+        if (parsed_since := events.parse_event_id(since)) is None:
+            await self.send_frames([events.encode_frame({"action": "resync", "error": f"invalid since id '{since}'"})])
+            return
+        if settings.CHANNELS_DISCORD_WS_STREAM_MAXLEN <= 0:
+            # nothing is retained to replay, the client can only catch up by re-listing
+            await self.send_frames([events.encode_frame({"action": "resync"})])
+            return
+        try:
+            replay, truncated = await sync_to_async(events.read_stream_since)(since)
+        except Exception as e:
+            logger.warning(f"failed to read replay stream since {since}: {repr(e)}")
+            replay, truncated = [], True
+
+        if truncated:
+            await self.send_frames([events.encode_frame({"action": "resync"})])
+        self.last_event_id = parsed_since
+        await self.send_frames([frame for event_id, frame in replay], [event_id for event_id, frame in replay])
+
+    async def send_frames(self, frames: list[str], event_ids: list[str | None] | None = None):
+        if event_ids is not None:
+            # drop anything the client has already been sent, either live or from the replay stream
+            unseen = []
+            for frame, event_id in zip(frames, event_ids):
+                parsed_id = events.parse_event_id(event_id)
+                if parsed_id is not None:
+                    if self.last_event_id is not None and parsed_id <= self.last_event_id:
+                        continue
+                    self.last_event_id = parsed_id
+                unseen.append(frame)
+            frames = unseen
+        if not frames:
+            return
+
+        if self.batched:
+            await self.send(text_data=events.encode_batch(frames))
+            return
+        for frame in frames:
+            await self.send(text_data=frame)
+
+    async def _forward_event_message(self, event):
+        # frames are encoded once by the producer (see discord.events.encode_frame), forward them unchanged
+        await self.send_frames([event["frame"]], [event.get("id")])
+
+    async def registration_new(self, event):
+        await self._forward_event_message(event)
+
+    async def registration_delete(self, event):
+        await self._forward_event_message(event)
+
+    async def registration_discord_switch(self, event):
+        await self._forward_event_message(event)
+
+    async def registration_batch(self, event):
+        await self.send_frames(event["frames"], event.get("ids"))
@@ -0,0 +1,245 @@
+import contextlib
+import json
+import logging
+import threading
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django_redis import get_redis_connection
+from redis.exceptions import LockError
+
+from discord.models import OutboxEvent
+
+
+logger = logging.getLogger(__name__)
+
+
+def encode_frame(payload: dict | str, event_id: str | None = None) -> str:
+    """
+    Encode a registration event into the websocket text frame sent to listeners.
+
+    The payload is nested as a JSON string under `message`, which is the wire format the discord bot expects. The frame
+    is encoded once here so consumers can forward it as-is instead of re-encoding it for every connected client.
+    :param payload: event body, e.g. {"discord_user_id": ..., "action": "register"}, or its JSON encoding
+    :param event_id: stream id of the event, clients pass the last one they saw as `?since=` when reconnecting
+    :return: str
+    """
+    message = payload if isinstance(payload, str) else json.dumps(payload)
+    if event_id is None:
+        return json.dumps({"message": message})
+    return json.dumps({"message": message, "id": event_id})
+
+
+def encode_batch(frames: list[str]) -> str:
+    """
+    Join already-encoded frames into a single JSON array frame without decoding them again.
+    :param frames: frames produced by `encode_frame`
+    :return: str
+    """
+    return f"[{','.join(frames)}]"
+
+
+def parse_event_id(event_id: str | None) -> tuple[int, int] | None:
+    """
+    Parse a redis stream id ("<milliseconds>-<sequence>") into a comparable tuple.
+    :param event_id: stream id, or None
+    :return: (milliseconds, sequence), or None if event_id is not a valid stream id
+    """
+    if event_id is None:
+        return None
+    ms, _, seq = event_id.partition("-")
+    try:
+        return int(ms), int(seq or 0)
+    except ValueError:
+        return None
+
+
+def _decode(value: bytes | str) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _stream_key() -> str:
+    return f"{settings.CHANNELS_DISCORD_WS_GROUP_NAME}_stream"
+
+
+def append_to_stream(messages: list[str]) -> list[str | None]:
+    """
+    Append encoded events to the capped replay stream in a single round trip.
+    :param messages: JSON encoded event bodies
+    :return: the events' stream ids, or Nones if the stream is disabled or redis is unavailable
+    """
+    if settings.CHANNELS_DISCORD_WS_STREAM_MAXLEN <= 0:
+        return [None] * len(messages)
+    try:
+        pipeline = get_redis_connection("default").pipeline(transaction=False)
+        for message in messages:
+            pipeline.xadd(_stream_key(), {"message": message},
+                          maxlen=settings.CHANNELS_DISCORD_WS_STREAM_MAXLEN,
+                          approximate=True)
+        return [_decode(event_id) for event_id in pipeline.execute()]
+    except Exception as e:
+        logger.warning(f"failed to append {len(messages)} events to replay stream: {repr(e)}")
+        return [None] * len(messages)
+
+
+def read_stream_since(since: str) -> tuple[list[tuple[str, str]], bool]:
+    """
+    Read every event appended to the replay stream after `since`.
+    :param since: stream id of the last event the client received
+    :return: ([(event_id, frame), ...], whether events after `since` may have been trimmed from the stream already)
+    """
+    connection = get_redis_connection("default")
+    oldest = connection.xrange(_stream_key(), count=1)
+    entries = connection.xrange(_stream_key(), min=f"({since}")
+
+    replay = []
+    for event_id, fields in entries:
+        event_id, fields = _decode(event_id), {_decode(k): _decode(v) for k, v in fields.items()}
+        replay.append((event_id, encode_frame(fields["message"], event_id)))
+    truncated = bool(oldest) and parse_event_id(_decode(oldest[0][0])) > parse_event_id(since)
+    return replay, truncated
+
+
+def _group_send(message: dict):
+    channel_layer = get_channel_layer()
+    # noinspection PyArgumentList
+    async_to_sync(channel_layer.group_send)(settings.CHANNELS_DISCORD_WS_GROUP_NAME, message)
+
+
+def broadcast_batch(messages: list[str]):
+    """
+    Send several events to the discord group as a single channel layer message.
+    :param messages: JSON encoded event bodies
+    :return: None
+    """
+    if not messages:
+        return
+    event_ids = append_to_stream(messages)
+    _group_send({"type": "registration.batch",
+                 "frames": [encode_frame(message, event_id) for message, event_id in zip(messages, event_ids)],
+                 "ids": event_ids})
+
+
+# seconds the drain lock is held for without being renewed, it is renewed before every batch
+OUTBOX_DRAIN_LOCK_TIMEOUT = 30
+
+
+class ProcessLock:
+    """
+    Stands in for the redis lock of drain_outbox when the cache isn't redis, e.g. LocMemCache in development: nothing
+    is shared between processes then, so neither is the lock.
+    """
+    _lock = threading.Lock()
+
+    def acquire(self, blocking: bool = True, blocking_timeout: float | None = None) -> bool:
+        return self._lock.acquire(blocking, -1 if blocking_timeout is None else blocking_timeout)
+
+    def reacquire(self):
+        pass
+
+    def release(self):
+        self._lock.release()
+
+
+def outbox_lock():
+    """
+    Lock keeping processes from draining, and sending, the same rows concurrently. Redis locks hold a random token: a
+    drain that outlived OUTBOX_DRAIN_LOCK_TIMEOUT can neither extend nor release a lock another process took since.
+    """
+    try:
+        connection = get_redis_connection("default")
+    except NotImplementedError:
+        return ProcessLock()
+    return connection.lock("outbox_drain_lock", timeout=OUTBOX_DRAIN_LOCK_TIMEOUT)
+
+
+def drain_outbox(batch_size: int | None = None, wait: float = 0) -> int:
+    """
+    Broadcast every pending outbox event, oldest first, `batch_size` events per channel layer message.
+
+    Rows are only deleted after their batch was sent, so an event may be sent twice if the process dies in between but
+    is never lost. A lock keeps processes from draining (and sending) the same rows concurrently, a drain that lost it
+    stops before its next batch.
+    :param batch_size: max events per broadcast. Defaults to settings.OUTBOX_DRAIN_BATCH_SIZE
+    :param wait: seconds to wait for another drain to finish, 0 to return right away
+    :return: number of events sent
+    """
+    batch_size = batch_size or settings.OUTBOX_DRAIN_BATCH_SIZE
+    lock = outbox_lock()
+    if not lock.acquire(blocking=wait > 0, blocking_timeout=wait or None):
+        return 0
+    sent = 0
+    try:
+        while batch := list(OutboxEvent.objects.order_by('pk').values_list('pk', 'message')[:batch_size]):
+            lock.reacquire()
+            broadcast_batch([message for _, message in batch])
+            OutboxEvent.objects.filter(pk__in=[pk for pk, _ in batch]).delete()
+            sent += len(batch)
+    except LockError as e:
+        # the lock expired and may belong to another drain already, the remaining rows are left to it
+        logger.warning(f"lost the outbox drain lock after sending {sent} events: {repr(e)}")
+    finally:
+        # fails the same way if the lock expired
+        with contextlib.suppress(LockError):
+            lock.release()
+    return sent
+
+
+class OutboxDrainer:
+    """
+    Background thread draining the outbox whenever a transaction that queued events commits, once
+    CHANNELS_DISCORD_WS_BATCH_WINDOW seconds have passed since the first of them woke it.
+
+    The thread also sweeps the outbox every `interval` seconds to pick up events left behind by other processes.
+    """
+
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self._wakeup = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def wake(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="outbox-drainer", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            woken = self._wakeup.wait(timeout=self.interval)
+            if woken and settings.CHANNELS_DISCORD_WS_BATCH_WINDOW > 0:
+                # let events from concurrent requests pile up so they go out in one broadcast. A sleep, not a wait on
+                # _wakeup: the commits of those requests wake the drainer too, and would end the window early
+                time.sleep(settings.CHANNELS_DISCORD_WS_BATCH_WINDOW)
+            self._wakeup.clear()
+            try:
+                drain_outbox()
+            except Exception as e:
+                logger.error(f"failed to drain outbox: {repr(e)}")
+            finally:
+                close_old_connections()
+
+
+outbox_drainer = OutboxDrainer()
+
+
+def enqueue(event_type: str, payload: dict, wake: bool = True):
+    """
+    Queue a registration event for broadcast once the current transaction commits.
+
+    Call this inside the transaction making the change the event describes: the event is dropped with the transaction
+    if it rolls back, and the request no longer waits on the channel layer.
+    :param event_type: channels event type, e.g. "registration.new"
+    :param payload: event body
+    :param wake: wake this process's drainer on commit. Otherwise the event waits for a sweep, the drainers of web
+        workers sweep every second
+    :return: None
+    """
+    OutboxEvent.objects.create(event_type=event_type, message=json.dumps(payload))
+    if wake:
+        transaction.on_commit(outbox_drainer.wake)
@@ -0,0 +1,136 @@
+"""
+Streaming export of every registrant with their badges, for staff spreadsheets: see TournamentPlayerViewSet.export.
+"""
+import csv
+import datetime
+import json
+from typing import AsyncIterator, Iterator
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Prefetch, QuerySet
+
+from userauth.authentication import filter_badges
+from userauth.models import TournamentPlayer, TournamentPlayerBadge
+
+
+# same names as TournamentPlayerSerializerWithBadges
+FIELDS = ('user_id',
+          'discord_user_id',
+          'discord_username',
+          'discord_global_name',
+          'osu_user_id',
+          'osu_username',
+          'osu_flag',
+          'osu_stats_updated',
+          'rank_standard',
+          'rank_standard_bws',
+          'is_organizer',
+          'is_captain',
+          'in_roster',
+          'in_backup_roster',
+          'team_id',
+          'badges_pending',
+          'filtered_badges_count',
+          'badges')
+
+
+def player_chunks(queryset: QuerySet, chunk_size: int) -> Iterator[list[TournamentPlayer]]:
+    """
+    Players of `queryset` in pk order, chunk_size at a time with their badges. Each chunk is a query of its own, keyed
+    on the last pk of the previous one: mysqlclient buffers the whole result of QuerySet.iterator() client-side, so
+    memory only stays flat with bounded queries.
+    """
+    queryset = queryset.order_by('pk').prefetch_related(
+        Prefetch('tournamentplayerbadge_set', queryset=TournamentPlayerBadge.objects.order_by('pk'))
+    )
+    last_pk = None
+    while True:
+        chunk = list((queryset if last_pk is None else queryset.filter(pk__gt=last_pk))[:chunk_size])
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last_pk = chunk[-1].pk
+
+
+def player_row(player: TournamentPlayer, cutoff_date: datetime.datetime | None) -> dict:
+    badges = [{'description': badge.description,
+               'awarded_at': datetime.datetime.isoformat(badge.award_date),
+               'url': badge.url,
+               'image_url': badge.image_url,
+               'image_url_2x': badge.image_url_2x}
+              for badge in player.tournamentplayerbadge_set.all()]
+    # as TournamentPlayerSerializerWithBadges.get_badges filters them
+    badges = filter_badges(badges, []) if cutoff_date is None else filter_badges(badges, [], cutoff_date=cutoff_date)
+    return {'user_id': player.user_id,
+            'discord_user_id': player.discord_user_id,
+            'discord_username': player.discord_username,
+            'discord_global_name': player.discord_global_name,
+            'osu_user_id': player.osu_user_id,
+            'osu_username': player.osu_username,
+            'osu_flag': player.osu_flag,
+            'osu_stats_updated': datetime.datetime.isoformat(player.osu_stats_updated),
+            'rank_standard': player.osu_rank_std,
+            'rank_standard_bws': player.osu_rank_std_bws,
+            'is_organizer': player.is_organizer,
+            'is_captain': player.is_captain,
+            'in_roster': player.in_roster,
+            'in_backup_roster': player.in_backup_roster,
+            'team_id': player.team_id,
+            'badges_pending': player.badges_pending,
+            'filtered_badges_count': len(badges),
+            'badges': badges}
+
+
+class Echo:
+    """
+    File-like object handing back what csv.writer writes, so rows can be yielded as they're formatted.
+    """
+
+    @staticmethod
+    def write(value):
+        return value
+
+
+def ndjson_lines(chunks: Iterator[list[TournamentPlayer]], cutoff_date) -> Iterator[str]:
+    for chunk in chunks:
+        yield "".join(json.dumps(player_row(player, cutoff_date)) + "\n" for player in chunk)
+
+
+def csv_lines(chunks: Iterator[list[TournamentPlayer]], cutoff_date) -> Iterator[str]:
+    writer = csv.writer(Echo())
+    yield writer.writerow(FIELDS)
+    for chunk in chunks:
+        rows = []
+        for player in chunk:
+            row = player_row(player, cutoff_date)
+            # a JSON array in a single cell, the badge count has a column of its own
+            row['badges'] = json.dumps(row['badges'])
+            rows.append(writer.writerow([row[field] for field in FIELDS]))
+        yield "".join(rows)
+
+
+FORMATS = {
+    "ndjson": (ndjson_lines, "application/x-ndjson"),
+    "csv": (csv_lines, "text/csv"),
+}
+
+
+def export_lines(queryset: QuerySet, output: str, cutoff_date: datetime.datetime | None = None) -> Iterator[str]:
+    """
+    :param output: one of FORMATS
+    :return: the export of `queryset`, one string per chunk of EXPORT_CHUNK_SIZE players
+    """
+    lines, _ = FORMATS[output]
+    return lines(player_chunks(queryset, settings.EXPORT_CHUNK_SIZE), cutoff_date)
+
+
+async def iterate_in_thread(iterator: Iterator[str]) -> AsyncIterator[str]:
+    """
+    Consume a sync iterator reading the database from an async response. Django's ASGI handler would otherwise
+    collect a sync StreamingHttpResponse into a list before sending any of it.
+    """
+    get_next = sync_to_async(next, thread_sensitive=True)
+    while (chunk := await get_next(iterator, None)) is not None:
+        yield chunk
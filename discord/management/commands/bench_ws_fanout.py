@@ -0,0 +1,86 @@
+import asyncio
+import time
+
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from discord import events
+from discord.consumers import DiscordRegistrationConsumer
+
+
+SAMPLE_PAYLOAD = {"discord_user_id": "109274120794127402",
+                  "osu_user_id": 2155578,
+                  "osu_username": "Azer",
+                  "osu_global_rank": 1292,
+                  "osu_global_rank_bws": 1235,
+                  "osu_flag": "CA",
+                  "is_organizer": False,
+                  "action": "register"}
+
+
+class Command(BaseCommand):
+    help = "Measures websocket fan-out throughput of DiscordRegistrationConsumer to many connected clients"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", default=1000, type=int)
+        parser.add_argument("--messages", default=50, type=int)
+        parser.add_argument("--batch-size", default=1, type=int,
+                            help="events per broadcast; clients opt into batched frames when greater than 1")
+        parser.add_argument("--in-memory", action='store_true',
+                            help="use an in-memory channel layer instead of the configured one")
+
+    def handle(self, *args, **options):
+        if options['clients'] < 1 or options['messages'] < 1 or options['batch_size'] < 1:
+            raise CommandError("--clients, --messages and --batch-size must be positive")
+        run_args = (options['clients'], options['messages'], options['batch_size'])
+
+        if options['in_memory']:
+            # default capacity (100) would silently drop messages once a client's queue fills up
+            layers = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer",
+                                  "CONFIG": {"capacity": options['messages'] + 10}}}
+            with override_settings(CHANNEL_LAYERS=layers):
+                elapsed = asyncio.run(self.run_fanout(*run_args))
+        else:
+            elapsed = asyncio.run(self.run_fanout(*run_args))
+
+        events_delivered = options['clients'] * options['messages'] * options['batch_size']
+        self.stdout.write(
+            self.style.SUCCESS(f"delivered {options['messages']} broadcasts of {options['batch_size']} event(s) "
+                               f"to {options['clients']} clients in {elapsed:.3f}s: "
+                               f"{options['messages'] / elapsed:.1f} broadcasts/s, "
+                               f"{events_delivered / elapsed:.0f} events/s")
+        )
+
+    @staticmethod
+    async def receive_all(communicator: WebsocketCommunicator, count: int):
+        for _ in range(count):
+            await communicator.receive_from(timeout=30)
+
+    async def run_fanout(self, clients: int, messages: int, batch_size: int) -> float:
+        application = DiscordRegistrationConsumer.as_asgi()
+        path = "/ws/discord/?batch=1" if batch_size > 1 else "/ws/discord/"
+        communicators = [WebsocketCommunicator(application, path) for _ in range(clients)]
+        for communicator in communicators:
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise CommandError("websocket client failed to connect")
+        self.stdout.write(f"connected {clients} clients")
+
+        channel_layer = get_channel_layer()
+        start_time = time.perf_counter()
+        for _ in range(messages):
+            if batch_size > 1:
+                message = {"type": "registration.batch",
+                           "frames": [events.encode_frame(SAMPLE_PAYLOAD) for _ in range(batch_size)]}
+            else:
+                message = {"type": "registration.new", "frame": events.encode_frame(SAMPLE_PAYLOAD)}
+            await channel_layer.group_send(settings.CHANNELS_DISCORD_WS_GROUP_NAME, message)
+        await asyncio.gather(*(self.receive_all(communicator, messages) for communicator in communicators))
+        elapsed = time.perf_counter() - start_time
+
+        for communicator in communicators:
+            await communicator.disconnect()
+        return elapsed
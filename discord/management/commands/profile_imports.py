@@ -0,0 +1,110 @@
+import dataclasses
+import os
+import re
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+# what each kind of process imports before it serves its first request or task
+TARGETS = {
+    # gunicorn's UvicornWorker loading kfcrebrand.asgi:application, then the URLconf on the first request
+    "web": "import kfcrebrand.asgi\n"
+           "from django.urls import get_resolver\n"
+           "get_resolver().url_patterns",
+    # celery -A kfcrebrand worker: the app, Django through celery's fixup, then the task modules
+    "worker": "import django\n"
+              "from kfcrebrand.celery import app\n"
+              "django.setup()\n"
+              "app.loader.import_default_modules()",
+}
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+@dataclasses.dataclass
+class ImportedModule:
+    name: str
+    self_us: int
+    cumulative_us: int
+    depth: int
+    # module whose import first imported this one, None for top level imports
+    parent: str | None = None
+
+
+def parse_importtime(output: str) -> list[ImportedModule]:
+    """
+    Modules listed by python -X importtime, in the order they finished importing. Nested imports are indented two
+    spaces per level and listed before the module importing them.
+    """
+    modules = []
+    # modules of each depth whose parent hasn't been listed yet
+    pending: dict[int, list[ImportedModule]] = {}
+    for line in output.splitlines():
+        if (match := IMPORTTIME_LINE.match(line)) is None:
+            continue
+        module = ImportedModule(name=match[4], self_us=int(match[1]), cumulative_us=int(match[2]),
+                                depth=len(match[3]) // 2)
+        for child in pending.pop(module.depth + 1, []):
+            child.parent = module.name
+        pending.setdefault(module.depth, []).append(module)
+        modules.append(module)
+    return modules
+
+
+def import_times(target: str) -> list[ImportedModule]:
+    """
+    Import `target`, one of TARGETS, in a fresh interpreter with the current settings.
+    """
+    env = {**os.environ, "DJANGO_SETTINGS_MODULE": settings.SETTINGS_MODULE}
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", TARGETS[target]],
+                            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise CommandError(f"importing {target} failed:\n{result.stderr[-2000:]}")
+    return parse_importtime(result.stderr)
+
+
+def project_packages() -> set[str]:
+    return {path.name for path in settings.BASE_DIR.iterdir() if (path / "__init__.py").exists()}
+
+
+class Command(BaseCommand):
+    help = ("Reports what starting a web or celery worker process spends importing, per project module and per "
+            "dependency the project imports, from python -X importtime in a fresh interpreter")
+
+    def add_arguments(self, parser):
+        parser.add_argument("target", nargs="?", default="web", choices=TARGETS)
+        parser.add_argument("--limit", default=20, type=int, help="modules listed per section")
+        parser.add_argument("--repeat", default=1, type=int, help="runs to make, the fastest one is reported")
+
+    def handle(self, *args, **options):
+        if options['limit'] < 1 or options['repeat'] < 1:
+            raise CommandError("--limit and --repeat must be positive")
+        runs = [import_times(options['target']) for _ in range(options['repeat'])]
+        modules = min(runs, key=lambda run: sum(module.cumulative_us for module in run if module.depth == 0))
+
+        total_us = sum(module.cumulative_us for module in modules if module.depth == 0)
+        self.stdout.write(self.style.SUCCESS(
+            f"{options['target']}: {total_us / 1000:.1f}ms importing {len(modules)} modules "
+            f"(fastest of {options['repeat']} runs)"
+        ))
+
+        packages = project_packages()
+        is_project = {module.name: module.name.split(".")[0] in packages for module in modules}
+        project = [module for module in modules if is_project[module.name]]
+        self.stdout.write(self.style.NOTICE("\nproject modules, including what they import:"))
+        self.write_table(project, options['limit'])
+
+        # dependencies are listed under the project module that imported them first
+        dependencies = [module for module in modules
+                        if not is_project[module.name] and is_project.get(module.parent, False)]
+        self.stdout.write(self.style.NOTICE("\ndependencies imported by project modules:"))
+        self.write_table(dependencies, options['limit'], importer=True)
+
+    def write_table(self, modules: list[ImportedModule], limit: int, importer: bool = False):
+        self.stdout.write(f"{'cumulative':>12} {'self':>10}  module")
+        for module in sorted(modules, key=lambda m: m.cumulative_us, reverse=True)[:limit]:
+            self.stdout.write(f"{module.cumulative_us / 1000:>10.1f}ms {module.self_us / 1000:>8.1f}ms  {module.name}"
+                              + (f" (imported by {module.parent})" if importer else ""))
@@ -0,0 +1,39 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from kfcrebrand import warmup
+
+
+def warm_osu_token():
+    # imported here, only this step needs the osu! API client
+    from discord.tasks import get_osu_token
+
+    if settings.OSU_CLIENT_ID and get_osu_token() is None:
+        raise RuntimeError("couldn't fetch an osu! API token")
+
+
+class Command(BaseCommand):
+    help = ("Runs the warm-up web workers go through at startup, and fetches the osu! API token celery tasks share, "
+            "reporting the time of each step. Useful after the database or redis restarted, before traffic returns")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--skip", action="append", default=[], choices=[*warmup.STEPS, "osu token"],
+                            help="step to leave out, can be repeated")
+
+    def handle(self, *args, **options):
+        steps = {**warmup.STEPS, "osu token": warm_osu_token}
+        steps = {name: step for name, step in steps.items() if name not in options['skip']}
+        if not steps:
+            raise CommandError("every step was skipped")
+
+        start_time = time.perf_counter()
+        durations, failed = warmup.warm_up(steps)
+        for name, duration in durations.items():
+            status = self.style.ERROR(" failed") if name in failed else ""
+            self.stdout.write(f"{duration * 1000:>10.1f}ms  {name}{status}")
+        elapsed = time.perf_counter() - start_time
+        if failed:
+            raise CommandError(f"{len(failed)} of {len(steps)} steps failed in {elapsed:.3f}s, see the log")
+        self.stdout.write(self.style.SUCCESS(f"warmed up in {elapsed:.3f}s"))
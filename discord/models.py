@@ -1,3 +1,19 @@
 from django.db import models
 
-# Create your models here.
+
+class OutboxEvent(models.Model):
+    """
+    Registration event waiting to be broadcast to websocket listeners.
+
+    Rows are written in the same transaction as the change they describe and removed once sent, see
+    `discord.events.enqueue`.
+    """
+    event_type = models.CharField(max_length=64)
+    message = models.TextField()  # JSON encoded event body
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.event_type} ({self.created})"
+
+    class Meta:
+        ordering = ['pk']
@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions, permissions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.permissions import BasePermission
+
+from userauth.models import TournamentPlayer
+
+
+class ReadOnly(BasePermission):
+    def has_permission(self, request, view):
+        return request.method in permissions.SAFE_METHODS
+
+
+class PreSharedKeyAuthentication(TokenAuthentication, BasePermission):
+    def has_permission(self, request, view):
+        auth = self.authenticate(request)
+        return auth is not None
+
+    def authenticate_credentials(self, key):
+        if settings.DISCORD_PSK != key:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+
+        return None, key
+
+
+class TeamOrganizer(BasePermission):
+    def has_object_permission(self, request, view, obj):
+        return self.is_organizer_of(request.user, None if obj is None else obj.pk)
+
+    @staticmethod
+    def is_organizer_of(user, team_id) -> bool:
+        if isinstance(user, AnonymousUser):
+            return False
+        try:
+            tourney_player = user.tournamentplayer
+        except TournamentPlayer.DoesNotExist:
+            return False
+        if not tourney_player.is_organizer or tourney_player.team_id != team_id:
+            return False
+
+        return True
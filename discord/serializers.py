@@ -0,0 +1,96 @@
+import datetime
+
+from django.contrib.auth.models import User
+from rest_framework import serializers
+
+from discord.permissions import PreSharedKeyAuthentication, TeamOrganizer
+from userauth.authentication import filter_badges, IsSuperUser
+from userauth.models import TournamentPlayer, TournamentPlayerBadge
+
+
+class TournamentPlayerSerializer(serializers.HyperlinkedModelSerializer):
+    url = serializers.HyperlinkedIdentityField(view_name='tournamentplayer-detail')
+    team_id = serializers.ReadOnlyField()
+    user_id = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
+    rank_standard = serializers.ReadOnlyField(source='osu_rank_std')
+    rank_standard_bws = serializers.ReadOnlyField(source='osu_rank_std_bws')
+
+    def to_representation(self, instance):
+        representation = super(TournamentPlayerSerializer, self).to_representation(instance=instance)
+
+        request = self._context['request']
+        # kinda don't like that I have to put these conditions here, but it is what it is
+        has_admin_perms = (IsSuperUser | PreSharedKeyAuthentication)().has_permission(request, None)
+        # team_id, not team: loading the team would cost a query per serialized player
+        has_team_perms = TeamOrganizer.is_organizer_of(request.user, instance.team_id)
+        if not has_admin_perms and not has_team_perms:
+            del representation['is_captain']
+            del representation['in_roster']
+            del representation['in_backup_roster']
+
+        return representation
+
+    class Meta:
+        model = TournamentPlayer
+        fields = ['url',
+                  'user_id',
+                  'discord_user_id',
+                  'discord_username',
+                  'osu_user_id',
+                  'osu_username',
+                  'osu_flag',
+                  'osu_stats_updated',
+                  'rank_standard',
+                  'rank_standard_bws',
+                  'is_organizer',
+                  'is_captain',
+                  'in_roster',
+                  'in_backup_roster',
+                  'team_id',
+                  'team']
+
+
+class BadgeSerializer(serializers.HyperlinkedModelSerializer):
+    # awarded_at = serializers.DateTimeField(source='award_date', format='%Y-%m-%dT%H:%M:%S%:z')  # %:z does not work
+    awarded_at = serializers.SerializerMethodField()
+
+    @staticmethod
+    def get_awarded_at(badge):
+        return datetime.datetime.isoformat(badge.award_date)
+
+    class Meta:
+        model = TournamentPlayerBadge
+        fields = ['description',
+                  'awarded_at',
+                  'url',
+                  'image_url',
+                  'image_url_2x']
+
+
+class TournamentPlayerSerializerWithBadges(TournamentPlayerSerializer):
+    # tournamentplayerbadge_set is the default `related_name` for badge -> tourney player relationship
+    badges = serializers.SerializerMethodField()
+
+    # use this to add `filtered_badge_count`
+    def to_representation(self, instance):
+        representation = super().to_representation(instance)
+        representation['filtered_badges_count'] = len(representation['badges'])
+        return representation
+
+    def get_badges(self, tournament_player: TournamentPlayer):
+        serializer = BadgeSerializer(instance=TournamentPlayerBadge.objects.filter(user=tournament_player),
+                                     many=True,
+                                     read_only=True,
+                                     source='tournamentplayerbadge_set')
+        unfiltered_badges = serializer.data
+        cutoff_date = self.context['request'].query_params.get('badge_cutoff_date', None)
+        if cutoff_date is not None:
+            try:
+                cutoff_date = datetime.datetime.fromtimestamp(int(cutoff_date), tz=datetime.timezone.utc)
+            except ValueError:
+                raise ValueError("Invalid badge_cutoff_date provided, please provide a unix timestamp")
+            return filter_badges(unfiltered_badges, [], cutoff_date=cutoff_date)
+        return filter_badges(unfiltered_badges, [])  # use default cutoff
+
+    class Meta(TournamentPlayerSerializer.Meta):
+        fields = TournamentPlayerSerializer.Meta.fields + ['badges', 'badges_pending']
@@ -1,9 +1,14 @@
 import datetime
 import logging
+import time
 
 from celery import shared_task
 from django.db import transaction
 
+# the app shared_task binds to, it isn't loaded with Django
+import kfcrebrand.celery  # noqa: F401
+
+from kfcrebrand import metrics
 from userauth.authentication import bws, filter_badges, prep_badges_for_db
 from userauth.models import TournamentPlayer, TournamentPlayerBadge
 from django.core.cache import cache
@@ -14,18 +19,37 @@ import requests
 logger = logging.getLogger(__name__)
 
 
+def call_osu_api(send, endpoint: str, url: str, **kwargs) -> requests.Response:
+    """
+    Make an osu! API call, recording its latency into kfcrebrand.metrics.
+    :param send: requests.get, requests.post...
+    :param endpoint: metrics label, the url path with ids left out, e.g. "/users/{id}/osu"
+    :param url: full url of the call
+    :param kwargs: passed on to `send`
+    :return: requests.Response
+    """
+    start_time = time.perf_counter()
+    status = "error"
+    try:
+        response = send(url, **kwargs)
+        status = response.status_code
+        return response
+    finally:
+        metrics.osu_api_request_duration.observe(time.perf_counter() - start_time, endpoint=endpoint, status=status)
+
+
 def get_osu_token() -> str | None:
     token_dict = cache.get("osu_token", None)
     if token_dict is None:
         logger.warning("fetching new osu! token")
-        r = requests.post("https://osu.ppy.sh/oauth/token", {
+        r = call_osu_api(requests.post, "/oauth/token", f"{settings.OSU_OAUTH_ENDPOINT}/token", data={
             "client_id": settings.OSU_CLIENT_ID,
             "client_secret": settings.OSU_CLIENT_SECRET,
             "grant_type": "client_credentials",
             "scope": "public"
         })
         if r.status_code != 200:
-            print(f"[get_osu_token] got status code {r.status_code}")
+            logger.error(f"[get_osu_token] got status code {r.status_code}")
             cache.delete("osu_token")
             return None
         response_data = r.json()
@@ -48,7 +72,7 @@ def update_user(user_id: int):
     if token is None:
         return
 
-    response = requests.get(f"https://osu.ppy.sh/api/v2/users/{user_id}/osu",
+    response = call_osu_api(requests.get, "/users/{id}/osu", f"{settings.OSU_API_ENDPOINT}/users/{user_id}/osu",
                             headers={"Authorization": f"Bearer {token}"})
 
     osu_data = response.json()
@@ -59,12 +83,15 @@ def update_user(user_id: int):
                                           tourney_player.osu_rank_std)
     tourney_player.osu_username = osu_data['username']
     tourney_player.osu_stats_updated = datetime.datetime.now(tz=datetime.timezone.utc)
+    tourney_player.badges_pending = False
 
+    write_start_time = time.perf_counter()
     with transaction.atomic():
         # can't be arsed to update, just delete and recreate them all
         TournamentPlayerBadge.objects.filter(user=tourney_player).delete()
         TournamentPlayerBadge.objects.bulk_create(db_badges)
         tourney_player.save()
+    metrics.task_db_write_duration.observe(time.perf_counter() - write_start_time, task=update_user.name)
     try:
         cache.decr("osu_queue_length")
         cache.touch("osu_queue_length", 60)
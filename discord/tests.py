@@ -1,14 +1,29 @@
+import csv
 import datetime
+import io
+import json
+import time
 from unittest.mock import Mock, patch
 
+from celery.app.task import Context
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import cache
-from django.test import TestCase
+from django.core.management import call_command
+from django.db import transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
 from parameterized import parameterized
+from redis.exceptions import LockNotOwnedError
 from rest_framework.test import APIRequestFactory
 
-from discord import tasks
+from discord import events, tasks
+from discord.consumers import DiscordRegistrationConsumer
+from discord.management.commands import profile_imports
+from discord.models import OutboxEvent
 from discord.views import TeamOrganizer, TournamentPlayerViewSet
+from kfcrebrand import celery, metrics
 from teammgmt.models import TournamentTeam
 from userauth.models import TournamentPlayer, TournamentPlayerBadge
 
@@ -258,6 +273,70 @@ class FetchOsuUserStatsTestCase(TestCase):
                     self.assertEqual(cache_touch.call_count, 1)
 
 
+class TaskMetricsTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.tourney_user = TournamentPlayer.objects.create(user=User.objects.create(),
+                                                            osu_user_id=1,
+                                                            osu_stats_updated=datetime.datetime.fromtimestamp(
+                                                                0,
+                                                                tz=datetime.timezone.utc
+                                                            ))
+
+    @staticmethod
+    def sample(metric: str, sample: str) -> float:
+        return metrics.REGISTRY.collect().get(metric, {}).get(sample, 0)
+
+    @patch("discord.tasks.get_osu_token", Mock(return_value="TEST_VALID_TOKEN"))
+    def test_update_user_records_api_latency_and_db_writes(self):
+        api_sample = 'osu_api_request_duration_seconds_count{endpoint="/users/{id}/osu",status="200"}'
+        write_sample = 'celery_task_db_write_duration_seconds_count{task="discord.tasks.update_user"}'
+        api_before = self.sample("osu_api_request_duration_seconds", api_sample)
+        write_before = self.sample("celery_task_db_write_duration_seconds", write_sample)
+        response = MockResponse({"badges": [], "statistics": {"global_rank": 1000}, "username": "test"}, 200)
+
+        with patch('discord.tasks.requests.get', new=Mock(return_value=response)):
+            tasks.update_user(self.tourney_user.osu_user_id)
+
+        self.assertEqual(api_before + 1, self.sample("osu_api_request_duration_seconds", api_sample))
+        self.assertEqual(write_before + 1, self.sample("celery_task_db_write_duration_seconds", write_sample))
+
+    def test_token_failure_records_status(self):
+        sample = 'osu_api_request_duration_seconds_count{endpoint="/oauth/token",status="401"}'
+        before = self.sample("osu_api_request_duration_seconds", sample)
+
+        with patch('discord.tasks.requests.post', new=Mock(return_value=MockResponse({}, 401))):
+            self.assertIsNone(tasks.get_osu_token())
+
+        self.assertEqual(before + 1, self.sample("osu_api_request_duration_seconds", sample))
+
+    def test_task_run_recorded(self):
+        sample = 'celery_task_duration_seconds_count{task="discord.tasks.update_users",state="SUCCESS"}'
+        before = self.sample("celery_task_duration_seconds", sample)
+
+        with patch("discord.tasks.update_user.delay"):
+            tasks.update_users.apply()
+
+        self.assertEqual(before + 1, self.sample("celery_task_duration_seconds", sample))
+
+    def test_queue_and_rate_limit_wait(self):
+        queue_sample = 'celery_task_queue_wait_seconds_sum{task="discord.tasks.update_user"}'
+        rate_limit_sample = 'celery_task_rate_limit_wait_seconds_sum{task="discord.tasks.update_user"}'
+        queue_before = self.sample("celery_task_queue_wait_seconds", queue_sample)
+        rate_limit_before = self.sample("celery_task_rate_limit_wait_seconds", rate_limit_sample)
+        now = time.time()
+        task = Mock(request=Context(published_at=now - 30, received_at=now - 10))
+        task.name = "discord.tasks.update_user"
+
+        celery.start_task_metrics(task_id="test", task=task)
+        celery.record_task_metrics(task_id="test", task=task, state="SUCCESS")
+
+        self.assertAlmostEqual(queue_before + 20,
+                               self.sample("celery_task_queue_wait_seconds", queue_sample), delta=0.5)
+        self.assertAlmostEqual(rate_limit_before + 10,
+                               self.sample("celery_task_rate_limit_wait_seconds", rate_limit_sample), delta=0.5)
+
+
 class ReturnBadgesOnDetailViewTestCase(TestCase):
     def setUp(self):
         self.maxDiff = None
@@ -456,3 +535,316 @@ class UpdateTournamentPlayerRolesTestCase(TestCase):
         res = set_tourney_user_staff(request, pk=self.tourney_user.discord_user_id)
 
         self.assertEqual(400, res.status_code)
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class DiscordRegistrationConsumerTestCase(TestCase):
+    def test_encode_frame_wire_format(self):
+        payload = {"discord_user_id": "0", "osu_user_id": 1, "action": "delete"}
+        frame = json.loads(events.encode_frame(payload))
+        self.assertEqual(payload, json.loads(frame["message"]))
+
+    async def test_frame_forwarded_unchanged(self):
+        communicator = WebsocketCommunicator(DiscordRegistrationConsumer.as_asgi(), "/ws/discord/")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        frame = events.encode_frame({"discord_user_id": "0", "action": "register"})
+        await get_channel_layer().group_send(settings.CHANNELS_DISCORD_WS_GROUP_NAME,
+                                             {"type": "registration.new", "frame": frame})
+        self.assertEqual(frame, await communicator.receive_from())
+        await communicator.disconnect()
+
+    async def test_batch_unbatched_client_receives_each_frame(self):
+        communicator = WebsocketCommunicator(DiscordRegistrationConsumer.as_asgi(), "/ws/discord/")
+        await communicator.connect()
+
+        frames = [events.encode_frame({"osu_user_id": i, "action": "register"}) for i in range(3)]
+        await get_channel_layer().group_send(settings.CHANNELS_DISCORD_WS_GROUP_NAME,
+                                             {"type": "registration.batch", "frames": frames})
+        for frame in frames:
+            self.assertEqual(frame, await communicator.receive_from())
+        await communicator.disconnect()
+
+    @parameterized.expand([
+        ("query_flag", "/ws/discord/?batch=1", None),
+        ("subprotocol", "/ws/discord/", ["batch"]),
+    ])
+    async def test_batch_opt_in_receives_array_frame(self, _, path, subprotocols):
+        communicator = WebsocketCommunicator(DiscordRegistrationConsumer.as_asgi(), path, subprotocols=subprotocols)
+        await communicator.connect()
+
+        frames = [events.encode_frame({"osu_user_id": i, "action": "register"}) for i in range(3)]
+        await get_channel_layer().group_send(settings.CHANNELS_DISCORD_WS_GROUP_NAME,
+                                             {"type": "registration.batch", "frames": frames})
+        received = json.loads(await communicator.receive_from())
+        self.assertEqual([json.loads(frame) for frame in frames], received)
+
+        # single events are wrapped in an array as well
+        await get_channel_layer().group_send(settings.CHANNELS_DISCORD_WS_GROUP_NAME,
+                                             {"type": "registration.new", "frame": frames[0]})
+        self.assertEqual([json.loads(frames[0])], json.loads(await communicator.receive_from()))
+        await communicator.disconnect()
+
+    async def test_replay_missed_events_before_live_feed(self):
+        missed = [(f"{i}-0", events.encode_frame({"osu_user_id": i}, f"{i}-0")) for i in (2, 3)]
+        with patch("discord.events.read_stream_since", return_value=(missed, False)) as read_stream_since:
+            communicator = WebsocketCommunicator(DiscordRegistrationConsumer.as_asgi(), "/ws/discord/?since=1-0")
+            await communicator.connect()
+            # the replay is read after accepting the connection, i.e. once connect() returned
+            for _, frame in missed:
+                self.assertEqual(frame, await communicator.receive_from())
+        read_stream_since.assert_called_with("1-0")
+
+        # live events already sent during replay are dropped, newer ones are forwarded
+        for event_id in ("3-0", "4-0"):
+            await get_channel_layer().group_send(settings.CHANNELS_DISCORD_WS_GROUP_NAME,
+                                                 {"type": "registration.new",
+                                                  "frame": events.encode_frame({"osu_user_id": 0}, event_id),
+                                                  "id": event_id})
+        self.assertEqual("4-0", json.loads(await communicator.receive_from())["id"])
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_replay_trimmed_stream_requests_resync(self):
+        with patch("discord.events.read_stream_since", return_value=([], True)):
+            communicator = WebsocketCommunicator(DiscordRegistrationConsumer.as_asgi(), "/ws/discord/?since=1-0")
+            await communicator.connect()
+            frame = json.loads(await communicator.receive_from())
+        self.assertEqual("resync", json.loads(frame["message"])["action"])
+        await communicator.disconnect()
+
+    @override_settings(CHANNELS_DISCORD_WS_STREAM_MAXLEN=0)
+    async def test_replay_disabled_stream_requests_resync(self):
+        with patch("discord.events.read_stream_since") as read_stream_since:
+            communicator = WebsocketCommunicator(DiscordRegistrationConsumer.as_asgi(), "/ws/discord/?since=1-0")
+            await communicator.connect()
+            frame = json.loads(await communicator.receive_from())
+        self.assertEqual("resync", json.loads(frame["message"])["action"])
+        read_stream_since.assert_not_called()
+        await communicator.disconnect()
+
+    def test_broadcast_appends_to_stream(self):
+        with patch("discord.events.get_redis_connection") as get_redis_connection:
+            pipeline = get_redis_connection.return_value.pipeline.return_value
+            pipeline.execute.return_value = [b"1700000000000-0", b"1700000000000-1"]
+            with patch("discord.events._group_send") as group_send:
+                events.broadcast_batch([json.dumps({"osu_user_id": 1}), json.dumps({"osu_user_id": 2})])
+
+        self.assertEqual(2, pipeline.xadd.call_count)
+        message = group_send.call_args.args[0]
+        self.assertEqual(["1700000000000-0", "1700000000000-1"], message["ids"])
+        self.assertEqual("1700000000000-1", json.loads(message["frames"][1])["id"])
+
+    @parameterized.expand([
+        ("1700000000000-5", (1700000000000, 5)),
+        ("1700000000000", (1700000000000, 0)),
+        ("not-an-id", None),
+        (None, None),
+    ])
+    def test_parse_event_id(self, event_id, expected):
+        self.assertEqual(expected, events.parse_event_id(event_id))
+
+
+class DrainOutboxTestCase(TestCase):
+
+    def test_drain_sends_in_batches_and_deletes(self):
+        for i in range(5):
+            OutboxEvent.objects.create(event_type="registration.new", message=json.dumps({"osu_user_id": i}))
+
+        with patch("discord.events._group_send") as group_send:
+            sent = events.drain_outbox(batch_size=2)
+
+        self.assertEqual(5, sent)
+        self.assertEqual(3, group_send.call_count)
+        self.assertFalse(OutboxEvent.objects.exists())
+        frames = [frame for call in group_send.call_args_list for frame in call.args[0]["frames"]]
+        self.assertEqual(list(range(5)), [json.loads(json.loads(frame)["message"])["osu_user_id"] for frame in frames])
+
+    def test_drain_keeps_events_when_broadcast_fails(self):
+        OutboxEvent.objects.create(event_type="registration.new", message=json.dumps({"osu_user_id": 1}))
+
+        with patch("discord.events._group_send", side_effect=ConnectionError):
+            with self.assertRaises(ConnectionError):
+                events.drain_outbox()
+
+        self.assertEqual(1, OutboxEvent.objects.count())
+        # released
+        lock = events.outbox_lock()
+        self.assertTrue(lock.acquire(blocking=False))
+        lock.release()
+
+    def test_drain_skipped_while_locked(self):
+        OutboxEvent.objects.create(event_type="registration.new", message=json.dumps({"osu_user_id": 1}))
+        lock = events.outbox_lock()
+        lock.acquire()
+        self.addCleanup(lock.release)
+
+        with patch("discord.events._group_send") as group_send:
+            self.assertEqual(0, events.drain_outbox())
+
+        self.assertEqual(0, group_send.call_count)
+        self.assertEqual(1, OutboxEvent.objects.count())
+
+    def test_drain_stops_once_lock_lost(self):
+        for i in range(3):
+            OutboxEvent.objects.create(event_type="registration.new", message=json.dumps({"osu_user_id": i}))
+        lock = Mock()
+        lock.reacquire.side_effect = [None, LockNotOwnedError("expired")]
+        lock.release.side_effect = LockNotOwnedError("expired")
+
+        with patch("discord.events.outbox_lock", return_value=lock), \
+                patch("discord.events._group_send") as group_send, \
+                self.assertLogs("discord.events", level="WARNING"):
+            self.assertEqual(2, events.drain_outbox(batch_size=2))
+
+        # the batch after the lock expired is left to whoever holds it now
+        self.assertEqual(1, group_send.call_count)
+        self.assertEqual(1, OutboxEvent.objects.count())
+
+    def test_enqueue_drains_on_commit(self):
+        with patch("discord.events.outbox_drainer.wake") as wake:
+            with self.captureOnCommitCallbacks(execute=True):
+                events.enqueue("registration.new", {"osu_user_id": 1})
+        self.assertEqual(1, wake.call_count)
+
+
+class OutboxDrainerTestCase(TransactionTestCase):
+    # the drainer thread only sees committed events
+
+    @override_settings(CHANNELS_DISCORD_WS_BATCH_WINDOW=0.5)
+    def test_events_committed_within_window_sent_together(self):
+        # sweeps would drain on their own, an hour apart there are none during the test
+        drainer = events.OutboxDrainer(interval=3600)
+        with patch("discord.events.outbox_drainer", drainer), patch("discord.events._group_send") as group_send:
+            for i in range(3):
+                with transaction.atomic():
+                    events.enqueue("registration.new", {"osu_user_id": i})
+                time.sleep(0.05)
+            deadline = time.monotonic() + 5
+            while OutboxEvent.objects.exists() and time.monotonic() < deadline:
+                time.sleep(0.05)
+
+        self.assertEqual(1, group_send.call_count)
+        self.assertEqual("registration.batch", group_send.call_args.args[0]["type"])
+        self.assertEqual(3, len(group_send.call_args.args[0]["frames"]))
+
+
+@override_settings(EXPORT_CHUNK_SIZE=2)
+class RegistrantExportTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        for i in range(5):
+            user = User.objects.create(username=f"export_{i}", is_staff=i == 4)
+            player = TournamentPlayer.objects.create(user=user, discord_user_id=str(i), discord_username=f"d{i}",
+                                                     osu_user_id=i, osu_username=f"o{i}", osu_flag="CA",
+                                                     osu_stats_updated=now)
+            for year in (2020, 2022):
+                TournamentPlayerBadge.objects.create(user=player, description=f"Cup {year} Winner",
+                                                     award_date=datetime.datetime(year, 6, 1,
+                                                                                  tzinfo=datetime.timezone.utc),
+                                                     image_url="badge.png", image_url_2x="badge@2x.png")
+
+    def export(self, query=""):
+        response = self.client.get(f"/registrants/export/{query}", HTTP_AUTHORIZATION=f"Token {settings.DISCORD_PSK}")
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.streaming)
+        return response
+
+    def test_requires_psk_or_superuser(self):
+        self.assertIn(self.client.get("/registrants/export/").status_code, (401, 403))
+
+    def test_ndjson(self):
+        response = self.export()
+
+        self.assertEqual("application/x-ndjson", response["Content-Type"])
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+        # staff aren't registrants, as in /registrants/
+        self.assertEqual(["0", "1", "2", "3"], [row["discord_user_id"] for row in rows])
+        # badges before the default cutoff are filtered out, as in /registrants/<pk>/
+        self.assertEqual(["Cup 2022 Winner"], [badge["description"] for badge in rows[0]["badges"]])
+        self.assertEqual(1, rows[0]["filtered_badges_count"])
+
+    def test_badge_cutoff_date(self):
+        rows = [json.loads(line) for line in
+                b"".join(self.export("?badge_cutoff_date=0").streaming_content).decode().splitlines()]
+
+        self.assertEqual(2, rows[0]["filtered_badges_count"])
+
+    def test_csv(self):
+        response = self.export("?output=csv")
+
+        self.assertEqual("text/csv", response["Content-Type"])
+        rows = list(csv.DictReader(io.StringIO(b"".join(response.streaming_content).decode())))
+        self.assertEqual(4, len(rows))
+        self.assertEqual("o0", rows[0]["osu_username"])
+        self.assertEqual(["Cup 2022 Winner"], [badge["description"] for badge in json.loads(rows[0]["badges"])])
+
+    def test_reads_in_chunks(self):
+        response = self.export()
+
+        # players and their badges per chunk of EXPORT_CHUNK_SIZE players, as the response is consumed
+        with self.assertNumQueries(2):
+            next(iter(response.streaming_content))
+        with self.assertNumQueries(2):
+            next(iter(response.streaming_content))
+        with self.assertNumQueries(1):
+            self.assertEqual([], list(response.streaming_content))
+
+    def test_invalid_output(self):
+        response = self.client.get("/registrants/export/?output=xlsx",
+                                   HTTP_AUTHORIZATION=f"Token {settings.DISCORD_PSK}")
+        self.assertEqual(400, response.status_code)
+
+    async def test_streamed_asynchronously(self):
+        response = await self.async_client.get("/registrants/export/",
+                                               AUTHORIZATION=f"Token {settings.DISCORD_PSK}")
+
+        self.assertEqual(200, response.status_code)
+        chunks = [chunk async for chunk in response.streaming_content]
+        self.assertEqual(2, len(chunks))
+        self.assertEqual(4, len(b"".join(chunks).decode().splitlines()))
+
+
+IMPORTTIME_OUTPUT = """\
+import time: self [us] | cumulative | imported package
+import time:       100 |        100 |     celery.local
+import time:       200 |        300 |   celery
+import time:        50 |         50 |   kfcrebrand.metrics
+import time:      1000 |       1350 | kfcrebrand.celery
+import time:        10 |         10 | json
+"""
+
+
+class ProfileImportsTestCase(SimpleTestCase):
+    def test_parse_importtime(self):
+        modules = {module.name: module for module in profile_imports.parse_importtime(IMPORTTIME_OUTPUT)}
+
+        self.assertEqual(["celery.local", "celery", "kfcrebrand.metrics", "kfcrebrand.celery", "json"], list(modules))
+        self.assertEqual((200, 300, 1), (modules["celery"].self_us, modules["celery"].cumulative_us,
+                                         modules["celery"].depth))
+        self.assertEqual("celery", modules["celery.local"].parent)
+        self.assertEqual("kfcrebrand.celery", modules["celery"].parent)
+        self.assertEqual("kfcrebrand.celery", modules["kfcrebrand.metrics"].parent)
+        self.assertIsNone(modules["json"].parent)
+
+    def test_web_process_skips_worker_dependencies(self):
+        modules = {module.name for module in profile_imports.import_times("web")}
+
+        self.assertIn("discord.views", modules)
+        # needed by celery workers and the ASGI runserver only
+        for worker_only in ("celery", "discord.tasks", "userauth.tasks", "daphne", "twisted"):
+            self.assertNotIn(worker_only, modules)
+
+    def test_report(self):
+        out = io.StringIO()
+        with patch.object(profile_imports, "import_times",
+                          return_value=profile_imports.parse_importtime(IMPORTTIME_OUTPUT)):
+            call_command("profile_imports", "worker", stdout=out)
+
+        report = out.getvalue()
+        self.assertIn("worker: 1.4ms importing 5 modules", report)
+        self.assertIn("kfcrebrand.celery", report)
+        self.assertIn("celery (imported by kfcrebrand.celery)", report)
+        self.assertNotIn("json", report)
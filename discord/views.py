@@ -1,139 +1,21 @@
 import datetime
 
-from django.conf import settings
-from django.contrib.auth.models import AnonymousUser, User
 from django.core.cache import cache
-from django.http import Http404
-from django.utils.translation import gettext_lazy as _
-from rest_framework import exceptions, permissions, serializers, status, viewsets
-from rest_framework.authentication import TokenAuthentication
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, StreamingHttpResponse
+from rest_framework import status, viewsets
 from rest_framework.decorators import action
 from rest_framework.exceptions import ValidationError
 from rest_framework.generics import get_object_or_404
-from rest_framework.permissions import BasePermission
 from rest_framework.response import Response
 
-from discord import tasks
-from userauth.authentication import filter_badges, IsSuperUser
-from userauth.models import TournamentPlayer, TournamentPlayerBadge
-
-
-class ReadOnly(BasePermission):
-    def has_permission(self, request, view):
-        return request.method in permissions.SAFE_METHODS
-
-
-class PreSharedKeyAuthentication(TokenAuthentication, BasePermission):
-    def has_permission(self, request, view):
-        auth = self.authenticate(request)
-        return auth is not None
-
-    def authenticate_credentials(self, key):
-        if settings.DISCORD_PSK != key:
-            raise exceptions.AuthenticationFailed(_('Invalid token.'))
-
-        return None, key
-
-
-class TeamOrganizer(BasePermission):
-    def has_object_permission(self, request, view, obj):
-        if isinstance(request.user, AnonymousUser):
-            return False
-        try:
-            tourney_player = request.user.tournamentplayer
-        except TournamentPlayer.DoesNotExist:
-            return False
-        if not tourney_player.is_organizer or tourney_player.team != obj:
-            return False
-
-        return True
-
-
-class TournamentPlayerSerializer(serializers.HyperlinkedModelSerializer):
-    url = serializers.HyperlinkedIdentityField(view_name='tournamentplayer-detail')
-    team_id = serializers.ReadOnlyField()
-    user_id = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
-    rank_standard = serializers.ReadOnlyField(source='osu_rank_std')
-    rank_standard_bws = serializers.ReadOnlyField(source='osu_rank_std_bws')
-
-    def to_representation(self, instance):
-        representation = super(TournamentPlayerSerializer, self).to_representation(instance=instance)
-
-        request = self._context['request']
-        # kinda don't like that I have to put these conditions here, but it is what it is
-        has_admin_perms = (IsSuperUser | PreSharedKeyAuthentication)().has_permission(request, None)
-        has_team_perms = TeamOrganizer().has_object_permission(request, None, instance.team)
-        if not has_admin_perms and not has_team_perms:
-            del representation['is_captain']
-            del representation['in_roster']
-            del representation['in_backup_roster']
-
-        return representation
-
-    class Meta:
-        model = TournamentPlayer
-        fields = ['url',
-                  'user_id',
-                  'discord_user_id',
-                  'discord_username',
-                  'osu_user_id',
-                  'osu_username',
-                  'osu_flag',
-                  'osu_stats_updated',
-                  'rank_standard',
-                  'rank_standard_bws',
-                  'is_organizer',
-                  'is_captain',
-                  'in_roster',
-                  'in_backup_roster',
-                  'team_id',
-                  'team']
-
-
-class BadgeSerializer(serializers.HyperlinkedModelSerializer):
-    # awarded_at = serializers.DateTimeField(source='award_date', format='%Y-%m-%dT%H:%M:%S%:z')  # %:z does not work
-    awarded_at = serializers.SerializerMethodField()
-
-    @staticmethod
-    def get_awarded_at(badge):
-        return datetime.datetime.isoformat(badge.award_date)
-
-    class Meta:
-        model = TournamentPlayerBadge
-        fields = ['description',
-                  'awarded_at',
-                  'url',
-                  'image_url',
-                  'image_url_2x']
-
-
-class TournamentPlayerSerializerWithBadges(TournamentPlayerSerializer):
-    # tournamentplayerbadge_set is the default `related_name` for badge -> tourney player relationship
-    badges = serializers.SerializerMethodField()
-
-    # use this to add `filtered_badge_count`
-    def to_representation(self, instance):
-        representation = super().to_representation(instance)
-        representation['filtered_badges_count'] = len(representation['badges'])
-        return representation
-
-    def get_badges(self, tournament_player: TournamentPlayer):
-        serializer = BadgeSerializer(instance=TournamentPlayerBadge.objects.filter(user=tournament_player),
-                                     many=True,
-                                     read_only=True,
-                                     source='tournamentplayerbadge_set')
-        unfiltered_badges = serializer.data
-        cutoff_date = self.context['request'].query_params.get('badge_cutoff_date', None)
-        if cutoff_date is not None:
-            try:
-                cutoff_date = datetime.datetime.fromtimestamp(int(cutoff_date), tz=datetime.timezone.utc)
-            except ValueError:
-                raise ValueError("Invalid badge_cutoff_date provided, please provide a unix timestamp")
-            return filter_badges(unfiltered_badges, [], cutoff_date=cutoff_date)
-        return filter_badges(unfiltered_badges, [])  # use default cutoff
-
-    class Meta(TournamentPlayerSerializer.Meta):
-        fields = TournamentPlayerSerializer.Meta.fields + ['badges', ]
+from discord.export import FORMATS, export_lines, iterate_in_thread
+# permissions and serializers used to live here
+from discord.permissions import PreSharedKeyAuthentication, ReadOnly, TeamOrganizer  # noqa: F401
+from discord.serializers import (BadgeSerializer, TournamentPlayerSerializer,  # noqa: F401
+                                 TournamentPlayerSerializerWithBadges)
+from userauth.authentication import IsSuperUser
+from userauth.models import TournamentPlayer
 
 
 class TournamentPlayerViewSet(viewsets.ModelViewSet):
@@ -160,6 +42,9 @@ class TournamentPlayerViewSet(viewsets.ModelViewSet):
         if queue_len > 0:
             return Response({"message": f"update tasks queue is not empty, {queue_len} tasks remaining"},
                             status=status.HTTP_429_TOO_MANY_REQUESTS)
+        # imported here, discord.tasks and the osu! API client it pulls in are only needed by the celery worker
+        from discord import tasks
+
         tasks.update_users.delay()
         return Response({"message": "Scheduled all users to be updated"})
 
@@ -168,10 +53,38 @@ class TournamentPlayerViewSet(viewsets.ModelViewSet):
         queue_len = cache.get("osu_queue_length", 0)
 
         tournament_player = self.get_object()
+        from discord import tasks
+
         tasks.update_user.delay(tournament_player.osu_user_id)
         return Response({"message": f"Scheduled {tournament_player.osu_username} ({tournament_player.osu_user_id}) "
                                     f"for update. {queue_len + 1} tasks in queue"})
 
+    @action(detail=False, permission_classes=[PreSharedKeyAuthentication | IsSuperUser], methods=["GET"])
+    def export(self, request):
+        """
+        Every registrant with their badges in a single streamed response, as `?output=ndjson` (default) or
+        `?output=csv`, read EXPORT_CHUNK_SIZE players at a time. Badges are filtered as by retrieve, including its
+        `badge_cutoff_date` parameter.
+        """
+        output = request.query_params.get("output", "ndjson")
+        if output not in FORMATS:
+            return Response({"error": f"output must be one of {tuple(FORMATS)}"}, status=status.HTTP_400_BAD_REQUEST)
+        cutoff_date = request.query_params.get("badge_cutoff_date", None)
+        if cutoff_date is not None:
+            try:
+                cutoff_date = datetime.datetime.fromtimestamp(int(cutoff_date), tz=datetime.timezone.utc)
+            except ValueError:
+                return Response({"error": "Invalid badge_cutoff_date provided, please provide a unix timestamp"},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        lines = export_lines(self.get_queryset(), output, cutoff_date)
+        if isinstance(request._request, ASGIRequest):
+            lines = iterate_in_thread(lines)
+        _, content_type = FORMATS[output]
+        response = StreamingHttpResponse(lines, content_type=content_type)
+        response["Content-Disposition"] = f'attachment; filename="registrants.{output}"'
+        return response
+
     # todo: this should really go...
     def retrieve(self, request, *args, **kwargs):
         try:
@@ -0,0 +1,14 @@
+"""
+MySQL backend for PlanetScale: no foreign key constraints, and connections pooled per worker process so requests reuse
+them, and their TLS sessions, instead of reconnecting every time. Configured through DATABASES like the mysql backend,
+plus these OPTIONS:
+
+- pool_size: idle connections kept per process, 0 to close connections at the end of every request (default 10)
+- health_check_after: seconds a pooled connection may sit idle before it is pinged when reused, with
+  CONN_HEALTH_CHECKS (default 1)
+- statement_timeout: milliseconds a statement may run for, set on every new connection (default no limit)
+- statement_timeout_variable: session variable holding it, "max_execution_time" for MySQL or "query_timeout" for
+  vitess (default "max_execution_time")
+
+CONN_MAX_AGE bounds how long a pooled connection is used for; 0 turns pooling off.
+"""
@@ -0,0 +1,119 @@
+import os
+import re
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.mysql import base as mysql_base
+from django.utils.asyncio import async_unsafe
+from django.utils.functional import cached_property
+
+from .features import DatabaseFeatures
+from .pool import ConnectionPool, get_pool
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_HEALTH_CHECK_AFTER = 1.0
+DEFAULT_STATEMENT_TIMEOUT_VARIABLE = "max_execution_time"
+
+_server_data: dict[str, dict] = {}
+_server_data_lock = threading.RLock()
+
+
+class DatabaseWrapper(mysql_base.DatabaseWrapper):
+    features_class = DatabaseFeatures
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        options = self.settings_dict["OPTIONS"]
+        self.pool_size = options.get("pool_size", DEFAULT_POOL_SIZE)
+        self.health_check_after = options.get("health_check_after", DEFAULT_HEALTH_CHECK_AFTER)
+        self.statement_timeout = options.get("statement_timeout")
+        self.statement_timeout_variable = options.get("statement_timeout_variable",
+                                                      DEFAULT_STATEMENT_TIMEOUT_VARIABLE)
+        # when the current connection was opened, whether it came out of the pool, and by which process
+        self.connection_created_at = None
+        self.connection_reused = False
+        self.connection_pid = None
+
+    @property
+    def pool(self) -> ConnectionPool | None:
+        max_age = self.settings_dict["CONN_MAX_AGE"]
+        if not self.pool_size or max_age == 0:
+            return None
+        health_check_after = self.health_check_after if self.settings_dict["CONN_HEALTH_CHECKS"] else None
+        return get_pool(self.alias, self.pool_size, max_age, health_check_after)
+
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        for option in ("pool_size", "health_check_after", "statement_timeout", "statement_timeout_variable"):
+            kwargs.pop(option, None)
+        if not re.fullmatch(r"\w+", self.statement_timeout_variable):
+            raise ImproperlyConfigured(f"Invalid statement_timeout_variable '{self.statement_timeout_variable}'.")
+        return kwargs
+
+    @async_unsafe
+    def get_new_connection(self, conn_params):
+        pool = self.pool
+        if pool is None:
+            connection = super().get_new_connection(conn_params)
+            self.connection_reused = False
+        else:
+            connection, self.connection_created_at, self.connection_reused = pool.acquire(
+                lambda: super(DatabaseWrapper, self).get_new_connection(conn_params), self.ping)
+            max_age = self.settings_dict["CONN_MAX_AGE"]
+            self.close_at = None if max_age is None else self.connection_created_at + max_age
+        self.connection_pid = os.getpid()
+        return connection
+
+    @staticmethod
+    def ping(connection) -> bool:
+        try:
+            connection.ping()
+        except mysql_base.Database.Error:
+            return False
+        return True
+
+    def init_connection_state(self):
+        # a pooled connection keeps its session variables
+        if self.connection_reused:
+            return
+        super().init_connection_state()
+        if self.statement_timeout:
+            with self.cursor() as cursor:
+                cursor.execute(f"SET @@SESSION.{self.statement_timeout_variable} = %s", [int(self.statement_timeout)])
+
+    def poolable(self) -> bool:
+        """
+        Whether the current connection can be handed to another request as is: no transaction open and nothing gone
+        wrong on it.
+        """
+        return (not self.in_atomic_block
+                and not self.needs_rollback
+                and not self.errors_occurred
+                and self.autocommit == self.settings_dict["AUTOCOMMIT"])
+
+    def _close(self):
+        if self.connection is None:
+            return
+        if self.connection_pid != os.getpid():
+            # inherited through a fork, quitting would close the parent's session
+            return
+        pool = self.pool
+        if pool is not None and self.poolable() and pool.release(self.connection, self.connection_created_at):
+            return
+        return super()._close()
+
+    def close_if_unusable_or_obsolete(self):
+        super().close_if_unusable_or_obsolete()
+        # called when requests start and finish. Under ASGI each request's sync code runs on a thread of its own, whose
+        # connection would be dropped with the thread, so hand it back to the pool instead of keeping it
+        if self.connection is not None and not self.in_atomic_block and self.pool is not None:
+            self.close()
+
+    @cached_property
+    def mysql_server_data(self):
+        # the same for every connection, so query it once per process rather than once per request's thread
+        with _server_data_lock:
+            if self.alias not in _server_data:
+                _server_data[self.alias] = super().mysql_server_data
+            return _server_data[self.alias]
@@ -0,0 +1,6 @@
+from django.db.backends.mysql.features import DatabaseFeatures as MysqlDatabaseFeatures
+
+
+class DatabaseFeatures(MysqlDatabaseFeatures):
+    # vitess doesn't enforce them
+    supports_foreign_keys = False
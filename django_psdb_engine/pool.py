@@ -0,0 +1,110 @@
+import dataclasses
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class PooledConnection:
+    connection: Any
+    created_at: float
+    released_at: float
+
+
+class ConnectionPool:
+    """
+    Idle connections of one worker process, shared by all of its threads.
+
+    Django keeps persistent connections per thread, but under ASGI the sync part of every request runs on a thread of
+    its own, so without this pool every request would open, and TLS handshake, a new connection whatever CONN_MAX_AGE
+    is. Connections are handed out most recently used first, which keeps a few of them busy and lets the rest age out.
+    """
+
+    def __init__(self, max_idle: int, max_age: float | None, health_check_after: float | None):
+        """
+        :param max_idle: idle connections kept, connections released while the pool is full are closed
+        :param max_age: seconds a connection is used for after it was opened, None for no limit
+        :param health_check_after: seconds a connection may sit idle before it is pinged when handed out again, None
+            to never ping
+        """
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.health_check_after = health_check_after
+        self._lock = threading.Lock()
+        self._idle: list[PooledConnection] = []
+        # the parent's sockets must not be used, nor closed, by a forked child
+        os.register_at_fork(after_in_child=self._forget)
+
+    def _forget(self):
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def expired(self, created_at: float, now: float) -> bool:
+        return self.max_age is not None and now - created_at >= self.max_age
+
+    def acquire(self, connect: Callable[[], Any], is_usable: Callable[[Any], bool]) -> tuple[Any, float, bool]:
+        """
+        :param connect: opens a new connection when there's no usable idle one
+        :param is_usable: health check of an idle connection
+        :return: (connection, when it was opened, whether it was reused)
+        """
+        while True:
+            with self._lock:
+                pooled = self._idle.pop() if self._idle else None
+            if pooled is None:
+                return connect(), time.monotonic(), False
+
+            now = time.monotonic()
+            if self.expired(pooled.created_at, now):
+                self.close(pooled.connection)
+                continue
+            if (self.health_check_after is not None and now - pooled.released_at >= self.health_check_after
+                    and not is_usable(pooled.connection)):
+                self.close(pooled.connection)
+                continue
+            return pooled.connection, pooled.created_at, True
+
+    def release(self, connection, created_at: float) -> bool:
+        """
+        :return: whether the pool took the connection, the caller closes it otherwise
+        """
+        now = time.monotonic()
+        if self.expired(created_at, now):
+            return False
+        with self._lock:
+            if len(self._idle) >= self.max_idle:
+                return False
+            self._idle.append(PooledConnection(connection, created_at, now))
+        return True
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for pooled in idle:
+            self.close(pooled.connection)
+
+    @staticmethod
+    def close(connection):
+        try:
+            connection.close()
+        except Exception as e:
+            logger.debug(f"failed to close pooled connection: {repr(e)}")
+
+    def __len__(self):
+        return len(self._idle)
+
+
+_pools: dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias: str, max_idle: int, max_age: float | None, health_check_after: float | None) -> ConnectionPool:
+    with _pools_lock:
+        if alias not in _pools:
+            _pools[alias] = ConnectionPool(max_idle, max_age, health_check_after)
+        return _pools[alias]
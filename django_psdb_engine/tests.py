@@ -0,0 +1,197 @@
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, Mock, patch
+
+from django.test import SimpleTestCase
+
+from django_psdb_engine.pool import ConnectionPool
+
+try:
+    import MySQLdb
+except ImportError:
+    MySQLdb = None
+
+
+SERVER_DATA_ROW = ("8.0.31-vitess", "", "InnoDB", 0, 0, 1)
+
+
+class ConnectionPoolTestCase(SimpleTestCase):
+    def test_reuses_most_recently_released(self):
+        pool = ConnectionPool(max_idle=5, max_age=None, health_check_after=None)
+        first, second = Mock(), Mock()
+        self.assertTrue(pool.release(first, time.monotonic()))
+        self.assertTrue(pool.release(second, time.monotonic()))
+
+        connection, _, reused = pool.acquire(Mock(), Mock())
+        self.assertIs(connection, second)
+        self.assertTrue(reused)
+        self.assertEqual(len(pool), 1)
+
+    def test_connects_when_empty(self):
+        pool = ConnectionPool(max_idle=5, max_age=None, health_check_after=None)
+        new_connection = Mock()
+
+        connection, _, reused = pool.acquire(Mock(return_value=new_connection), Mock())
+        self.assertIs(connection, new_connection)
+        self.assertFalse(reused)
+
+    def test_release_refused_when_full(self):
+        pool = ConnectionPool(max_idle=1, max_age=None, health_check_after=None)
+        self.assertTrue(pool.release(Mock(), time.monotonic()))
+        self.assertFalse(pool.release(Mock(), time.monotonic()))
+
+    def test_expired_connections_closed(self):
+        pool = ConnectionPool(max_idle=5, max_age=60, health_check_after=None)
+        self.assertFalse(pool.release(Mock(), time.monotonic() - 61))
+
+        old = Mock()
+        pool.release(old, time.monotonic() - 59)
+        with patch("django_psdb_engine.pool.time.monotonic", return_value=time.monotonic() + 2):
+            connection, _, reused = pool.acquire(Mock(), Mock())
+        self.assertIsNot(connection, old)
+        self.assertFalse(reused)
+        old.close.assert_called_once()
+
+    def test_health_check_after_idle(self):
+        pool = ConnectionPool(max_idle=5, max_age=None, health_check_after=1)
+        dead, alive = Mock(), Mock()
+        pool.release(alive, time.monotonic())
+        pool.release(dead, time.monotonic())
+        is_usable = Mock(side_effect=lambda connection: connection is alive)
+
+        with patch("django_psdb_engine.pool.time.monotonic", return_value=time.monotonic() + 2):
+            connection, _, reused = pool.acquire(Mock(), is_usable)
+        self.assertIs(connection, alive)
+        self.assertTrue(reused)
+        dead.close.assert_called_once()
+        self.assertEqual(is_usable.call_count, 2)
+
+    def test_no_health_check_when_recently_used(self):
+        pool = ConnectionPool(max_idle=5, max_age=None, health_check_after=1)
+        pool.release(Mock(), time.monotonic())
+        is_usable = Mock()
+
+        pool.acquire(Mock(), is_usable)
+        is_usable.assert_not_called()
+
+    def test_forgotten_after_fork(self):
+        pool = ConnectionPool(max_idle=5, max_age=None, health_check_after=None)
+        inherited = Mock()
+        pool.release(inherited, time.monotonic())
+
+        pool._forget()
+        self.assertEqual(len(pool), 0)
+        inherited.close.assert_not_called()
+
+
+def mock_connection():
+    connection = MagicMock()
+    connection.encoders = {}
+    connection.get_autocommit.return_value = True
+    connection.cursor.return_value.fetchone.return_value = SERVER_DATA_ROW
+    return connection
+
+
+@unittest.skipIf(MySQLdb is None, "mysqlclient isn't installed")
+class DatabaseWrapperTestCase(SimpleTestCase):
+    def setUp(self):
+        from django.db.backends.mysql import base as mysql_base
+        from django_psdb_engine import base, pool
+
+        patcher = patch.object(mysql_base.Database, "connect", side_effect=lambda **kwargs: mock_connection())
+        self.connect = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.dict(pool._pools, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.dict(base._server_data, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def make_wrapper(conn_max_age=300, **options):
+        from django_psdb_engine.base import DatabaseWrapper
+
+        return DatabaseWrapper({
+            "ENGINE": "django_psdb_engine",
+            "NAME": "kfc",
+            "USER": "user",
+            "PASSWORD": "password",
+            "HOST": "db.example.com",
+            "PORT": "3306",
+            "ATOMIC_REQUESTS": False,
+            "AUTOCOMMIT": True,
+            "CONN_MAX_AGE": conn_max_age,
+            "CONN_HEALTH_CHECKS": True,
+            "OPTIONS": {"ssl": {"ca": "/etc/ssl/certs/ca-certificates.crt"}, **options},
+            "TIME_ZONE": None,
+            "TEST": {},
+        }, alias="psdb")
+
+    def run_request(self, **kwargs):
+        """
+        Connect, query and finish like a request on a thread of its own does under ASGI.
+        """
+        def request():
+            wrapper = self.make_wrapper(**kwargs)
+            wrapper.close_if_unusable_or_obsolete()
+            with wrapper.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            wrapper.close_if_unusable_or_obsolete()
+
+        thread = threading.Thread(target=request)
+        thread.start()
+        thread.join()
+
+    def test_custom_options_not_passed_to_mysqlclient(self):
+        params = self.make_wrapper(pool_size=3, statement_timeout=5000).get_connection_params()
+        self.assertNotIn("pool_size", params)
+        self.assertNotIn("statement_timeout", params)
+        self.assertEqual(params["ssl"], {"ca": "/etc/ssl/certs/ca-certificates.crt"})
+
+    def test_requests_share_one_connection(self):
+        connections = []
+        self.connect.side_effect = lambda **kwargs: connections.append(mock_connection()) or connections[-1]
+        for _ in range(5):
+            self.run_request()
+
+        self.assertEqual(len(connections), 1)
+        # the server variables are queried and the session is set up once, not once per request
+        executed = [c.args[0] for c in connections[0].cursor.return_value.execute.mock_calls]
+        self.assertEqual(sum("@@sql_mode" in sql for sql in executed), 1)
+        self.assertEqual(sum("ISOLATION LEVEL" in sql for sql in executed), 1)
+        self.assertEqual(executed.count("SELECT 1"), 5)
+
+    def test_statement_timeout_set_once_per_connection(self):
+        connections = []
+        self.connect.side_effect = lambda **kwargs: connections.append(mock_connection()) or connections[-1]
+        for _ in range(3):
+            self.run_request(statement_timeout=5000, statement_timeout_variable="query_timeout")
+
+        self.assertEqual(len(connections), 1)
+        executed = [c.args for c in connections[0].cursor.return_value.execute.mock_calls]
+        self.assertEqual(executed.count(("SET @@SESSION.query_timeout = %s", [5000])), 1)
+        self.assertEqual([sql for sql, *_ in executed].count("SELECT 1"), 3)
+
+    def test_no_pooling_without_conn_max_age(self):
+        for _ in range(3):
+            self.run_request(conn_max_age=0)
+        self.assertEqual(self.connect.call_count, 3)
+
+    def test_connection_with_errors_not_pooled(self):
+        wrapper = self.make_wrapper()
+        wrapper.ensure_connection()
+        connection = wrapper.connection
+        wrapper.errors_occurred = True
+        wrapper.close()
+
+        connection.close.assert_called_once()
+        self.run_request()
+        self.assertEqual(self.connect.call_count, 2)
+
+    def test_invalid_statement_timeout_variable(self):
+        from django.core.exceptions import ImproperlyConfigured
+
+        with self.assertRaises(ImproperlyConfigured):
+            self.make_wrapper(statement_timeout_variable="x; DROP TABLE y").get_connection_params()
@@ -1,5 +1,11 @@
-# This will make sure the app is always imported when
-# Django starts so that shared_task will use this app.
-from .celery import app as celery_app
+# The celery app is loaded on first use rather than along with Django: web processes only need it to queue tasks, and
+# task modules import kfcrebrand.celery so that shared_task uses this app. `celery -A kfcrebrand` finds it there too.
+def __getattr__(name):
+    if name == "celery_app":
+        from .celery import app
+
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 __all__ = ('celery_app',)
@@ -9,21 +9,22 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 
 import os
 
-from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.security.websocket import AllowedHostsOriginValidator
 from django.core.asgi import get_asgi_application
 
-from discord.routing import websocket_urlpatterns
-
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'kfcrebrand.settings')
 
+# initialize django (and the app registry) before importing consumers, which depend on models
 django_asgi_app = get_asgi_application()
 
+from discord.routing import websocket_urlpatterns  # noqa: E402
+from kfcrebrand.warmup import Lifespan  # noqa: E402
+
 
 application = ProtocolTypeRouter(
     {
         "http": django_asgi_app,
         "websocket": URLRouter(websocket_urlpatterns),
+        "lifespan": Lifespan(),
     }
 )
@@ -0,0 +1,356 @@
+import collections
+import json
+import logging
+import os
+import pickle
+import re
+import threading
+import time
+from typing import Callable, Iterable
+
+from django.core.cache.backends import locmem
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django_redis import cache as django_redis_cache
+
+from kfcrebrand import metrics
+
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+# digit runs, e.g. user ids, and long random tokens, e.g. session keys
+KEY_ID = re.compile(r"\d+|[0-9a-z]{20,}")
+
+
+def key_family(key) -> str:
+    """
+    `key` with its ids and tokens replaced by *, so per-key metrics get a series per kind of key, not per user or
+    session: "auth_principal_42" -> "auth_principal_*".
+    """
+    return KEY_ID.sub("*", str(key))
+
+
+def record_key_gets(keys: Iterable, found, result: str = "hit"):
+    """
+    :param found: keys of `keys` that were found, counted as `result`, the others as misses
+    """
+    counts = collections.Counter((key_family(key), result if key in found else "miss") for key in keys)
+    for (family, key_result), amount in counts.items():
+        metrics.cache_key_gets.inc(amount, key=family, result=key_result)
+
+
+class InstrumentedCacheMixin:
+    """
+    Counts hits and misses of get into kfcrebrand.metrics, per kind of key and into the current request's stats.
+    """
+
+    def get(self, key, default=None, version=None, **kwargs):
+        value = super().get(key, _MISSING, version=version, **kwargs)
+        if value is _MISSING:
+            metrics.record_cache_gets(hits=0, misses=1)
+            metrics.cache_key_gets.inc(key=key_family(key), result="miss")
+            return default
+        metrics.record_cache_gets(hits=1, misses=0)
+        metrics.cache_key_gets.inc(key=key_family(key), result="hit")
+        return value
+
+
+class RedisCache(InstrumentedCacheMixin, django_redis_cache.RedisCache):
+    def get_many(self, keys, version=None, **kwargs):
+        # a single MGET; BaseCache.get_many of other backends goes through get and is counted there
+        keys = list(keys)
+        values = super().get_many(keys, version=version, **kwargs)
+        metrics.record_cache_gets(hits=len(values), misses=len(keys) - len(values))
+        record_key_gets(keys, values)
+        return values
+
+
+class LocMemCache(InstrumentedCacheMixin, locmem.LocMemCache):
+    pass
+
+
+# seconds between attempts to subscribe to invalidations again after losing the connection
+RESUBSCRIBE_DELAY = 1
+
+
+class LocalTier:
+    """
+    Bounded LRU of pickled values held in process by TwoTierRedisCache, shared by all of the process's threads, whose
+    entries expire after `ttl` seconds at most.
+
+    Writes made through TwoTierRedisCache by any process are published on `channel`, and evicted from every local
+    tier by a subscriber thread. Entries are only stored and served while that subscription is up: a process that
+    can't hear about writes falls back to reading redis every time, and its tier is emptied whenever it subscribes
+    (again) since it may have missed some while it wasn't.
+    """
+
+    def __init__(self, channel: str, max_entries: int, ttl: float):
+        self.channel = channel
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # made key -> (expiry on the monotonic clock, pickled value), least recently used first
+        self._entries: collections.OrderedDict[str, tuple[float, bytes]] = collections.OrderedDict()
+        # bumped by every eviction, so a value read from redis before one isn't stored after it
+        self.generation = 0
+        self.subscribed = False
+        self._subscriber: threading.Thread | None = None
+        # celery's prefork pool: the subscriber thread stays with the parent, children start their own
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self.subscribed = False
+        self._subscriber = None
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            if (entry := self._entries.get(key)) is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes, generation: int):
+        """
+        :param generation: self.generation from before `value` was read from redis
+        """
+        with self._lock:
+            if generation != self.generation or not self.subscribed:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def evict(self, keys: Iterable[str]):
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def handle_message(self, data: bytes | str):
+        """
+        :param data: JSON list of made keys written, or "*" after a clear
+        """
+        message = json.loads(data)
+        if message == "*":
+            self.clear()
+        else:
+            self.evict(message)
+
+    def ensure_subscribed(self, connect: Callable) -> bool:
+        """
+        Start the subscriber thread if it isn't running yet.
+        :param connect: returns the redis client to subscribe with
+        :return: whether the tier is usable, i.e. subscribed
+        """
+        if self._subscriber is None:
+            with self._lock:
+                if self._subscriber is None:
+                    self._subscriber = threading.Thread(target=self._run_subscriber, args=(connect,),
+                                                        name="cache-invalidation", daemon=True)
+                    self._subscriber.start()
+        return self.subscribed
+
+    def _run_subscriber(self, connect: Callable):
+        while True:
+            try:
+                self.listen(connect().pubsub())
+            except Exception as e:
+                logger.warning(f"lost cache invalidations on {self.channel}, reading redis until resubscribed: "
+                               f"{repr(e)}")
+            time.sleep(RESUBSCRIBE_DELAY)
+
+    def listen(self, pubsub):
+        try:
+            pubsub.subscribe(self.channel)
+            for message in pubsub.listen():
+                if message["type"] == "subscribe":
+                    self.clear()
+                    self.subscribed = True
+                elif message["type"] == "message":
+                    self.handle_message(message["data"])
+        finally:
+            self.subscribed = False
+            self.clear()
+            pubsub.close()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_local_tiers: dict[str, LocalTier] = {}
+_local_tiers_lock = threading.Lock()
+
+
+def get_local_tier(channel: str, max_entries: int, ttl: float) -> LocalTier:
+    # django instantiates cache backends per thread, the local tier is per process
+    with _local_tiers_lock:
+        if channel not in _local_tiers:
+            _local_tiers[channel] = LocalTier(channel, max_entries, ttl)
+        return _local_tiers[channel]
+
+
+class TwoTierRedisCache(RedisCache):
+    """
+    RedisCache with a LocalTier in front: repeated reads of hot keys, like osu_queue_length or cached principals, are
+    served from the process's memory instead of a round trip to redis.
+
+    Every write through this backend evicts the keys from the local tier of every process subscribed to the
+    invalidation channel, so other processes read stale values only until the invalidation reaches them, usually
+    within a millisecond, and never for longer than L1_TTL. Keys expiring in redis, or written to redis by anything
+    else, stay cached locally for up to L1_TTL.
+
+    OPTIONS, besides django_redis's:
+    L1_MAX_ENTRIES: values held per process, 0 disables the local tier (default 1000)
+    L1_TTL: seconds a value is held for at most, 0 disables the local tier (default 5)
+    L1_CHANNEL: pub/sub channel of invalidations, shared by every instance using the same KEY_PREFIX by default
+    """
+
+    def __init__(self, server, params):
+        super().__init__(server, params)
+        options = params.get("OPTIONS", {})
+        max_entries = options.get("L1_MAX_ENTRIES", 1000)
+        ttl = options.get("L1_TTL", 5)
+        channel = options.get("L1_CHANNEL", f"cache_invalidation:{self.key_prefix}")
+        self.local = get_local_tier(channel, max_entries, ttl) if max_entries > 0 and ttl > 0 else None
+
+    def local_tier(self) -> LocalTier | None:
+        """
+        :return: the local tier if it can be used, i.e. is enabled and subscribed to invalidations
+        """
+        if self.local is None or not self.local.ensure_subscribed(lambda: self.client.get_client(write=True)):
+            return None
+        return self.local
+
+    def made_key(self, key, version=None) -> str:
+        return str(self.client.make_key(key, version=version))
+
+    def get(self, key, default=None, version=None, **kwargs):
+        if (local := self.local_tier()) is None:
+            return super().get(key, default, version=version, **kwargs)
+        made_key = self.made_key(key, version)
+        if (pickled := local.get(made_key)) is not None:
+            metrics.record_cache_gets(hits=1, misses=0)
+            metrics.cache_key_gets.inc(key=key_family(key), result="local_hit")
+            return pickle.loads(pickled)
+
+        generation = local.generation
+        value = super().get(key, _MISSING, version=version, **kwargs)
+        if value is _MISSING:
+            return default
+        local.set(made_key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), generation)
+        return value
+
+    def get_many(self, keys, version=None, **kwargs):
+        if (local := self.local_tier()) is None:
+            return super().get_many(keys, version=version, **kwargs)
+        values = {}
+        remaining = {}
+        for key in keys:
+            made_key = self.made_key(key, version)
+            if (pickled := local.get(made_key)) is not None:
+                values[key] = pickle.loads(pickled)
+            else:
+                remaining[key] = made_key
+        if values:
+            metrics.record_cache_gets(hits=len(values), misses=0)
+            record_key_gets(values, values, result="local_hit")
+
+        if remaining:
+            generation = local.generation
+            found = super().get_many(remaining, version=version, **kwargs)
+            for key, value in found.items():
+                local.set(remaining[key], pickle.dumps(value, pickle.HIGHEST_PROTOCOL), generation)
+            values.update(found)
+        return values
+
+    def invalidate(self, keys: Iterable, version=None):
+        """
+        Evict `keys` from the local tier of this process, and of every other one through the invalidation channel.
+        """
+        if self.local is None:
+            return
+        made_keys = [self.made_key(key, version) for key in keys]
+        self.local.evict(made_keys)
+        self.publish(json.dumps(made_keys))
+
+    def publish(self, message: str):
+        try:
+            self.client.get_client(write=True).publish(self.local.channel, message)
+        except Exception as e:
+            # the write itself went through, other processes see it within L1_TTL
+            logger.warning(f"failed to publish cache invalidation on {self.local.channel}: {repr(e)}")
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, **kwargs):
+        result = super().set(key, value, timeout, version=version, **kwargs)
+        self.invalidate([key], version)
+        return result
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None, **kwargs):
+        added = super().add(key, value, timeout, version=version, **kwargs)
+        if added:
+            self.invalidate([key], version)
+        return added
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None, **kwargs):
+        result = super().set_many(data, timeout, version=version, **kwargs)
+        self.invalidate(data, version)
+        return result
+
+    def delete(self, key, version=None, **kwargs):
+        result = super().delete(key, version=version, **kwargs)
+        self.invalidate([key], version)
+        return result
+
+    def delete_many(self, keys, version=None, **kwargs):
+        keys = list(keys)
+        result = super().delete_many(keys, version=version, **kwargs)
+        self.invalidate(keys, version)
+        return result
+
+    def incr(self, key, delta=1, version=None, **kwargs):
+        value = super().incr(key, delta, version=version, **kwargs)
+        self.invalidate([key], version)
+        return value
+
+    def decr(self, key, delta=1, version=None, **kwargs):
+        value = super().decr(key, delta, version=version, **kwargs)
+        self.invalidate([key], version)
+        return value
+
+    def incr_version(self, key, delta=1, version=None, **kwargs):
+        if version is None:
+            version = self.version
+        new_version = super().incr_version(key, delta, version=version, **kwargs)
+        if self.local is not None:
+            made_keys = [self.made_key(key, version), self.made_key(key, new_version)]
+            self.local.evict(made_keys)
+            self.publish(json.dumps(made_keys))
+        return new_version
+
+    def invalidate_all(self):
+        if self.local is not None:
+            self.local.clear()
+            self.publish(json.dumps("*"))
+
+    def delete_pattern(self, *args, **kwargs):
+        result = super().delete_pattern(*args, **kwargs)
+        self.invalidate_all()
+        return result
+
+    def clear(self):
+        result = super().clear()
+        self.invalidate_all()
+        return result
@@ -1,6 +1,7 @@
 import os
+import time
 
-from celery import Celery
+from celery import Celery, signals
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'kfcrebrand.settings')
@@ -15,3 +16,54 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 
 # Load task modules from all registered Django apps.
 app.autodiscover_tasks()
+
+
+# task metrics, see kfcrebrand.metrics. It is imported in the handlers, this module is loaded along with the settings.
+# Published and received times are wall clock since they're taken by different hosts or processes. Message headers
+# and the request dict end up as attributes of task.request on the worker
+@signals.before_task_publish.connect
+def stamp_published_at(headers=None, **kwargs):
+    if headers is not None:
+        headers["published_at"] = time.time()
+
+
+@signals.task_received.connect
+def stamp_received_at(request=None, **kwargs):
+    # sent before the task is held back by its rate limit
+    request.request_dict["received_at"] = time.time()
+
+
+_running_tasks = {}
+
+
+@signals.task_prerun.connect
+def start_task_metrics(task_id=None, task=None, **kwargs):
+    from kfcrebrand import metrics
+
+    now = time.time()
+    published_at = task.request.get("published_at")
+    received_at = task.request.get("received_at")
+    if published_at is not None and received_at is not None:
+        metrics.task_queue_wait.observe(max(received_at - published_at, 0), task=task.name)
+    if received_at is not None:
+        metrics.task_rate_limit_wait.observe(max(now - received_at, 0), task=task.name)
+    _running_tasks[task_id] = (time.perf_counter(), *metrics.start_request())
+
+
+@signals.task_postrun.connect
+def record_task_metrics(task_id=None, task=None, state=None, **kwargs):
+    from kfcrebrand import metrics
+
+    if (running := _running_tasks.pop(task_id, None)) is None:
+        return
+    start_time, stats, token = running
+    metrics.end_request(token)
+    metrics.record_task(stats, task.name, state or "UNKNOWN", time.perf_counter() - start_time)
+
+
+@signals.worker_process_shutdown.connect
+@signals.worker_shutdown.connect
+def flush_metrics(**kwargs):
+    from kfcrebrand import metrics
+
+    metrics.REGISTRY.flush()
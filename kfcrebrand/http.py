@@ -0,0 +1,56 @@
+import asyncio
+import time
+import weakref
+
+import httpx
+from django.conf import settings
+
+from kfcrebrand import metrics
+
+
+_clients: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient] = weakref.WeakKeyDictionary()
+
+
+async def _mark_request_start(request: httpx.Request):
+    request.extensions["metrics_start_time"] = time.perf_counter()
+
+
+async def _record_response(response: httpx.Response):
+    start_time = response.request.extensions.get("metrics_start_time")
+    if start_time is not None:
+        metrics.record_outbound_request(response.request.url.host, response.status_code,
+                                        time.perf_counter() - start_time)
+
+
+# times every outbound call into kfcrebrand.metrics
+EVENT_HOOKS = {"request": [_mark_request_start], "response": [_record_response]}
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Get the pooled HTTP client for outbound API calls made from async views.
+
+    Pooled connections belong to the event loop that opened them, so one client is kept per running loop. Under uvicorn
+    that is a single client per worker process.
+    :return: httpx.AsyncClient
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.OUTBOUND_HTTP_TIMEOUT, connect=settings.OUTBOUND_HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=settings.OUTBOUND_HTTP_MAX_CONNECTIONS,
+                                max_keepalive_connections=settings.OUTBOUND_HTTP_MAX_CONNECTIONS),
+            event_hooks=EVENT_HOOKS,
+        )
+        _clients[loop] = client
+    return client
+
+
+async def close_async_client():
+    """
+    Close the client of the running event loop, if it has one, e.g. when the worker shuts down.
+    """
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
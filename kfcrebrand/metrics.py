@@ -0,0 +1,293 @@
+"""
+Prometheus metrics shared by every worker process.
+
+Each process records samples into its own registry, which costs a lock and a few dict updates, and a background thread
+adds what was recorded since its last flush to redis every METRICS_FLUSH_INTERVAL seconds. /metrics renders the totals
+kept in redis, so whichever worker answers the scrape reports all of them. Without redis behind the default cache, the
+answering process renders its own totals instead.
+"""
+import contextvars
+import dataclasses
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django_redis import get_redis_connection
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# a refresh of every registrant queues thousands of rate limited tasks at once
+WAIT_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200)
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+
+
+def sample_name(name: str, labels: dict) -> str:
+    """
+    :return: the sample as it appears in the exposition format, e.g. 'cache_gets_total{result="hit"}'
+    """
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{label}="{_escape(value)}"' for label, value in labels.items()) + "}"
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.metrics: dict[str, "Metric"] = {}
+        # metric name -> sample name -> value, since the process started and since the last flush
+        self._totals: dict[str, dict[str, float]] = {}
+        self._pending: dict[str, dict[str, float]] = {}
+        # None until the first flush finds out whether redis is there
+        self.shared: bool | None = None
+        self._flusher: threading.Thread | None = None
+        # celery's prefork pool: the parent's samples and flusher thread stay with the parent
+        os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        self._lock = threading.Lock()
+        self._totals = {}
+        self._pending = {}
+        self._flusher = None
+
+    def register(self, metric: "Metric"):
+        self.metrics[metric.name] = metric
+
+    def add(self, name: str, samples: list[tuple[str, float]]):
+        with self._lock:
+            totals = self._totals.setdefault(name, {})
+            pending = self._pending.setdefault(name, {})
+            for sample, amount in samples:
+                totals[sample] = totals.get(sample, 0) + amount
+                pending[sample] = pending.get(sample, 0) + amount
+            if self._flusher is None and self.shared is not False:
+                self._flusher = threading.Thread(target=self._run_flusher, name="metrics-flusher", daemon=True)
+                self._flusher.start()
+
+    def _run_flusher(self):
+        while self.shared is not False:
+            time.sleep(settings.METRICS_FLUSH_INTERVAL)
+            self.flush()
+
+    def _redis_key(self, name: str) -> str:
+        return f"{settings.METRICS_REDIS_KEY_PREFIX}:{name}"
+
+    def flush(self):
+        """
+        Add the samples recorded since the last flush to the totals in redis. They are kept for the next flush if redis
+        can't be reached.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if self.shared is False or not pending:
+            return
+        try:
+            pipeline = get_redis_connection("default").pipeline(transaction=False)
+            for name, samples in pending.items():
+                for sample, amount in samples.items():
+                    pipeline.hincrbyfloat(self._redis_key(name), sample, amount)
+            pipeline.execute()
+            self.shared = True
+        except NotImplementedError:
+            # the default cache isn't redis
+            self.shared = False
+        except Exception as e:
+            logger.warning(f"failed to flush metrics to redis: {repr(e)}")
+            with self._lock:
+                for name, samples in pending.items():
+                    kept = self._pending.setdefault(name, {})
+                    for sample, amount in samples.items():
+                        kept[sample] = kept.get(sample, 0) + amount
+
+    def collect(self) -> dict[str, dict[str, float]]:
+        """
+        :return: metric name to sample name to value, across every process when redis is available
+        """
+        self.flush()
+        if self.shared:
+            try:
+                pipeline = get_redis_connection("default").pipeline(transaction=False)
+                for name in self.metrics:
+                    pipeline.hgetall(self._redis_key(name))
+                return {name: {sample.decode(): float(value) for sample, value in samples.items()}
+                        for name, samples in zip(self.metrics, pipeline.execute())}
+            except Exception as e:
+                logger.warning(f"failed to read metrics from redis, rendering this process only: {repr(e)}")
+        with self._lock:
+            return {name: dict(samples) for name, samples in self._totals.items()}
+
+    def render(self) -> str:
+        """
+        :return: every metric in the Prometheus text exposition format
+        """
+        collected = self.collect()
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            samples = sorted(collected.get(name, {}).items())
+            lines.extend(f"{sample} {_format_value(value)}" for sample, value in samples)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    type: str = None
+
+    def __init__(self, name: str, documentation: str, registry: Registry = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.registry = registry
+        registry.register(self)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        self.registry.add(self.name, [(sample_name(self.name, labels), amount)])
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets=DEFAULT_BUCKETS, registry: Registry = REGISTRY):
+        super().__init__(name, documentation, registry)
+        self.buckets = [(bound, _format_value(bound)) for bound in buckets] + [(float("inf"), "+Inf")]
+
+    def observe(self, value: float, **labels):
+        # every bucket is written, so all of them exist for histogram_quantile even before they count anything
+        samples = [(sample_name(f"{self.name}_bucket", {**labels, "le": le}), 1 if value <= bound else 0)
+                   for bound, le in self.buckets]
+        samples.append((sample_name(f"{self.name}_sum", labels), value))
+        samples.append((sample_name(f"{self.name}_count", labels), 1))
+        self.registry.add(self.name, samples)
+
+
+request_duration = Histogram("http_request_duration_seconds", "Wall time of requests, by view, method and status")
+request_db_queries = Histogram("http_request_db_queries", "Database queries per request, by view",
+                               buckets=COUNT_BUCKETS)
+request_db_duration = Histogram("http_request_db_duration_seconds", "Database time per request, by view")
+request_cache_hits = Counter("http_request_cache_hits_total", "Cache hits during requests, by view")
+request_cache_misses = Counter("http_request_cache_misses_total", "Cache misses during requests, by view")
+request_outbound_duration = Histogram("http_request_outbound_duration_seconds",
+                                      "Time spent on outbound HTTP calls per request making any, by view")
+task_queue_wait = Histogram("celery_task_queue_wait_seconds",
+                            "Time from publishing a task to a worker receiving it, by task", buckets=WAIT_BUCKETS)
+task_rate_limit_wait = Histogram("celery_task_rate_limit_wait_seconds",
+                                 "Time from a worker receiving a task to starting it, by task: the rate limiter's hold "
+                                 "plus waiting for a free pool process", buckets=WAIT_BUCKETS)
+task_duration = Histogram("celery_task_duration_seconds", "Run time of tasks, by task and state")
+task_db_queries = Histogram("celery_task_db_queries", "Database queries per task run, by task", buckets=COUNT_BUCKETS)
+task_db_duration = Histogram("celery_task_db_duration_seconds", "Database time per task run, by task")
+task_db_write_duration = Histogram("celery_task_db_write_duration_seconds",
+                                   "Time in the transaction writing a task's results, by task")
+osu_api_request_duration = Histogram("osu_api_request_duration_seconds",
+                                     "Latency of osu! API calls made by tasks, by endpoint and status")
+cache_gets = Counter("cache_gets_total", "Cache lookups by the instrumented cache backends, by result")
+cache_key_gets = Counter("cache_key_gets_total",
+                         "Cache lookups by kind of key, ids in keys replaced by *, and result: local_hit for values "
+                         "served from the in-process tier of TwoTierRedisCache, hit or miss in the backend")
+warmup_duration = Histogram("process_warmup_duration_seconds",
+                            "Time spent warming a worker up before it serves requests, by step")
+outbound_request_duration = Histogram("outbound_http_request_duration_seconds",
+                                      "Time to response headers of outbound HTTP calls, by host and status")
+
+
+@dataclasses.dataclass
+class RequestStats:
+    db_queries: int = 0
+    db_time: float = 0.0
+    cache_hits: int = 0
+    cache_misses: int = 0
+    outbound_requests: int = 0
+    outbound_time: float = 0.0
+
+
+# set by RequestMetricsMiddleware for the duration of a request. asgiref copies the context into sync_to_async threads,
+# so work done on behalf of async views still lands on their request
+_request_stats: contextvars.ContextVar[RequestStats | None] = contextvars.ContextVar("request_stats", default=None)
+
+
+def start_request() -> tuple[RequestStats, contextvars.Token]:
+    """
+    Start collecting database, cache and outbound HTTP stats of a request, or of a task run, in the current context.
+    """
+    stats = RequestStats()
+    return stats, _request_stats.set(stats)
+
+
+def end_request(token: contextvars.Token):
+    _request_stats.reset(token)
+
+
+def record_request(stats: RequestStats, view: str, method: str, status: int, duration: float):
+    request_duration.observe(duration, view=view, method=method, status=status)
+    request_db_queries.observe(stats.db_queries, view=view)
+    request_db_duration.observe(stats.db_time, view=view)
+    if stats.cache_hits:
+        request_cache_hits.inc(stats.cache_hits, view=view)
+    if stats.cache_misses:
+        request_cache_misses.inc(stats.cache_misses, view=view)
+    if stats.outbound_requests:
+        request_outbound_duration.observe(stats.outbound_time, view=view)
+
+
+def record_task(stats: RequestStats, task: str, state: str, duration: float):
+    task_duration.observe(duration, task=task, state=state)
+    task_db_queries.observe(stats.db_queries, task=task)
+    task_db_duration.observe(stats.db_time, task=task)
+
+
+def record_cache_gets(hits: int, misses: int):
+    if hits:
+        cache_gets.inc(hits, result="hit")
+    if misses:
+        cache_gets.inc(misses, result="miss")
+    if (stats := _request_stats.get()) is not None:
+        stats.cache_hits += hits
+        stats.cache_misses += misses
+
+
+def record_outbound_request(host: str, status: int, duration: float):
+    outbound_request_duration.observe(duration, host=host, status=status)
+    if (stats := _request_stats.get()) is not None:
+        stats.outbound_requests += 1
+        stats.outbound_time += duration
+
+
+def time_query(execute, sql, params, many, context):
+    """
+    Database execute wrapper adding every query to the current request's stats.
+    """
+    if (stats := _request_stats.get()) is None:
+        return execute(sql, params, many, context)
+    start_time = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.db_queries += 1
+        stats.db_time += time.perf_counter() - start_time
+
+
+def instrument_connection(connection, **kwargs):
+    # connection_created is sent again on every reconnect of the same wrapper
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+connection_created.connect(instrument_connection)
@@ -0,0 +1,147 @@
+import json
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from rest_framework.views import APIView
+
+from kfcrebrand import metrics, routers
+
+
+logger = logging.getLogger("kfcrebrand.requests")
+
+KNOWN_METHODS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+SAFE_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+def view_label(request) -> str:
+    """
+    Metrics label of the view that handled `request`: "<ViewSet>.<action>" for DRF viewsets, the url name or view
+    function otherwise, and "unmatched" when no url matched.
+    """
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unmatched"
+    view_class = getattr(match.func, "cls", None)
+    actions = getattr(match.func, "actions", None)
+    if view_class is not None and actions:
+        return f"{view_class.__name__}.{actions.get(request.method.lower(), request.method.lower())}"
+    if view_class is not None:
+        return view_class.__name__
+    return match.view_name or getattr(match.func, "__name__", "unknown")
+
+
+class RequestMetricsMiddleware:
+    """
+    Records wall time, database queries and time, cache hits and misses and outbound HTTP time of every request into
+    kfcrebrand.metrics, labelled by view. Goes first in MIDDLEWARE so the other middlewares are timed too.
+
+    With METRICS_LOG_REQUESTS, every request is also logged as a JSON line for the log pipeline.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+        # connections opened before this module was imported didn't get connection_created
+        for connection in connections.all(initialized_only=True):
+            metrics.instrument_connection(connection)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats, token = metrics.start_request()
+        start_time = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.end_request(token)
+        self.record(request, response, stats, time.perf_counter() - start_time)
+        return response
+
+    async def __acall__(self, request):
+        stats, token = metrics.start_request()
+        start_time = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.end_request(token)
+        self.record(request, response, stats, time.perf_counter() - start_time)
+        return response
+
+    @staticmethod
+    def record(request, response, stats: metrics.RequestStats, duration: float):
+        view = view_label(request)
+        method = request.method if request.method in KNOWN_METHODS else "other"
+        metrics.record_request(stats, view, method, response.status_code, duration)
+        if settings.METRICS_LOG_REQUESTS:
+            logger.info(json.dumps({"view": view,
+                                    "method": method,
+                                    "path": request.path,
+                                    "status": response.status_code,
+                                    "duration_ms": round(duration * 1000, 2),
+                                    "db_queries": stats.db_queries,
+                                    "db_time_ms": round(stats.db_time * 1000, 2),
+                                    "cache_hits": stats.cache_hits,
+                                    "cache_misses": stats.cache_misses,
+                                    "outbound_requests": stats.outbound_requests,
+                                    "outbound_time_ms": round(stats.outbound_time * 1000, 2)}))
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Lets kfcrebrand.routers.ReplicaRouter send the reads of safe-method DRF views to the read replica, unless the client
+    wrote within the last DATABASE_REPLICA_STICKINESS seconds. Requests that write set a cookie pinning the client to
+    the primary for that long. Goes ahead of SessionMiddleware so session saves count as writes.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state, token = routers.start_request()
+        request.routing_state = state
+        try:
+            response = self.get_response(request)
+        finally:
+            routers.end_request(token)
+        return self.pin(request, response, state)
+
+    async def __acall__(self, request):
+        state, token = routers.start_request()
+        request.routing_state = state
+        try:
+            response = await self.get_response(request)
+        finally:
+            routers.end_request(token)
+        return self.pin(request, response, state)
+
+    @staticmethod
+    def process_view(request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, "cls", None)
+        if (request.method in SAFE_METHODS
+                and view_class is not None and issubclass(view_class, APIView)
+                and settings.DATABASE_REPLICA_PIN_COOKIE not in request.COOKIES):
+            request.routing_state.use_replica = True
+            request.routing_state.atomic_depth = len(connections[DEFAULT_DB_ALIAS].atomic_blocks)
+
+    @staticmethod
+    def pin(request, response, state: routers.RoutingState):
+        if state.wrote or request.method not in SAFE_METHODS:
+            response.set_cookie(settings.DATABASE_REPLICA_PIN_COOKIE, "1",
+                                max_age=settings.DATABASE_REPLICA_STICKINESS,
+                                domain=settings.SESSION_COOKIE_DOMAIN,
+                                secure=settings.SESSION_COOKIE_SECURE,
+                                httponly=True,
+                                samesite=settings.SESSION_COOKIE_SAMESITE)
+        return response
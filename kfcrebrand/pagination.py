@@ -1,5 +1,28 @@
+from django.core.paginator import Paginator
 from rest_framework.pagination import PageNumberPagination
 
 
 class PageNumberWithLimitPagination(PageNumberPagination):
     page_size_query_param = 'limit'
+
+
+class CountedPaginator(Paginator):
+    """
+    Paginator of a queryset whose size is already known, e.g. from a counter column, saving the COUNT(*) query.
+
+    The known count is only reported as the total: pages are sliced by per_page alone, so a counter that drifted
+    from the rows can't hide any of them.
+    """
+
+    def __init__(self, object_list, per_page, count: int, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.known_count = count
+
+    @property
+    def count(self):
+        return self.known_count
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        return self._get_page(self.object_list[bottom:bottom + self.per_page], number, self)
@@ -0,0 +1,90 @@
+"""
+Sends reads of safe-method DRF requests to the read replica, DATABASE_REPLICA_ALIAS, and everything else to the
+primary. ReplicaRoutingMiddleware decides per request: once a request writes, it and the requests of the same client
+for the next DATABASE_REPLICA_STICKINESS seconds read from the primary, so nobody reads around their own writes while
+the replica catches up.
+"""
+import contextvars
+import dataclasses
+import logging
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.utils.connection import ConnectionDoesNotExist
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class RoutingState:
+    use_replica: bool = False
+    wrote: bool = False
+    # atomic blocks on the primary when the view started: reads inside a transaction the view opened go to the primary
+    atomic_depth: int = 0
+
+
+# set by ReplicaRoutingMiddleware for the duration of a request, mutated rather than replaced so that sync_to_async
+# threads and the request's own context see the same state
+_routing_state: contextvars.ContextVar[RoutingState | None] = contextvars.ContextVar("routing_state", default=None)
+
+# replica alias -> time.monotonic() until which it isn't tried again
+_unavailable_until: dict[str, float] = {}
+
+
+def start_request() -> tuple[RoutingState, contextvars.Token]:
+    state = RoutingState()
+    return state, _routing_state.set(state)
+
+
+def end_request(token: contextvars.Token):
+    _routing_state.reset(token)
+
+
+def replica_available(alias: str) -> bool:
+    """
+    :return: whether `alias` is configured and can be connected to. A replica that can't is skipped for
+        DATABASE_REPLICA_RETRY_INTERVAL seconds, its reads going to the primary meanwhile
+    """
+    if time.monotonic() < _unavailable_until.get(alias, 0):
+        return False
+    try:
+        connection = connections[alias]
+    except ConnectionDoesNotExist:
+        return False
+    try:
+        connection.ensure_connection()
+    except DatabaseError as e:
+        logger.warning(f"read replica {alias} unavailable, reading from the primary: {repr(e)}")
+        _unavailable_until[alias] = time.monotonic() + settings.DATABASE_REPLICA_RETRY_INTERVAL
+        return False
+    return True
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _routing_state.get()
+        if state is None or not state.use_replica or state.wrote:
+            return None
+        if len(connections[DEFAULT_DB_ALIAS].atomic_blocks) > state.atomic_depth:
+            return None
+        alias = settings.DATABASE_REPLICA_ALIAS
+        return alias if replica_available(alias) else None
+
+    def db_for_write(self, model, **hints):
+        if (state := _routing_state.get()) is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same rows as the primary
+        aliases = {DEFAULT_DB_ALIAS, settings.DATABASE_REPLICA_ALIAS}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == settings.DATABASE_REPLICA_ALIAS:
+            return False
+        return None
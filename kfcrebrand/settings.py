@@ -13,7 +13,6 @@ import datetime
 import os
 from dotenv import load_dotenv
 from pathlib import Path
-import tldextract
 
 
 # stolen from distutil, as distutil is deprecated in py3.10
@@ -32,6 +31,17 @@ def strtobool(val):
         raise ValueError("invalid truth value %r" % (val,))
 
 
+def registered_domain(domain: str) -> str:
+    """
+    The registrable part of `domain`, e.g. stagec.xyz for vps.5wc.stagec.xyz, resolved from the public suffix list
+    snapshot shipped with tldextract: no download and no cache directory, settings are imported by every process.
+    """
+    # imported here, tldextract and the requests it pulls in are only needed when REGISTERED_DOMAIN isn't set
+    import tldextract
+
+    return tldextract.TLDExtract(suffix_list_urls=(), cache_dir=None)(domain).registered_domain
+
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -48,7 +58,7 @@ DEBUG = strtobool(os.environ.get("DJANGO_DEBUG", "false"))
 
 _allowed_schemes: list = os.environ.get("ALLOWED_SCHEMES", "https").split(",")
 _frontend_domain: str = os.environ.get("FRONTEND_DOMAIN", "vps.5wc.stagec.xyz")
-_parsed_frontend_domain = tldextract.extract(_frontend_domain)
+_registered_domain: str = os.environ.get("REGISTERED_DOMAIN") or registered_domain(_frontend_domain)
 _allowed_hosts: list = os.environ.get("ALLOWED_HOSTS", _frontend_domain).split(",")
 _allowed_ports: list[int] = list(map(int, os.environ.get("ALLOWED_PORTS", "443").split(",")))
 
@@ -72,8 +82,8 @@ CSRF_TRUSTED_ORIGINS = ([f"{scheme}://*.{hostname}:{port}"
                          for scheme in _allowed_schemes
                          for hostname in ALLOWED_HOSTS
                          for port in _allowed_ports])
-CSRF_COOKIE_DOMAIN = f".{_parsed_frontend_domain.registered_domain}"
-SESSION_COOKIE_DOMAIN = f".{_parsed_frontend_domain.registered_domain}"
+CSRF_COOKIE_DOMAIN = f".{_registered_domain}"
+SESSION_COOKIE_DOMAIN = f".{_registered_domain}"
 
 USE_X_FORWARDED_HOST = True
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
@@ -82,7 +92,8 @@ SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 
 INSTALLED_APPS = [
     'corsheaders',
-    'daphne',
+    # daphne only provides the ASGI runserver and imports twisted, so gunicorn and celery processes go without it
+    *(['daphne'] if strtobool(os.environ.get("DJANGO_DEV_SERVER", "false")) else []),
     'discord',
     'userauth',
     'teammgmt',
@@ -102,6 +113,8 @@ AUTHENTICATION_BACKENDS = [
 ]
 
 MIDDLEWARE = [
+    'kfcrebrand.middleware.RequestMetricsMiddleware',
+    'kfcrebrand.middleware.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -148,23 +161,61 @@ DATABASES = {
         'PORT': os.environ.get('DB_PORT'),
         'USER': os.environ.get('DB_USER'),
         'PASSWORD': os.environ.get('DB_PASSWORD'),
-        'OPTIONS': {'ssl': {'ca': os.environ.get('MYSQL_ATTR_SSL_CA')}}
+        # connections are pooled per worker process and reused across requests for this long, see django_psdb_engine
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 300)),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            **({'ssl': {'ca': os.environ['MYSQL_ATTR_SSL_CA']}} if os.environ.get('MYSQL_ATTR_SSL_CA') else {}),
+            'connect_timeout': int(os.environ.get('DB_CONNECT_TIMEOUT', 10)),
+            'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+            # milliseconds, 0 for no limit
+            'statement_timeout': int(os.environ.get('DB_STATEMENT_TIMEOUT', 0)),
+            'statement_timeout_variable': os.environ.get('DB_STATEMENT_TIMEOUT_VARIABLE', 'max_execution_time'),
+        }
     }
 }
 
+# read replica for public GET traffic, see kfcrebrand.routers. On PlanetScale, DB_REPLICA_NAME=<database>@replica
+DATABASE_REPLICA_ALIAS = 'replica'
+if os.environ.get('DB_REPLICA_HOST') or os.environ.get('DB_REPLICA_NAME'):
+    DATABASES[DATABASE_REPLICA_ALIAS] = {
+        **DATABASES['default'],
+        'NAME': os.environ.get('DB_REPLICA_NAME') or DATABASES['default']['NAME'],
+        'HOST': os.environ.get('DB_REPLICA_HOST') or DATABASES['default']['HOST'],
+        'OPTIONS': {**DATABASES['default']['OPTIONS']},
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_ROUTERS = ['kfcrebrand.routers.ReplicaRouter']
+# seconds a client reads from the primary after writing, so it sees its own writes
+DATABASE_REPLICA_STICKINESS = int(os.environ.get('DB_REPLICA_STICKINESS', 10))
+DATABASE_REPLICA_PIN_COOKIE = 'db_primary'
+# seconds before a replica that couldn't be connected to is tried again
+DATABASE_REPLICA_RETRY_INTERVAL = float(os.environ.get('DB_REPLICA_RETRY_INTERVAL', 30))
+
 CACHES = {
     "default": {
-        "BACKEND": "django_redis.cache.RedisCache",
+        # django_redis behind an in-process LRU, counting hits and misses for /metrics
+        "BACKEND": "kfcrebrand.cache.TwoTierRedisCache",
         "LOCATION": [
             # "redis://127.0.0.1:6379/0",
             "redis://redis:6379/0"
         ],
         "OPTIONS": {
             "CLIENT_CLASS": "django_redis.client.DefaultClient",
+            "L1_MAX_ENTRIES": int(os.environ.get("CACHE_L1_MAX_ENTRIES", 1000)),
+            "L1_TTL": float(os.environ.get("CACHE_L1_TTL", 5)),
         }
     }
 }
 
+# "django.contrib.sessions.backends.cache" keeps sessions in redis only (lost on eviction or restart),
+# "django.contrib.sessions.backends.cached_db" reads through redis and still writes to the database
+SESSION_ENGINE = os.environ.get("SESSION_ENGINE", "django.contrib.sessions.backends.db")
+# seconds a logged-in user and their TournamentPlayer stay cached between requests, 0 disables
+AUTH_PRINCIPAL_CACHE_TTL = int(os.environ.get("AUTH_PRINCIPAL_CACHE_TTL", 300))
+# seconds between checks of the disqualified users version key, see userauth.disqualification
+DISQUALIFIED_USERS_CHECK_INTERVAL = float(os.environ.get("DISQUALIFIED_USERS_CHECK_INTERVAL", 1))
+
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -244,19 +295,41 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 50
 }
 
-DISCORD_API_ENDPOINT = 'https://discord.com/api/v10'
+DISCORD_API_ENDPOINT = os.environ.get("DISCORD_API_ENDPOINT", 'https://discord.com/api/v10')
 DISCORD_CLIENT_ID = os.environ.get("DISCORD_CLIENT_ID", None)
 DISCORD_CLIENT_SECRET = os.environ.get("DISCORD_CLIENT_SECRET", None)
 DISCORD_REDIRECT_URI_SUFFIX = "/auth/discord/discord_code"
 DISCORD_PSK = os.environ.get("DISCORD_PSK", "DONOTUSEINPRODUCTIONDONOTUSEINPRODUCTIONDONOTUSEINPRODUCTION")
 CHANNELS_DISCORD_WS_GROUP_NAME = "5wc_discord_signups"
-
-OSU_API_ENDPOINT = "https://osu.ppy.sh/api/v2"
-OSU_OAUTH_ENDPOINT = "https://osu.ppy.sh/oauth"
+# seconds to collect registration events into a single broadcast. 0 sends every event immediately
+CHANNELS_DISCORD_WS_BATCH_WINDOW = float(os.environ.get("CHANNELS_DISCORD_WS_BATCH_WINDOW", 0))
+# approximate number of events kept in redis for clients reconnecting with `?since=<id>`. 0 disables the replay stream
+CHANNELS_DISCORD_WS_STREAM_MAXLEN = int(os.environ.get("CHANNELS_DISCORD_WS_STREAM_MAXLEN", 10000))
+OUTBOX_DRAIN_BATCH_SIZE = 100  # max registration events per websocket broadcast when draining the outbox
+# players read per query by /registrants/export/, which streams the whole list in one response
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", 500))
+# warm each web worker up through the ASGI lifespan startup before it accepts connections, see kfcrebrand.warmup
+WARMUP_ON_STARTUP = strtobool(os.environ.get("WARMUP_ON_STARTUP", "true"))
+
+OSU_API_ENDPOINT = os.environ.get("OSU_API_ENDPOINT", "https://osu.ppy.sh/api/v2")
+OSU_OAUTH_ENDPOINT = os.environ.get("OSU_OAUTH_ENDPOINT", "https://osu.ppy.sh/oauth")
 OSU_CLIENT_ID = os.environ.get("OSU_CLIENT_ID", None)
 OSU_CLIENT_SECRET = os.environ.get("OSU_CLIENT_SECRET", None)
 OSU_REDIRECT_URI_SUFFIX = "/auth/osu/code"
 
+# pooled client used by async views for osu! and discord API calls, see kfcrebrand.http
+OUTBOUND_HTTP_TIMEOUT = float(os.environ.get("OUTBOUND_HTTP_TIMEOUT", 5))  # seconds, per read/write/pool wait
+OUTBOUND_HTTP_CONNECT_TIMEOUT = float(os.environ.get("OUTBOUND_HTTP_CONNECT_TIMEOUT", 2))
+OUTBOUND_HTTP_MAX_CONNECTIONS = int(os.environ.get("OUTBOUND_HTTP_MAX_CONNECTIONS", 100))
+# seconds the full osu!/discord profile is kept in the cache after an OAuth callback, for /auth/session/ to return.
+# The session only holds a subset, which /auth/session/ falls back to afterwards
+OAUTH_PROFILE_CACHE_TTL = int(os.environ.get("OAUTH_PROFILE_CACHE_TTL", 600))
+
+# per-request metrics served on /metrics, see kfcrebrand.metrics
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", 5))  # seconds between flushes to redis
+METRICS_REDIS_KEY_PREFIX = "metrics"
+METRICS_LOG_REQUESTS = strtobool(os.environ.get("METRICS_LOG_REQUESTS", "false"))  # JSON line per request
+
 TEAM_ROSTER_SIZE_MIN = int(os.environ.get("TEAM_ROSTER_SIZE_MIN", 6))  # fatal if not parseable
 TEAM_ROSTER_SIZE_MAX = int(os.environ.get("TEAM_ROSTER_SIZE_MAX", 8))
 TEAM_ROSTER_BACKUP_SIZE_MAX = int(os.environ.get("TEAM_ROSTER_BACKUP_SIZE_MAX", 3))
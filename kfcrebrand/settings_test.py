@@ -9,7 +9,7 @@ DATABASES = {
 }
 CACHES = {
     "default": {
-        "BACKEND": "django_redis.cache.RedisCache",
+        "BACKEND": "kfcrebrand.cache.RedisCache",
         "LOCATION": [
             "redis://127.0.0.1:6379/0",
             # "redis://redis:6379/0"
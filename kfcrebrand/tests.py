@@ -0,0 +1,784 @@
+import asyncio
+import datetime
+import io
+import json
+import os
+import pathlib
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+import httpx
+import redis
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from parameterized import parameterized
+from rest_framework.test import APIClient
+
+from kfcrebrand import cache as cache_backends, http, metrics, routers, warmup
+from kfcrebrand.cache import LocalTier, TwoTierRedisCache
+from kfcrebrand.settings import registered_domain
+from teammgmt.models import TournamentTeam
+from userauth.authentication import DiscordAndOsuAuthBackend, principal_cache_key
+from userauth.models import TournamentPlayer, TournamentPlayerBadge
+
+QUERY_BUDGETS_FILE = pathlib.Path(__file__).parent / "query_budgets.json"
+# UPDATE_QUERY_BUDGETS=1 python manage.py test kfcrebrand rewrites QUERY_BUDGETS_FILE with the measured counts
+UPDATE_QUERY_BUDGETS = os.environ.get("UPDATE_QUERY_BUDGETS", "") not in ("", "0")
+
+# players on the measured team; each needs an organizer plus two disjoint rosters and backups for the roster PATCH
+TEAM_SIZES = (24, 48, 96)
+TEAM_FLAG = "QB"
+
+
+def timed_query(queries: list[tuple[str, float]]):
+    """
+    Execute wrapper appending (sql, seconds) of every query to `queries`. The time captured by
+    CaptureQueriesContext is rounded to the millisecond, which is most queries here.
+    """
+    def wrapper(execute, sql, params, many, context):
+        start_time = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            queries.append((sql, time.perf_counter() - start_time))
+    return wrapper
+
+
+@override_settings(TEAM_ROSTER_SIZE_MAX=8,
+                   TEAM_ROSTER_BACKUP_SIZE_MAX=3,
+                   TEAM_ROSTER_REGISTRATION_START=datetime.datetime.fromtimestamp(0, tz=datetime.timezone.utc),
+                   TEAM_ROSTER_SELECTION_END=datetime.datetime.now(tz=datetime.timezone.utc) +
+                   datetime.timedelta(days=1))
+class QueryBudgetTestCase(TestCase):
+    """
+    Query count of every endpoint and method, measured against teams of each of TEAM_SIZES. A count that changes with
+    the team size is an N+1, otherwise it may not exceed its budget in query_budgets.json. Total query time is
+    recorded alongside for reference but not enforced. Savepoints are not counted.
+    """
+    measured: dict[str, dict] = {}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.budgets = json.loads(QUERY_BUDGETS_FILE.read_text()) if QUERY_BUDGETS_FILE.exists() else {}
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        if UPDATE_QUERY_BUDGETS and cls.measured:
+            # merged, so regenerating from a subset of the tests keeps the other budgets
+            budgets = {**cls.budgets, **cls.measured}
+            QUERY_BUDGETS_FILE.write_text(json.dumps(dict(sorted(budgets.items())), indent=2) + "\n")
+
+    @staticmethod
+    def seed(size: int) -> list[TournamentPlayer]:
+        """
+        Team TEAM_FLAG with `size` players and size // 8 other teams of 8. The first player organizes the team, the
+        next roster-max players are its roster with the first of them captain, and the next backup-max its backups.
+        Every player has size // 8 badges.
+        :return: players of team TEAM_FLAG, in pk order
+        """
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        roster_max = settings.TEAM_ROSTER_SIZE_MAX
+        backup_max = settings.TEAM_ROSTER_BACKUP_SIZE_MAX
+        flags = [TEAM_FLAG] * size + [f"Q{n}" for n in range(size // 8) for _ in range(8)]
+        TournamentTeam.objects.bulk_create([TournamentTeam(osu_flag=flag) for flag in set(flags)])
+        users = User.objects.bulk_create([User(pk=10_000 + i, username=f"budget_{i}") for i in range(len(flags))])
+        players = TournamentPlayer.objects.bulk_create([
+            TournamentPlayer(user=user,
+                             discord_user_id=str(user.pk),
+                             discord_username=user.username,
+                             osu_user_id=user.pk,
+                             osu_username=user.username,
+                             osu_flag=flag,
+                             team_id=flag,
+                             osu_rank_std=user.pk,
+                             osu_rank_std_bws=user.pk,
+                             osu_stats_updated=now,
+                             is_organizer=i == 0,
+                             is_captain=i == 1,
+                             in_roster=1 <= i <= roster_max,
+                             in_backup_roster=roster_max < i <= roster_max + backup_max)
+            for i, (user, flag) in enumerate(zip(users, flags))
+        ])
+        TournamentPlayerBadge.objects.bulk_create([
+            TournamentPlayerBadge(user=player,
+                                  description=f"Budget Cup {2022 + n % 2} Winner",
+                                  award_date=datetime.datetime(2022 + n % 2, 6, 1, tzinfo=datetime.timezone.utc),
+                                  image_url="https://assets.ppy.sh/profile-badges/budget.png",
+                                  image_url_2x="https://assets.ppy.sh/profile-badges/budget@2x.png")
+            for player in players for n in range(size // 8)
+        ])
+        # bulk_create skips the signals counting players into their teams
+        TournamentTeam.refresh_counters(set(flags))
+        return players[:size]
+
+    @staticmethod
+    def organizer_client(team_players: list[TournamentPlayer]) -> APIClient:
+        client = APIClient()
+        # fetched as userauth.authentication.get_user fetches the principal
+        client.force_authenticate(User.objects.select_related('tournamentplayer').get(pk=team_players[0].pk))
+        return client
+
+    @staticmethod
+    def psk_client(team_players: list[TournamentPlayer]) -> APIClient:
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Token {settings.DISCORD_PSK}")
+        return client
+
+    def assert_within_budget(self, endpoint: str, make_client, request):
+        """
+        :param endpoint: budget name, "<method> <path>"
+        :param make_client: seeded team players to APIClient, called before measuring
+        :param request: (client, seeded team players) to response, the request to measure
+        """
+        counts = {}
+        times = {}
+        for size in TEAM_SIZES:
+            with transaction.atomic():
+                team_players = self.seed(size)
+                client = make_client(team_players)
+                queries = []
+                with connection.execute_wrapper(timed_query(queries)):
+                    response = request(client, team_players)
+                self.assertLess(response.status_code, 300, f"{endpoint}: {response.data}")
+                counted = [duration for sql, duration in queries if 'SAVEPOINT' not in sql]
+                counts[size] = len(counted)
+                times[size] = sum(counted) * 1000
+                transaction.set_rollback(True)
+
+        self.assertEqual(1, len(set(counts.values())),
+                         f"{endpoint} query count depends on team size (team size: queries): {counts}")
+        self.measured[endpoint] = {"queries": counts[TEAM_SIZES[-1]], "time_ms": round(times[TEAM_SIZES[-1]], 1)}
+        if UPDATE_QUERY_BUDGETS:
+            return
+
+        self.assertIn(endpoint, self.budgets, f"no query budget for {endpoint}, run the tests with "
+                                              f"UPDATE_QUERY_BUDGETS=1 to record it")
+        self.assertLessEqual(counts[TEAM_SIZES[-1]], self.budgets[endpoint]["queries"],
+                             f"{endpoint} is over its query budget, run the tests with UPDATE_QUERY_BUDGETS=1 "
+                             f"if the new queries are intended")
+
+    def test_registrants_list(self):
+        self.assert_within_budget("GET /registrants/", lambda players: APIClient(),
+                                  lambda client, players: client.get("/registrants/"))
+
+    def test_registrants_list_as_organizer(self):
+        self.assert_within_budget("GET /registrants/ (organizer)", self.organizer_client,
+                                  lambda client, players: client.get("/registrants/"))
+
+    def test_registrant_detail(self):
+        self.assert_within_budget("GET /registrants/<pk>/", lambda players: APIClient(),
+                                  lambda client, players: client.get(f"/registrants/{players[1].pk}/"))
+
+    def test_registrant_detail_by_discord_id(self):
+        self.assert_within_budget(
+            "GET /registrants/<discord id>/?key=discord", lambda players: APIClient(),
+            lambda client, players: client.get(f"/registrants/{players[1].discord_user_id}/?key=discord")
+        )
+
+    def test_registrant_set_organizer(self):
+        self.assert_within_budget(
+            "PATCH /registrants/<pk>/", self.psk_client,
+            lambda client, players: client.patch(f"/registrants/{players[1].pk}/", {"is_organizer": True},
+                                                 format='json')
+        )
+
+    def test_registrant_set_staff(self):
+        self.assert_within_budget(
+            "PATCH /registrants/<pk>/ (is_staff)", self.psk_client,
+            lambda client, players: client.patch(f"/registrants/{players[1].pk}/", {"is_staff": True},
+                                                 format='json')
+        )
+
+    def test_teams_list(self):
+        self.assert_within_budget("GET /teams/", lambda players: APIClient(),
+                                  lambda client, players: client.get("/teams/"))
+
+    def test_team_members(self):
+        self.assert_within_budget("GET /teams/<flag>/members/", self.organizer_client,
+                                  lambda client, players: client.get(f"/teams/{TEAM_FLAG}/members/"))
+
+    def test_team_members_update(self):
+        roster_max = settings.TEAM_ROSTER_SIZE_MAX
+        backup_max = settings.TEAM_ROSTER_BACKUP_SIZE_MAX
+
+        def request(client, players):
+            # replaces the whole seeded roster and backups
+            new_selection = [player.pk for player in players[1 + roster_max + backup_max:]]
+            return client.patch(f"/teams/{TEAM_FLAG}/members/",
+                                {"players": new_selection[:roster_max],
+                                 "backups": new_selection[roster_max:roster_max + backup_max],
+                                 "captain": new_selection[0]},
+                                format='json')
+
+        self.assert_within_budget("PATCH /teams/<flag>/members/", self.organizer_client, request)
+
+
+class RequestMetricsTestCase(TestCase):
+    list_count = 'http_request_duration_seconds_count{view="TournamentPlayerViewSet.list",method="GET",status="200"}'
+
+    @staticmethod
+    def sample(metric: str, sample: str) -> float:
+        return metrics.REGISTRY.collect().get(metric, {}).get(sample, 0)
+
+    def test_request_recorded_by_view(self):
+        queries = 'http_request_db_queries_sum{view="TournamentPlayerViewSet.list"}'
+        count_before = self.sample("http_request_duration_seconds", self.list_count)
+        queries_before = self.sample("http_request_db_queries", queries)
+
+        self.client.get("/registrants/")
+
+        self.assertEqual(count_before + 1, self.sample("http_request_duration_seconds", self.list_count))
+        self.assertLess(queries_before, self.sample("http_request_db_queries", queries))
+
+    async def test_async_request_recorded_by_view(self):
+        count_before = self.sample("http_request_duration_seconds", self.list_count)
+
+        await self.async_client.get("/registrants/")
+
+        self.assertEqual(count_before + 1, self.sample("http_request_duration_seconds", self.list_count))
+
+    def test_unmatched_request(self):
+        unmatched = 'http_request_duration_seconds_count{view="unmatched",method="GET",status="404"}'
+        count_before = self.sample("http_request_duration_seconds", unmatched)
+
+        self.client.get("/not-a-page/")
+
+        self.assertEqual(count_before + 1, self.sample("http_request_duration_seconds", unmatched))
+
+    @override_settings(CACHES={"default": {"BACKEND": "kfcrebrand.cache.LocMemCache"}})
+    def test_cache_hits_and_misses(self):
+        hits_before = self.sample("cache_gets_total", 'cache_gets_total{result="hit"}')
+        misses_before = self.sample("cache_gets_total", 'cache_gets_total{result="miss"}')
+
+        self.assertIsNone(cache.get("metrics_test"))
+        cache.set("metrics_test", 1)
+        self.assertEqual(1, cache.get("metrics_test"))
+        self.assertEqual({"metrics_test": 1}, cache.get_many(["metrics_test", "metrics_test_missing"]))
+
+        self.assertEqual(hits_before + 2, self.sample("cache_gets_total", 'cache_gets_total{result="hit"}'))
+        self.assertEqual(misses_before + 2, self.sample("cache_gets_total", 'cache_gets_total{result="miss"}'))
+
+    async def test_outbound_request_timed(self):
+        sample = 'outbound_http_request_duration_seconds_count{host="osu.ppy.sh",status="200"}'
+        count_before = self.sample("outbound_http_request_duration_seconds", sample)
+
+        async with httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, json={})),
+                                     event_hooks=http.EVENT_HOOKS) as client:
+            await client.get("https://osu.ppy.sh/api/v2/me/osu")
+
+        self.assertEqual(count_before + 1, self.sample("outbound_http_request_duration_seconds", sample))
+
+    def test_metrics_endpoint_requires_psk(self):
+        self.assertIn(self.client.get("/metrics").status_code, (401, 403))
+        self.assertIn(self.client.get("/metrics", HTTP_AUTHORIZATION="Token wrong").status_code, (401, 403))
+
+    def test_metrics_endpoint(self):
+        self.client.get("/registrants/")
+
+        response = self.client.get("/metrics", HTTP_AUTHORIZATION=f"Token {settings.DISCORD_PSK}")
+
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        body = response.content.decode()
+        self.assertIn("# TYPE http_request_duration_seconds histogram", body)
+        self.assertIn(self.list_count, body)
+        self.assertIn('http_request_duration_seconds_bucket{view="TournamentPlayerViewSet.list",method="GET",'
+                      'status="200",le="+Inf"}', body)
+
+    def test_histogram_buckets_are_cumulative(self):
+        registry = metrics.Registry()
+        registry.shared = False
+        histogram = metrics.Histogram("test_seconds", "test", buckets=(0.1, 1), registry=registry)
+
+        histogram.observe(0.5, view="a")
+
+        self.assertEqual({'test_seconds_bucket{view="a",le="0.1"}': 0,
+                          'test_seconds_bucket{view="a",le="1"}': 1,
+                          'test_seconds_bucket{view="a",le="+Inf"}': 1,
+                          'test_seconds_sum{view="a"}': 0.5,
+                          'test_seconds_count{view="a"}': 1}, registry.collect()["test_seconds"])
+
+
+class ReplicaRoutingTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.team = TournamentTeam.objects.create(osu_flag="RR")
+        cls.user = User.objects.create(username="replica_reader", is_staff=True, is_superuser=True)
+        cls.player = TournamentPlayer.objects.create(
+            user=cls.user,
+            discord_user_id="1",
+            osu_user_id=1,
+            osu_flag="RR",
+            team=cls.team,
+            is_organizer=True,
+            osu_stats_updated=datetime.datetime.fromtimestamp(0, tz=datetime.timezone.utc))
+
+    @staticmethod
+    def routed(request) -> tuple[object, set]:
+        """
+        :param request: makes the request
+        :return: (response, databases ReplicaRouter picked for the request's reads). The reads still go to the test
+            database, which has no replica
+        """
+        decisions = set()
+        db_for_read = routers.ReplicaRouter.db_for_read
+
+        def spy(router, model, **hints):
+            decisions.add(db_for_read(router, model, **hints) or "default")
+            return None
+
+        with patch.object(routers.ReplicaRouter, "db_for_read", spy), \
+                patch.object(routers, "replica_available", return_value=True):
+            response = request()
+        return response, decisions
+
+    @parameterized.expand([
+        ("registrants", "/registrants/"),
+        ("session", "/auth/session/"),
+        ("teams", "/teams/"),
+        ("team members", "/teams/RR/members/"),
+    ])
+    def test_safe_drf_reads_go_to_replica(self, _, path):
+        self.client.force_login(self.user)
+
+        response, decisions = self.routed(lambda: self.client.get(path))
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({"replica"}, decisions)
+        self.assertNotIn(settings.DATABASE_REPLICA_PIN_COOKIE, response.cookies)
+
+    def test_unsafe_method_reads_primary_and_pins(self):
+        self.client.force_login(self.user)
+
+        response, decisions = self.routed(lambda: self.client.post("/auth/session/logout/"))
+
+        self.assertEqual({"default"}, decisions)
+        self.assertIn(settings.DATABASE_REPLICA_PIN_COOKIE, response.cookies)
+
+    def test_get_that_writes_pins(self):
+        self.client.force_login(self.user)
+
+        # logging out deletes the session
+        response, _ = self.routed(lambda: self.client.get("/auth/session/logout/"))
+
+        pin = response.cookies[settings.DATABASE_REPLICA_PIN_COOKIE]
+        self.assertEqual(settings.DATABASE_REPLICA_STICKINESS, pin["max-age"])
+
+    def test_pinned_client_reads_primary(self):
+        self.client.cookies[settings.DATABASE_REPLICA_PIN_COOKIE] = "1"
+
+        _, decisions = self.routed(lambda: self.client.get("/registrants/"))
+
+        self.assertEqual({"default"}, decisions)
+
+    def test_non_drf_view_reads_primary(self):
+        self.client.force_login(self.user)
+
+        response, decisions = self.routed(lambda: self.client.get("/admin/"))
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({"default"}, decisions)
+
+    def test_reads_after_write_or_in_transaction_go_to_primary(self):
+        router = routers.ReplicaRouter()
+        state, token = routers.start_request()
+        state.use_replica = True
+        state.atomic_depth = len(connection.atomic_blocks)
+        try:
+            with patch.object(routers, "replica_available", return_value=True):
+                self.assertEqual("replica", router.db_for_read(TournamentPlayer))
+                with transaction.atomic():
+                    self.assertIsNone(router.db_for_read(TournamentPlayer))
+                self.assertEqual("default", router.db_for_write(TournamentPlayer))
+                self.assertIsNone(router.db_for_read(TournamentPlayer))
+        finally:
+            routers.end_request(token)
+        self.assertIsNone(router.db_for_read(TournamentPlayer))
+
+    @override_settings(DATABASE_REPLICA_RETRY_INTERVAL=30)
+    def test_unavailable_replica_falls_back_to_primary(self):
+        replica = MagicMock()
+        replica.ensure_connection.side_effect = OperationalError("replica down")
+
+        with patch.dict(routers._unavailable_until, clear=True), \
+                patch.object(routers, "connections", {"replica": replica}):
+            self.assertFalse(routers.replica_available("replica"))
+            # not tried again until the retry interval passed
+            self.assertFalse(routers.replica_available("replica"))
+            self.assertEqual(1, replica.ensure_connection.call_count)
+
+            replica.ensure_connection.side_effect = None
+            with patch("kfcrebrand.routers.time.monotonic", return_value=time.monotonic() + 31):
+                self.assertTrue(routers.replica_available("replica"))
+
+    def test_principal_cache_filled_from_primary(self):
+        cache.delete(principal_cache_key(self.user.pk))
+        state, token = routers.start_request()
+        state.use_replica = True
+        try:
+            # the test database has no replica, reading from it would fail
+            with patch.object(routers.ReplicaRouter, "db_for_read", return_value="replica") as db_for_read:
+                user = DiscordAndOsuAuthBackend().get_user(self.user.pk)
+        finally:
+            routers.end_request(token)
+
+        self.assertTrue(user.tournamentplayer.is_organizer)
+        db_for_read.assert_not_called()
+
+    def test_unconfigured_replica_unavailable(self):
+        self.assertFalse(routers.replica_available("replica"))
+
+
+class RegisteredDomainTestCase(SimpleTestCase):
+    @parameterized.expand([
+        ("vps.5wc.stagec.xyz", "stagec.xyz"),
+        ("5wc.example.co.uk", "example.co.uk"),
+        ("localhost", ""),
+    ])
+    def test_registered_domain(self, domain, expected):
+        self.assertEqual(expected, registered_domain(domain))
+
+    def test_offline(self):
+        with patch("socket.socket.connect", side_effect=AssertionError("network access")), \
+                patch("tldextract.cache.DiskCache.get", side_effect=AssertionError("cache access")):
+            self.assertEqual("stagec.xyz", registered_domain("vps.5wc.stagec.xyz"))
+
+
+class WarmupTestCase(TestCase):
+    def setUp(self):
+        call_command("seed_registrations", 5, synthetic=True, bulk=True, stdout=io.StringIO())
+
+    def test_warm_up(self):
+        with self.assertNoLogs("kfcrebrand.warmup", level="WARNING"):
+            durations, failed = warmup.warm_up()
+
+        self.assertEqual(list(warmup.STEPS), list(durations))
+        self.assertEqual(set(), failed)
+        self.assertTrue(TournamentTeam.objects.filter(pk="WYSI").exists())
+
+    def test_failed_step_skipped(self):
+        later_step = MagicMock()
+        with self.assertLogs("kfcrebrand.warmup", level="ERROR"):
+            durations, failed = warmup.warm_up({"broken": MagicMock(side_effect=OperationalError), "later": later_step})
+
+        self.assertEqual({"broken"}, failed)
+        later_step.assert_called_once()
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command("warmup", skip=["osu token"], stdout=out)
+
+        for step in warmup.STEPS:
+            self.assertIn(step, out.getvalue())
+        self.assertIn("warmed up in", out.getvalue())
+
+    @override_settings(OSU_CLIENT_ID="1")
+    @patch("discord.tasks.get_osu_token", return_value=None)
+    def test_command_osu_token_failure(self, get_osu_token):
+        with self.assertRaises(CommandError):
+            call_command("warmup", stdout=io.StringIO())
+        get_osu_token.assert_called_once()
+
+
+class LifespanTestCase(TestCase):
+    async def run_lifespan(self):
+        from kfcrebrand.asgi import application
+
+        messages = asyncio.Queue()
+        for message_type in ("lifespan.startup", "lifespan.shutdown"):
+            messages.put_nowait({"type": message_type})
+        sent = []
+
+        async def send(message):
+            sent.append(message["type"])
+
+        await application({"type": "lifespan"}, messages.get, send)
+        return sent
+
+    @patch("discord.events.outbox_drainer.wake")
+    @patch("kfcrebrand.warmup.warm_up_worker")
+    async def test_startup_warms_up(self, warm_up_worker, wake_drainer):
+        self.assertEqual(["lifespan.startup.complete", "lifespan.shutdown.complete"], await self.run_lifespan())
+        warm_up_worker.assert_called_once()
+        wake_drainer.assert_called_once()
+
+    @override_settings(WARMUP_ON_STARTUP=False)
+    @patch("discord.events.outbox_drainer.wake")
+    @patch("kfcrebrand.warmup.warm_up_worker")
+    async def test_warm_up_disabled(self, warm_up_worker, wake_drainer):
+        self.assertEqual(["lifespan.startup.complete", "lifespan.shutdown.complete"], await self.run_lifespan())
+        warm_up_worker.assert_not_called()
+        # the outbox is swept whether or not the worker warms up
+        wake_drainer.assert_called_once()
+
+
+class FakeRedisClient:
+    """
+    The parts of django_redis's DefaultClient TwoTierRedisCache uses, over a dict. Also stands in for the redis client
+    invalidations are published with.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.reads = 0
+        self.published = []
+
+    @staticmethod
+    def make_key(key, version=None, prefix=None):
+        return f":{version or 1}:{key}"
+
+    def get(self, key, default=None, version=None, client=None):
+        self.reads += 1
+        return self.data.get(self.make_key(key, version), default)
+
+    def get_many(self, keys, version=None, client=None):
+        self.reads += 1
+        return {key: self.data[self.make_key(key, version)] for key in keys if self.make_key(key, version) in self.data}
+
+    def set(self, key, value, timeout=None, version=None, client=None, nx=False, xx=False):
+        self.data[self.make_key(key, version)] = value
+        return True
+
+    def incr(self, key, delta=1, version=None, client=None, ignore_key_check=False):
+        self.data[self.make_key(key, version)] += delta
+        return self.data[self.make_key(key, version)]
+
+    def delete_many(self, keys, version=None, client=None):
+        return sum(self.data.pop(self.make_key(key, version), None) is not None for key in keys)
+
+    def get_client(self, write=True):
+        return self
+
+    def publish(self, channel, message):
+        self.published.append((channel, json.loads(message)))
+
+
+class TwoTierCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.channel = f"test_invalidation_{self.id()}"
+        self.backend = TwoTierRedisCache("redis://127.0.0.1:6379/0", {"OPTIONS": {"L1_CHANNEL": self.channel,
+                                                                                  "L1_MAX_ENTRIES": 2}})
+        self.redis = self.backend._client = FakeRedisClient()
+        self.local = self.backend.local
+        # as if the subscriber thread were listening
+        self.local._subscriber = MagicMock()
+        self.local.subscribed = True
+        self.addCleanup(self.local.clear)
+
+    @staticmethod
+    def sample(result: str, key: str) -> float:
+        return metrics.REGISTRY.collect().get("cache_key_gets_total", {}).get(
+            f'cache_key_gets_total{{key="{key}",result="{result}"}}', 0)
+
+    def test_key_family(self):
+        self.assertEqual("auth_principal_*", cache_backends.key_family("auth_principal_42"))
+        self.assertEqual("osu_queue_length", cache_backends.key_family("osu_queue_length"))
+        self.assertEqual("django.contrib.sessions.cached_*",
+                         cache_backends.key_family("django.contrib.sessions.cached_db" + "x" * 32))
+
+    def test_reads_served_locally(self):
+        local_hits_before = self.sample("local_hit", "auth_principal_*")
+        hits_before = self.sample("hit", "auth_principal_*")
+        self.redis.set("auth_principal_1", {"pk": 1})
+
+        self.assertEqual({"pk": 1}, self.backend.get("auth_principal_1"))
+        self.assertEqual({"pk": 1}, self.backend.get("auth_principal_1"))
+        self.assertEqual({"auth_principal_1": {"pk": 1}}, self.backend.get_many(["auth_principal_1"]))
+
+        self.assertEqual(1, self.redis.reads)
+        self.assertEqual(hits_before + 1, self.sample("hit", "auth_principal_*"))
+        self.assertEqual(local_hits_before + 2, self.sample("local_hit", "auth_principal_*"))
+
+    def test_misses_not_cached(self):
+        self.assertIsNone(self.backend.get("missing"))
+        self.assertEqual("default", self.backend.get("missing", "default"))
+
+        self.assertEqual(2, self.redis.reads)
+
+    def test_get_many_reads_remaining_keys(self):
+        self.redis.set("a", 1)
+        self.redis.set("b", 2)
+        self.backend.get("a")
+
+        self.assertEqual({"a": 1, "b": 2}, self.backend.get_many(["a", "b", "c"]))
+        self.assertEqual({"a": 1, "b": 2}, self.backend.get_many(["a", "b"]))
+        self.assertEqual(2, self.redis.reads)
+
+    def test_writes_invalidate(self):
+        self.backend.set("osu_queue_length", 1)
+        self.assertEqual(1, self.backend.get("osu_queue_length"))
+
+        self.assertEqual(2, self.backend.incr("osu_queue_length"))
+        self.assertEqual(2, self.backend.get("osu_queue_length"))
+        self.backend.delete_many(["osu_queue_length"])
+        self.assertIsNone(self.backend.get("osu_queue_length"))
+
+        self.assertEqual([(self.channel, [":1:osu_queue_length"])] * 3, self.redis.published)
+
+    def test_invalidation_from_another_process(self):
+        self.redis.set("osu_queue_length", 1)
+        self.backend.get("osu_queue_length")
+        self.redis.set("osu_queue_length", 2)
+        self.assertEqual(1, self.backend.get("osu_queue_length"))
+
+        self.local.handle_message(json.dumps([":1:osu_queue_length"]))
+
+        self.assertEqual(2, self.backend.get("osu_queue_length"))
+
+    def test_read_racing_invalidation_not_stored(self):
+        self.redis.set("osu_queue_length", 1)
+        original_get = self.redis.get
+
+        def get_then_invalidated(*args, **kwargs):
+            value = original_get(*args, **kwargs)
+            self.local.handle_message(json.dumps([":1:osu_queue_length"]))
+            return value
+
+        with patch.object(self.redis, "get", get_then_invalidated):
+            self.assertEqual(1, self.backend.get("osu_queue_length"))
+        self.assertEqual(0, len(self.local))
+
+    def test_bounded_lru(self):
+        for key in ("a", "b", "c"):
+            self.redis.set(key, key)
+        self.backend.get("a")
+        self.backend.get("b")
+        self.backend.get("a")
+        self.backend.get("c")
+
+        self.assertIsNotNone(self.local.get(":1:a"))
+        self.assertIsNone(self.local.get(":1:b"))
+        self.assertEqual(2, len(self.local))
+
+    def test_entries_expire(self):
+        self.redis.set("a", 1)
+        self.backend.get("a")
+
+        with patch("kfcrebrand.cache.time.monotonic", return_value=time.monotonic() + self.local.ttl):
+            self.assertIsNone(self.local.get(":1:a"))
+
+    def test_unsubscribed_reads_redis(self):
+        self.local.subscribed = False
+        self.redis.set("a", 1)
+
+        self.backend.get("a")
+        self.backend.get("a")
+
+        self.assertEqual(2, self.redis.reads)
+        self.assertEqual(0, len(self.local))
+
+    def test_listen(self):
+        self.local.subscribed = False
+        self.local.evict([])
+        pubsub = MagicMock()
+        entries_seen = []
+
+        def listen():
+            yield {"type": "subscribe", "data": 1}
+            self.local.set(":1:a", b"stale", self.local.generation)
+            self.local.set(":1:b", b"fresh", self.local.generation)
+            yield {"type": "message", "data": json.dumps([":1:a"]).encode()}
+            entries_seen.append((self.local.get(":1:a"), self.local.get(":1:b")))
+            raise ConnectionError("redis went away")
+
+        pubsub.listen.side_effect = listen
+        with self.assertRaises(ConnectionError):
+            self.local.listen(pubsub)
+
+        pubsub.subscribe.assert_called_once_with(self.channel)
+        self.assertEqual([(None, b"fresh")], entries_seen)
+        self.assertFalse(self.local.subscribed)
+        self.assertEqual(0, len(self.local))
+
+    def test_disabled(self):
+        backend = TwoTierRedisCache("redis://127.0.0.1:6379/0", {"OPTIONS": {"L1_TTL": 0}})
+        backend._client = FakeRedisClient()
+
+        backend.set("a", 1)
+        backend.get("a")
+        backend.get("a")
+
+        self.assertIsNone(backend.local)
+        self.assertEqual(2, backend._client.reads)
+        self.assertEqual([], backend._client.published)
+
+
+TEST_REDIS_URL = "redis://127.0.0.1:6379/0"
+
+
+def redis_reachable(url: str) -> bool:
+    try:
+        redis.Redis.from_url(url, socket_connect_timeout=1).ping()
+    except redis.exceptions.RedisError:
+        return False
+    return True
+
+
+@unittest.skipUnless(redis_reachable(TEST_REDIS_URL), f"no redis at {TEST_REDIS_URL}")
+@override_settings(CACHES={"default": {"BACKEND": "kfcrebrand.cache.TwoTierRedisCache",
+                                       "LOCATION": TEST_REDIS_URL,
+                                       # longer than the tests, so only invalidations evict
+                                       "OPTIONS": {"CLIENT_CLASS": "django_redis.client.DefaultClient",
+                                                   "L1_TTL": 60},
+                                       "KEY_PREFIX": "testing_two_tier"}})
+class TwoTierCacheRedisTestCase(TestCase):
+    """
+    Requests served through the cache backend production uses, against redis.
+    """
+
+    def setUp(self):
+        self.addCleanup(cache.delete_pattern, "*")
+        deadline = time.monotonic() + 5
+        while cache.local_tier() is None:
+            self.assertLess(time.monotonic(), deadline, "not subscribed to cache invalidations")
+            time.sleep(0.01)
+
+    def held_locally(self, key) -> bool:
+        return cache.local.get(cache.made_key(key)) is not None
+
+    def test_principal_not_stale_after_write(self):
+        team = TournamentTeam.objects.create(osu_flag="TT")
+        user = User.objects.create(username="two_tier")
+        TournamentPlayer.objects.create(user=user, discord_user_id="42", osu_user_id=42, osu_flag="TT", team=team,
+                                        osu_stats_updated=datetime.datetime.fromtimestamp(0, tz=datetime.timezone.utc))
+        client = APIClient()
+        client.force_login(user, backend="userauth.authentication.DiscordAndOsuAuthBackend")
+
+        # the first request caches the principal in redis, the second one in the local tier
+        for _ in range(2):
+            self.assertEqual(403, client.get("/teams/TT/members/").status_code)
+        self.assertTrue(self.held_locally(principal_cache_key(user.pk)))
+
+        response = APIClient().patch("/registrants/42/?key=discord", {"is_organizer": True}, format="json",
+                                     HTTP_AUTHORIZATION=f"Token {settings.DISCORD_PSK}")
+        self.assertEqual(200, response.status_code)
+
+        self.assertEqual(200, client.get("/teams/TT/members/").status_code)
+
+    def test_queue_length_not_stale_after_worker_incr(self):
+        client = APIClient(HTTP_AUTHORIZATION=f"Token {settings.DISCORD_PSK}")
+        cache.set("osu_queue_length", 0)
+        with patch("discord.tasks.update_users.delay"):
+            for _ in range(2):
+                self.assertEqual(200, client.post("/registrants/update_all_users/").status_code)
+        self.assertTrue(self.held_locally("osu_queue_length"))
+
+        # a celery worker: another process, with a local tier of its own
+        worker_cache = TwoTierRedisCache(TEST_REDIS_URL, {"KEY_PREFIX": "testing_two_tier"})
+        worker_cache.local = LocalTier(cache.local.channel, 1000, 60)
+        worker_cache.incr("osu_queue_length")
+        deadline = time.monotonic() + 5
+        while self.held_locally("osu_queue_length"):
+            self.assertLess(time.monotonic(), deadline, "invalidation never reached the local tier")
+            time.sleep(0.01)
+
+        response = client.post("/registrants/update_all_users/")
+        self.assertEqual(429, response.status_code)
+        self.assertIn("1 tasks remaining", response.data["message"])
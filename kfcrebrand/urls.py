@@ -17,9 +17,12 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from kfcrebrand.views import prometheus_metrics
+
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', prometheus_metrics),
     path('auth/', include('userauth.urls')),
     path('registrants/', include('discord.urls')),
     path('teams/', include('teammgmt.urls')),
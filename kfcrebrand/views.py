@@ -0,0 +1,11 @@
+from django.http import HttpResponse
+from rest_framework.decorators import api_view, permission_classes
+
+from discord.permissions import PreSharedKeyAuthentication
+from kfcrebrand import metrics
+
+
+@api_view(['GET'])
+@permission_classes([PreSharedKeyAuthentication])
+def prometheus_metrics(request):
+    return HttpResponse(metrics.REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
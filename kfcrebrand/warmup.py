@@ -0,0 +1,163 @@
+"""
+Warms a freshly started process up before it serves anything, so a rollout doesn't make the first requests each worker
+handles pay for what is otherwise set up lazily: the URL resolvers, database and redis connections, the default team,
+the disqualified user set, and the views and serializers of the most requested endpoints.
+
+Gunicorn's uvicorn workers run it from the ASGI lifespan startup (see Lifespan), before they accept connections;
+`manage.py warmup` runs it on its own, e.g. to warm the shared database and redis after they restart.
+"""
+import io
+import logging
+import time
+from importlib import import_module
+from typing import Callable
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import DatabaseError, close_old_connections, connections
+from django.urls import get_resolver, resolve, reverse
+
+from discord import events
+from kfcrebrand import http, metrics
+from teammgmt.models import TournamentTeam
+from userauth import disqualification
+from userauth.models import TournamentPlayer
+
+
+logger = logging.getLogger(__name__)
+
+# the most requested read endpoints, along with a registrant and a team member list found by warm_requests
+WARMUP_PATHS = ("/registrants/", "/teams/", "/auth/session/")
+
+
+def warm_urls():
+    # reversing populates every namespace of the resolver, as HyperlinkedIdentityField does on its first use
+    get_resolver()
+    reverse("tournamentplayer-list")
+    reverse("tournamentteam-list")
+
+
+def warm_databases():
+    for alias in settings.DATABASES:
+        try:
+            connections[alias].ensure_connection()
+        except DatabaseError as e:
+            logger.warning(f"warm-up couldn't connect to database {alias}: {repr(e)}")
+
+
+def warm_default_team():
+    TournamentTeam.get_default_pk()
+
+
+def warm_disqualified_users():
+    disqualification.disqualified_ids()
+
+
+def warmup_request(path: str, authorization: str | None = None) -> WSGIRequest:
+    """
+    An anonymous GET of `path` with an empty session, as the request factory of django.test builds it without
+    importing the test framework.
+    :param authorization: Authorization header, if any
+    """
+    environ = {"REQUEST_METHOD": "GET",
+               "PATH_INFO": path,
+               "QUERY_STRING": "",
+               "SERVER_NAME": "localhost",
+               "SERVER_PORT": "443",
+               "HTTP_HOST": "localhost",
+               "wsgi.url_scheme": "https",
+               "wsgi.input": io.BytesIO()}
+    if authorization is not None:
+        environ["HTTP_AUTHORIZATION"] = authorization
+    request = WSGIRequest(environ)
+    request.session = import_module(settings.SESSION_ENGINE).SessionStore()
+    request.user = AnonymousUser()
+    return request
+
+
+def warm_requests():
+    """
+    Serve the WARMUP_PATHS in-process, skipping middleware, so their views, serializers, renderers and queries have
+    all run once.
+    """
+    # path -> Authorization header
+    paths = dict.fromkeys(WARMUP_PATHS)
+    if (player_pk := TournamentPlayer.objects.values_list('pk', flat=True).first()) is not None:
+        paths[f"/registrants/{player_pk}/"] = None
+    if (team_pk := TournamentTeam.objects.filter(candidate_count__gt=0).values_list('pk', flat=True).first()):
+        # only the team's organizers and the Discord bot can read it
+        paths[f"/teams/{team_pk}/members/"] = f"Token {settings.DISCORD_PSK}"
+
+    for path, authorization in paths.items():
+        match = resolve(path)
+        response = match.func(warmup_request(path, authorization), *match.args, **match.kwargs)
+        if hasattr(response, "render"):
+            response.render()
+        if response.status_code >= 400:
+            logger.warning(f"warm-up request to {path} returned {response.status_code}")
+
+
+# name -> step, in the order they run
+STEPS: dict[str, Callable[[], None]] = {
+    "urls": warm_urls,
+    "databases": warm_databases,
+    "default team": warm_default_team,
+    "disqualified users": warm_disqualified_users,
+    "requests": warm_requests,
+}
+
+
+def warm_up(steps: dict[str, Callable[[], None]] = None) -> tuple[dict[str, float], set[str]]:
+    """
+    Run the warm-up steps, logging and skipping any that fail: a worker that can't warm up still has to start.
+    :param steps: defaults to STEPS
+    :return: seconds taken by each step, names of the steps that failed
+    """
+    durations = {}
+    failed = set()
+    for name, step in (STEPS if steps is None else steps).items():
+        start_time = time.perf_counter()
+        try:
+            step()
+        except Exception:
+            logger.exception(f"warm-up step {name} failed")
+            failed.add(name)
+        durations[name] = time.perf_counter() - start_time
+        metrics.warmup_duration.observe(durations[name], step=name)
+    logger.info(f"warmed up in {sum(durations.values()):.3f}s: "
+                + ", ".join(f"{name} {duration:.3f}s" for name, duration in durations.items()))
+    return durations, failed
+
+
+def warm_up_worker():
+    warm_up()
+    # hand the connections opened on this thread back, to the pool of django_psdb_engine if it's in use
+    close_old_connections()
+
+
+class Lifespan:
+    """
+    ASGI lifespan protocol: uvicorn waits for the startup to complete before the worker accepts connections. Also
+    starts the worker's outbox drainer, and opens the pooled outbound HTTP client of the worker's event loop, whose TLS
+    setup the first OAuth login would otherwise pay for, and closes it on shutdown.
+    """
+
+    async def __call__(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                # sweeps events left in the outbox by commands and by workers that crashed or were redeployed, which
+                # would otherwise wait for this process to enqueue one of its own
+                events.outbox_drainer.wake()
+                if settings.WARMUP_ON_STARTUP:
+                    start_time = time.perf_counter()
+                    http.get_async_client()
+                    metrics.warmup_duration.observe(time.perf_counter() - start_time, step="http client")
+                    await sync_to_async(warm_up_worker)()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await http.close_async_client()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
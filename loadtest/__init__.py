@@ -0,0 +1,7 @@
+"""
+Load tests against local stub servers standing in for the osu! and discord APIs.
+
+Run from the repository root, e.g.
+    python -m loadtest.oauth_callbacks --latency 0,0.1,0.5 --concurrency 50
+    python -m loadtest.run --settings kfcrebrand.settings --users 500 --concurrency 50
+"""
@@ -0,0 +1,73 @@
+"""
+Concurrent osu!/discord OAuth callbacks against stub upstream APIs with increasing latency.
+
+Each request walks the full callback: token exchange, profile fetch and session save. The callbacks are served
+in-process by the project's ASGI application, so the numbers reflect one worker process. With async callbacks the wall
+time of a wave of concurrent logins should track the upstream latency, not latency times the number of logins.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+import httpx
+
+from loadtest.stats import summarize
+from loadtest.stubs import StubServer, StubUpstream
+
+
+async def run_wave(application, path: str, codes: range, concurrency: int) -> tuple[float, list[float], int]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def callback(client: httpx.AsyncClient, code: int):
+        nonlocal errors
+        async with semaphore:
+            start_time = time.perf_counter()
+            r = await client.get(path, params={"code": code})
+            if r.status_code == 200:
+                latencies.append(time.perf_counter() - start_time)
+            else:
+                errors += 1
+
+    transport = httpx.ASGITransport(app=application)
+    async with httpx.AsyncClient(transport=transport, base_url="http://localhost") as client:
+        start_time = time.perf_counter()
+        await asyncio.gather(*(callback(client, code) for code in codes))
+        return time.perf_counter() - start_time, latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--latency", default="0,0.1,0.25,0.5",
+                        help="comma separated upstream latencies to test, in seconds (per upstream call)")
+    parser.add_argument("--concurrency", default=50, type=int, help="callbacks in flight at once")
+    parser.add_argument("--requests", default=200, type=int, help="callbacks per latency and provider")
+    parser.add_argument("--settings", default=os.environ.get("DJANGO_SETTINGS_MODULE", "kfcrebrand.settings"))
+    args = parser.parse_args()
+
+    upstream = StubUpstream()
+    with StubServer(upstream) as stub:
+        # endpoints are read from the environment when settings are imported
+        os.environ.update(stub.environ())
+        os.environ["DJANGO_SETTINGS_MODULE"] = args.settings
+        from kfcrebrand.asgi import application
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+
+        offset = 0
+        for latency in (float(latency) for latency in args.latency.split(",")):
+            upstream.latency = latency
+            for provider, path in (("osu", "/auth/osu/code/"), ("discord", "/auth/discord/discord_code/")):
+                codes = range(offset, offset + args.requests)
+                offset += args.requests
+                elapsed, latencies, errors = asyncio.run(run_wave(application, path, codes, args.concurrency))
+                # two sequential upstream calls per callback, `concurrency` callbacks at a time
+                ideal = 2 * latency * -(-args.requests // args.concurrency)
+                print(summarize(f"{provider} @ {latency * 1000:.0f}ms upstream", latencies, elapsed, errors)
+                      + f", ideal wall time {ideal:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+End-to-end load test: registration storm, anonymous registrant reads, organizer roster PATCHes and websocket fan-out.
+
+osu! and discord are replaced by a local stub server. Everything else is real: the configured database, cache and
+channel layer, and the project's ASGI application, driven in-process as one worker. Registered players come from
+synthetic profiles and are deleted afterwards unless --keep is given. Do not run against production.
+
+Production runs MySQL, whose numbers are the meaningful ones: point --settings at a settings module whose DATABASES
+is the MySQL server to test against. SQLite serializes writes, so PATCH and storm latencies it reports are upper
+bounds.
+"""
+import argparse
+import asyncio
+import datetime
+import logging
+import os
+import time
+
+import httpx
+
+from loadtest import scenarios
+from loadtest.stubs import StubServer, StubUpstream
+
+SCENARIOS = ("storm", "reads", "patches", "ws")
+
+
+def configure_environment(stub: StubServer):
+    # settings read these once, at import
+    now = int(time.time())
+    os.environ.update(stub.environ())
+    os.environ.update({"FRONTEND_DOMAIN": httpx.URL(scenarios.BASE_URL).host,
+                       "REGISTRATION_START": str(now - 86400),
+                       "REGISTRATION_END": str(now + 86400),
+                       "ROSTER_SELECTION_END": str(now + 86400)})
+
+
+def wait_for_outbox(timeout: float = 60):
+    from discord.models import OutboxEvent
+    deadline = time.monotonic() + timeout
+    while OutboxEvent.objects.exists() and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+
+def enqueue_registration(payload: dict):
+    """
+    Send an event the way registrations do: an outbox row written in the registration's transaction, broadcast by the
+    drainer thread its commit wakes.
+    """
+    from django.db import transaction
+    from discord import events
+
+    with transaction.atomic():
+        events.enqueue("registration.new", payload)
+
+
+def setup_organizers(profile_indices: range) -> dict[str, tuple[int, list[int]]]:
+    """
+    Makes the first registered player of every team with at least two players its organizer.
+    :return: team flag to (organizer profile index, team player pks)
+    """
+    from userauth.authentication import invalidate_principals
+    from userauth.management.commands._synthetic import SYNTHETIC_OSU_ID_OFFSET
+    from userauth.models import TournamentPlayer
+
+    teams: dict[str, list[tuple[int, int]]] = {}
+    players = (TournamentPlayer.objects
+               .filter(osu_user_id__in=[SYNTHETIC_OSU_ID_OFFSET + index for index in profile_indices])
+               .order_by('pk').values_list('team_id', 'pk', 'osu_user_id'))
+    for team_id, pk, osu_user_id in players:
+        teams.setdefault(team_id, []).append((pk, osu_user_id - SYNTHETIC_OSU_ID_OFFSET))
+    teams = {flag: members for flag, members in teams.items() if len(members) > 1}
+
+    organizer_pks = [members[0][0] for members in teams.values()]
+    TournamentPlayer.objects.filter(pk__in=organizer_pks).update(is_organizer=True)
+    invalidate_principals(*organizer_pks)
+    return {flag: (members[0][1], [pk for pk, _ in members]) for flag, members in teams.items()}
+
+
+def cleanup(profile_indices: range):
+    from userauth.management.commands._synthetic import SYNTHETIC_OSU_ID_OFFSET
+    from userauth.management.commands.drop_all_registrations import Command as DropCommand
+    from userauth.models import TournamentPlayer
+
+    pks = list(TournamentPlayer.objects
+               .filter(osu_user_id__in=[SYNTHETIC_OSU_ID_OFFSET + index for index in profile_indices])
+               .values_list('pk', flat=True))
+    for i in range(0, len(pks), 1000):
+        DropCommand.delete_chunk(pks[i:i + 1000])
+    DropCommand.delete_orphaned_sessions(1000)
+
+
+async def run(args, application, profile_indices: range):
+    from django.conf import settings
+    from userauth.models import TournamentPlayer
+
+    results = []
+    clients = {index: scenarios.make_client(application) for index in profile_indices}
+    try:
+        if {"storm", "patches"} & set(args.scenarios):
+            results.append(await scenarios.registration_storm(clients, args.concurrency))
+
+        if "reads" in args.scenarios:
+            player_pks = await asyncio.to_thread(lambda: list(TournamentPlayer.objects.values_list('pk', flat=True)))
+            if player_pks:
+                results.append(await scenarios.registrant_reads(application, player_pks, args.reads, args.concurrency))
+
+        if "patches" in args.scenarios:
+            # the storm's registrations are still being broadcast by the outbox drainer thread, whose writes would
+            # compete with the PATCHes': on SQLite, they fail with "database is locked"
+            await asyncio.to_thread(wait_for_outbox)
+            teams = await asyncio.to_thread(setup_organizers, profile_indices)
+            if teams:
+                organizers = {flag: (clients[index], player_pks) for flag, (index, player_pks) in teams.items()}
+                results.append(await scenarios.organizer_patches(organizers, args.patches, args.concurrency,
+                                                                 settings.TEAM_ROSTER_SIZE_MAX,
+                                                                 settings.TEAM_ROSTER_BACKUP_SIZE_MAX))
+
+        if "ws" in args.scenarios:
+            # registrations from the storm are still being broadcast from the outbox drainer thread
+            await asyncio.to_thread(wait_for_outbox)
+            results.append(await scenarios.websocket_fanout(application, enqueue_registration,
+                                                            args.ws_clients, args.ws_events))
+    finally:
+        for client in clients.values():
+            await client.aclose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help=f"any of {', '.join(SCENARIOS)}, all by default. patches registers players with a storm "
+                             f"first")
+    parser.add_argument("--settings", default=os.environ.get("DJANGO_SETTINGS_MODULE", "kfcrebrand.settings"))
+    parser.add_argument("--users", default=200, type=int, help="players registered by the storm")
+    parser.add_argument("--concurrency", default=20, type=int, help="HTTP requests in flight at once")
+    parser.add_argument("--reads", default=1000, type=int, help="anonymous /registrants/ requests")
+    parser.add_argument("--patches", default=200, type=int, help="organizer roster PATCH requests")
+    parser.add_argument("--ws-clients", default=200, type=int, help="websocket listeners")
+    parser.add_argument("--ws-events", default=50, type=int, help="events broadcast to the websocket listeners")
+    parser.add_argument("--upstream-latency", default=0.05, type=float,
+                        help="seconds every stubbed osu!/discord API call takes")
+    parser.add_argument("--eager-tasks", action='store_true', help="run celery tasks inline, when there's no broker")
+    parser.add_argument("--keep", action='store_true', help="don't delete the registered players afterwards")
+    args = parser.parse_args()
+    if unknown := set(args.scenarios) - set(SCENARIOS):
+        parser.error(f"unknown scenario(s) {', '.join(sorted(unknown))}, choose from {', '.join(SCENARIOS)}")
+    args.scenarios = args.scenarios or list(SCENARIOS)
+
+    with StubServer(StubUpstream(latency=args.upstream_latency)) as stub:
+        configure_environment(stub)
+        os.environ["DJANGO_SETTINGS_MODULE"] = args.settings
+        from kfcrebrand.asgi import application
+        from kfcrebrand.celery import app as celery_app
+        from django.conf import settings
+
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        logging.getLogger("userauth").setLevel(logging.WARNING)
+        if "django_redis" not in settings.CACHES["default"]["BACKEND"]:
+            # the replay stream needs redis, every broadcast would warn about it
+            logging.getLogger("discord.events").setLevel(logging.ERROR)
+        celery_app.conf.task_always_eager = args.eager_tasks
+
+        profile_indices = range(scenarios.FIRST_PROFILE_INDEX, scenarios.FIRST_PROFILE_INDEX + args.users)
+        print(f"{datetime.datetime.now():%H:%M:%S} running {', '.join(args.scenarios)} against "
+              f"{settings.DATABASES['default']['ENGINE']}, upstream latency {args.upstream_latency * 1000:.0f}ms")
+        try:
+            for result in asyncio.run(run(args, application, profile_indices)):
+                print(result)
+        finally:
+            if not args.keep:
+                cleanup(profile_indices)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Load test scenarios, each driving the project's ASGI application in-process and timing every operation.
+
+Requests go through the full middleware stack, so sync views run on the application's single sync thread exactly as
+they would inside one uvicorn worker.
+"""
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+import httpx
+from asgiref.sync import sync_to_async
+from channels.testing import WebsocketCommunicator
+
+from loadtest.stats import summarize
+
+# synthetic profile indices used by the load test, clear of the ones seed_registrations --synthetic starts from
+FIRST_PROFILE_INDEX = 50_000_000
+BASE_URL = "http://loadtest.example.com"
+CSRF_TOKEN = "loadtestloadtestloadtestloadtest"
+
+
+@dataclass
+class Result:
+    name: str
+    elapsed: float = 0.0
+    latencies: list[float] = field(default_factory=list)
+    errors: int = 0
+
+    def __str__(self):
+        return summarize(self.name, self.latencies, self.elapsed, self.errors)
+
+    async def time(self, operation: Callable[[], Awaitable]):
+        start_time = time.perf_counter()
+        try:
+            await operation()
+        except (httpx.HTTPError, asyncio.TimeoutError, AssertionError):
+            self.errors += 1
+            return
+        self.latencies.append(time.perf_counter() - start_time)
+
+
+async def run_concurrently(concurrency: int, operations: list[Callable[[], Awaitable]]) -> float:
+    """
+    :return: wall time of running every operation, at most `concurrency` at once
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(operation):
+        async with semaphore:
+            await operation()
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(run(operation) for operation in operations))
+    return time.perf_counter() - start_time
+
+
+def make_client(application) -> httpx.AsyncClient:
+    """
+    A browser-like client with its own cookie jar, sending the CSRF token DRF's SessionAuthentication asks for.
+    """
+    from django.conf import settings
+
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=application), base_url=BASE_URL,
+                               headers={"X-CSRFToken": CSRF_TOKEN})
+    # same domain as the cookie django sets, so a rotated token replaces this one
+    client.cookies.set("csrftoken", CSRF_TOKEN, domain=settings.CSRF_COOKIE_DOMAIN or httpx.URL(BASE_URL).host)
+    return client
+
+
+async def registration_storm(clients: dict[int, httpx.AsyncClient], concurrency: int) -> Result:
+    """
+    Every client completes the osu! and discord OAuth callbacks, then logs in, registering synthetic profile `index`.
+    """
+    result = Result("registration storm (osu! callback, discord callback, login)")
+
+    def register(index: int, client: httpx.AsyncClient):
+        async def operation():
+            for path in (f"/auth/osu/code/?code={index}",
+                         f"/auth/discord/discord_code/?code={index}",
+                         "/auth/session/login/"):
+                (await client.get(path)).raise_for_status()
+            # login rotates the CSRF token
+            client.headers["X-CSRFToken"] = client.cookies["csrftoken"]
+        return lambda: result.time(operation)
+
+    result.elapsed = await run_concurrently(concurrency, [register(index, client) for index, client in clients.items()])
+    return result
+
+
+async def registrant_reads(application, player_pks: list[int], requests: int, concurrency: int) -> Result:
+    """
+    Anonymous reads: three in four list a random page of registrants, the rest fetch one registrant with badges.
+    """
+    result = Result("anonymous /registrants/ reads")
+    rng = random.Random(0)
+    pages = max(1, len(player_pks) // 50)
+    paths = [f"/registrants/?page={rng.randint(1, pages)}" if rng.random() < 0.75
+             else f"/registrants/{rng.choice(player_pks)}/"
+             for _ in range(requests)]
+
+    async with make_client(application) as client:
+        def read(path: str):
+            async def operation():
+                (await client.get(path)).raise_for_status()
+            return lambda: result.time(operation)
+
+        result.elapsed = await run_concurrently(concurrency, [read(path) for path in paths])
+    return result
+
+
+async def organizer_patches(organizers: dict[str, tuple[httpx.AsyncClient, list[int]]],
+                            requests: int, concurrency: int, roster_max: int, backup_max: int) -> Result:
+    """
+    Team organizers PATCH their roster, backups and captain with a random selection of their team's players.
+    :param organizers: team flag to (logged-in organizer client, team player pks)
+    """
+    result = Result("organizer /teams/<flag>/members/ PATCH")
+    rng = random.Random(0)
+    flags = list(organizers)
+
+    def patch(flag: str):
+        client, player_pks = organizers[flag]
+        selection = rng.sample(player_pks, k=min(len(player_pks), roster_max + backup_max))
+        roster, backups = selection[:roster_max], selection[roster_max:]
+        data = {"players": roster, "backups": backups, "captain": roster[0] if roster else None}
+
+        async def operation():
+            (await client.patch(f"/teams/{flag}/members/", json=data)).raise_for_status()
+        return lambda: result.time(operation)
+
+    result.elapsed = await run_concurrently(concurrency, [patch(flags[i % len(flags)]) for i in range(requests)])
+    return result
+
+
+async def websocket_fanout(application, broadcast: Callable[[dict], None], clients: int, events: int) -> Result:
+    """
+    `clients` listeners on /ws/discord/ each receive `events` registration events sent through `broadcast`, e.g.
+    run.enqueue_registration. Latency is measured per delivery, from just before the broadcast to the listener
+    receiving the frame.
+    """
+    result = Result(f"/ws/discord/ fan-out to {clients} clients (per delivery)")
+    communicators = [WebsocketCommunicator(application, "/ws/discord/") for _ in range(clients)]
+    for communicator in communicators:
+        connected, _ = await communicator.connect()
+        assert connected, "websocket client failed to connect"
+
+    sent_at: dict[int, float] = {}
+
+    async def listen(communicator: WebsocketCommunicator):
+        for _ in range(events):
+            try:
+                frame = await communicator.receive_from(timeout=30)
+            except asyncio.TimeoutError:
+                result.errors += 1
+                return
+            event = json.loads(json.loads(frame)["message"])
+            result.latencies.append(time.perf_counter() - sent_at[event["osu_user_id"]])
+
+    listeners = [asyncio.create_task(listen(communicator)) for communicator in communicators]
+    start_time = time.perf_counter()
+    for i in range(events):
+        sent_at[i] = time.perf_counter()
+        await sync_to_async(broadcast)({"discord_user_id": str(i), "osu_user_id": i, "osu_username": f"loadtest_{i}",
+                                        "osu_global_rank": 10_000 + i, "osu_global_rank_bws": 10_000 + i,
+                                        "osu_flag": "US", "is_organizer": False, "action": "register"})
+    await asyncio.gather(*listeners)
+    result.elapsed = time.perf_counter() - start_time
+
+    for communicator in communicators:
+        await communicator.disconnect()
+    return result
@@ -0,0 +1,20 @@
+import statistics
+
+
+def summarize(name: str, latencies: list[float], elapsed: float, errors: int = 0) -> str:
+    """
+    Format throughput and latency percentiles of a load test scenario.
+    :param name: scenario name
+    :param latencies: per-request latencies in seconds, successful requests only
+    :param elapsed: wall time of the whole scenario in seconds
+    :param errors: number of failed requests
+    :return: str
+    """
+    if not latencies:
+        return f"{name}: no successful requests, {errors} errors"
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return (f"{name}: {len(latencies)} ok, {errors} errors in {elapsed:.3f}s "
+            f"({len(latencies) / elapsed:.1f}/s), "
+            f"p50 {quantiles[49] * 1000:.1f}ms, "
+            f"p95 {quantiles[94] * 1000:.1f}ms, "
+            f"p99 {quantiles[98] * 1000:.1f}ms")
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import socket
+import threading
+import time
+from urllib.parse import parse_qs
+
+import uvicorn
+
+from userauth.management.commands._synthetic import SYNTHETIC_OSU_ID_OFFSET, synthetic_profile
+
+
+class StubUpstream:
+    """
+    ASGI app answering the osu! and discord OAuth/API endpoints the views call, after `latency` seconds.
+
+    An authorization code `<n>` is traded for access token `stub-<n>`, which identifies synthetic profile n (see
+    seed_registrations --synthetic).
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+        status, payload = self.route(scope["method"], scope["path"], dict(scope["headers"]), body)
+        await send({"type": "http.response.start",
+                    "status": status,
+                    "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": json.dumps(payload).encode()})
+
+    @staticmethod
+    def route(method: str, path: str, headers: dict, body: bytes) -> tuple[int, dict]:
+        if method == "POST" and path in ("/oauth/token", "/api/v10/oauth2/token"):
+            form = parse_qs(body.decode())
+            if "code" in form:
+                return 200, {"access_token": f"stub-{form['code'][0]}", "token_type": "Bearer", "expires_in": 86400}
+            # client credentials grant, used by the celery worker
+            return 200, {"access_token": "stub-client", "token_type": "Bearer", "expires_in": 86400}
+
+        authorization = headers.get(b"authorization", b"").decode()
+        if not authorization.startswith("Bearer stub-"):
+            return 401, {"error": "invalid token"}
+        token_user = authorization.removeprefix("Bearer stub-")
+
+        if method == "GET" and path == "/api/v2/me/osu" and token_user.isdigit():
+            return 200, synthetic_profile(int(token_user))[1]
+        if method == "GET" and path.startswith("/api/v2/users/") and path.endswith("/osu"):
+            user_id = path.split("/")[4]
+            if user_id.isdigit() and int(user_id) >= SYNTHETIC_OSU_ID_OFFSET:
+                return 200, synthetic_profile(int(user_id) - SYNTHETIC_OSU_ID_OFFSET)[1]
+        if method == "GET" and path == "/api/v10/oauth2/@me" and token_user.isdigit():
+            return 200, {"user": synthetic_profile(int(token_user))[0]}
+        return 404, {"error": "not found"}
+
+
+class StubServer:
+    """
+    Serves an ASGI app with uvicorn on a free local port from a background thread.
+    """
+
+    def __init__(self, app, host: str = "127.0.0.1"):
+        self.app = app
+        self.host = host
+        with socket.socket() as sock:
+            sock.bind((host, 0))
+            self.port = sock.getsockname()[1]
+        self.server = uvicorn.Server(uvicorn.Config(app, host=host, port=self.port, log_level="warning",
+                                                    lifespan="off", access_log=False))
+        self.thread = threading.Thread(target=self.server.run, name="stub-server", daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def __enter__(self):
+        self.thread.start()
+        deadline = time.monotonic() + 10
+        while not self.server.started:
+            if time.monotonic() > deadline or not self.thread.is_alive():
+                raise RuntimeError(f"stub server failed to start on {self.url}")
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+    def environ(self) -> dict[str, str]:
+        """
+        Settings overrides pointing the project at this stub server.
+        """
+        return {"OSU_OAUTH_ENDPOINT": f"{self.url}/oauth",
+                "OSU_API_ENDPOINT": f"{self.url}/api/v2",
+                "DISCORD_API_ENDPOINT": f"{self.url}/api/v10"}
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from teammgmt.models import TournamentTeam
+
+
+class Command(BaseCommand):
+    help = ("Recounts the candidate, roster, backup and captain counters of every team from its players, "
+            "run by the migrate service of docker-compose.yml on every deploy")
+
+    def add_arguments(self, parser):
+        parser.add_argument("flags", nargs="*", help="teams to recount, defaults to all of them")
+
+    def handle(self, *args, **options):
+        start_time = time.perf_counter()
+        teams = options['flags'] or TournamentTeam.objects.values('pk')
+        with transaction.atomic():
+            refreshed = TournamentTeam.refresh_counters(teams)
+        self.stdout.write(
+            self.style.SUCCESS(f"recounted {refreshed} teams in {time.perf_counter() - start_time:.3f}s")
+        )
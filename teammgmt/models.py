@@ -1,13 +1,66 @@
 from django.db import models
+from django.db.models import Count, Exists, F, OuterRef, Q
 
 
 # Create your models here.
 class TournamentTeam(models.Model):
     osu_flag = models.CharField(max_length=4, primary_key=True)
 
+    # counted from the team's players in the transactions changing them, so listing teams needs no aggregate. Saving or
+    # deleting a player adjusts them through userauth.signals, queryset updates of players call refresh_counters
+    candidate_count = models.PositiveIntegerField(default=0)
+    roster_count = models.PositiveIntegerField(default=0)
+    backup_count = models.PositiveIntegerField(default=0)
+    has_captain = models.BooleanField(default=False)
+
     @classmethod
     def get_default_pk(cls):
         default_team, _ = cls.objects.get_or_create(
             osu_flag='WYSI',
         )
         return default_team.pk
+
+    @classmethod
+    def adjust_counters(cls, team_id, candidates: int = 0, roster: int = 0, backups: int = 0,
+                        recount_captain: bool = False):
+        """
+        Add to the counters of team `team_id` in a single UPDATE, nothing is queried when nothing changes.
+        :param recount_captain: also set has_captain from whether any of the team's players is captain, in the same
+            UPDATE. Recounted rather than set, as another player of the team may still be captain
+        """
+        counters = {}
+        if candidates:
+            counters['candidate_count'] = F('candidate_count') + candidates
+        if roster:
+            counters['roster_count'] = F('roster_count') + roster
+        if backups:
+            counters['backup_count'] = F('backup_count') + backups
+        if recount_captain:
+            players = cls._meta.get_field('players').related_model.objects
+            counters['has_captain'] = Exists(players.filter(team_id=OuterRef('pk'), is_captain=True))
+        if counters:
+            cls.objects.filter(pk=team_id).update(**counters)
+
+    @classmethod
+    def refresh_counters(cls, teams, candidates: bool = True) -> int:
+        """
+        Recount the counters of `teams` from their players.
+        :param teams: team pks, or a values() queryset of them
+        :param candidates: also recount candidate_count. Roster changes leave it out so they can't overwrite a
+            registration counted concurrently
+        :return: number of teams recounted
+        """
+        teams = list(cls.objects.filter(pk__in=teams).annotate(
+            counted_candidates=Count('players'),
+            counted_roster=Count('players', filter=Q(players__in_roster=True)),
+            counted_backups=Count('players', filter=Q(players__in_backup_roster=True)),
+            counted_captains=Count('players', filter=Q(players__is_captain=True)),
+        ))
+        for team in teams:
+            team.candidate_count = team.counted_candidates
+            team.roster_count = team.counted_roster
+            team.backup_count = team.counted_backups
+            team.has_captain = team.counted_captains > 0
+        fields = ['roster_count', 'backup_count', 'has_captain'] + (['candidate_count'] if candidates else [])
+        cls.objects.bulk_update(teams, fields)
+        return len(teams)
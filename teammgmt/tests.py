@@ -10,7 +10,7 @@ from rest_framework.authentication import TokenAuthentication
 from discord.views import TournamentPlayerSerializer, TournamentPlayerViewSet
 from teammgmt.models import TournamentTeam
 from teammgmt.views import TournamentTeamViewSet
-from userauth.authentication import IsSuperUser
+from userauth.authentication import DiscordAndOsuAuthBackend, IsSuperUser
 from userauth.models import TournamentPlayer
 from rest_framework.test import APIRequestFactory
 
@@ -199,6 +199,23 @@ class TestSetTeamCaptain(TestCaseWithTourneyUsers):
         self.assertIsNone(res.data['captain'])
         self.assertEqual(200, res.status_code)
 
+    def test_roster_change_invalidates_cached_principals(self):
+        backend = DiscordAndOsuAuthBackend()
+        for player in self.tourney_players[:2]:
+            backend.get_user(player.pk)
+        request = self.factory.patch(f'/teams/{self.tourney_team.osu_flag}/members',
+                                     data={"players": [self.tourney_players[0].pk],
+                                           "backups": [self.tourney_players[1].pk],
+                                           "captain": self.tourney_players[0].pk},
+                                     format="json")
+        members_view = TournamentTeamViewSet.as_view({'patch': 'members'}, permission_classes=[])
+        self.assertEqual(200, members_view(request, pk=self.tourney_team.pk).status_code)
+
+        captain = backend.get_user(self.tourney_players[0].pk).tournamentplayer
+        self.assertTrue(captain.in_roster)
+        self.assertTrue(captain.is_captain)
+        self.assertTrue(backend.get_user(self.tourney_players[1].pk).tournamentplayer.in_backup_roster)
+
     def test_invalid_captain_type(self):
         request = self.factory.patch(f'/teams/{self.tourney_team.osu_flag}/members',
                                      data={"players": [], "backups": [], "captain": "your mom"},
@@ -270,3 +287,147 @@ class TestViewRosterMembership(TestCaseWithTourneyUsers):
 
         for field in self.restricted_fields:
             self.assertIn(field, serializer.data.keys())
+
+
+class TestTeamCounters(TestCaseWithTourneyUsers):
+    def setUp(self) -> None:
+        settings.TEAM_ROSTER_REGISTRATION_START = (datetime.datetime.now(tz=datetime.timezone.utc) -
+                                                   datetime.timedelta(days=5))
+        settings.TEAM_ROSTER_SELECTION_END = (datetime.datetime.now(tz=datetime.timezone.utc) +
+                                              datetime.timedelta(days=5))
+        super().setUp()
+
+    def assertCounters(self, team_id, candidates, roster, backups, has_captain):
+        team = TournamentTeam.objects.get(pk=team_id)
+        self.assertEqual((candidates, roster, backups, has_captain),
+                         (team.candidate_count, team.roster_count, team.backup_count, team.has_captain))
+
+    def patch_members(self, players, backups, captain=None):
+        request = APIRequestFactory().patch(f'/teams/{self.tourney_team.osu_flag}/members',
+                                            data={"players": players, "backups": backups, "captain": captain},
+                                            format="json")
+        members_view = TournamentTeamViewSet.as_view({'patch': 'members'}, permission_classes=[])
+        return members_view(request, pk=self.tourney_team.pk)
+
+    def test_created_players_counted(self):
+        self.assertCounters("SH", 11, 0, 0, False)
+
+    def test_registration_counted(self):
+        settings.USER_REGISTRATION_END = datetime.datetime.now(tz=datetime.timezone.utc) + timedelta(days=1)
+        DiscordAndOsuAuthBackend().authenticate(
+            None,
+            discord_user_data={"id": "100", "username": "new", "discriminator": "0"},
+            osu_user_data={'id': 100, 'username': 'new', 'country_code': 'SH', 'statistics': {"global_rank": 1},
+                           'badges': []})
+
+        self.assertCounters("SH", 12, 0, 0, False)
+
+    def test_roster_change_counted(self):
+        ids = [player.pk for player in self.tourney_players]
+
+        self.assertEqual(200, self.patch_members(ids[:6], ids[6:9], captain=ids[0]).status_code)
+        self.assertCounters("SH", 11, 6, 3, True)
+
+        self.assertEqual(200, self.patch_members(ids[:2], ids[2:3]).status_code)
+        self.assertCounters("SH", 11, 2, 1, False)
+
+    def test_roster_change_counts_players_of_other_teams_on_theirs(self):
+        other_team = TournamentTeam.objects.create(osu_flag="727")
+        self.tourney_players[1].team = other_team
+        self.tourney_players[1].save()
+
+        self.patch_members([self.tourney_players[0].pk, self.tourney_players[1].pk], [])
+
+        self.assertCounters("SH", 10, 1, 0, False)
+        self.assertCounters("727", 1, 1, 0, False)
+
+    def test_team_change_moves_counts(self):
+        other_team = TournamentTeam.objects.create(osu_flag="727")
+        player = TournamentPlayer.objects.get(pk=self.tourney_players[0].pk)
+        player.in_roster = True
+        player.is_captain = True
+        player.save()
+        self.assertCounters("SH", 11, 1, 0, True)
+
+        player.team = other_team
+        player.save()
+
+        self.assertCounters("SH", 10, 0, 0, False)
+        self.assertCounters("727", 1, 1, 0, True)
+
+    def test_captain_recounted_when_one_steps_down(self):
+        captains = [TournamentPlayer.objects.get(pk=player.pk) for player in self.tourney_players[:2]]
+        for captain in captains:
+            captain.in_roster = True
+            captain.is_captain = True
+            captain.save()
+
+        captains[0].is_captain = False
+        captains[0].save()
+        self.assertCounters("SH", 11, 2, 0, True)
+
+        captains[1].delete()
+        self.assertCounters("SH", 10, 1, 0, False)
+
+    def test_counters_read_only_in_admin(self):
+        admin_user = User.objects.create(username="admin", is_staff=True, is_superuser=True)
+        self.client.force_login(admin_user)
+
+        res = self.client.post(f'/admin/teammgmt/tournamentteam/{self.tourney_team.pk}/change/',
+                               data={"osu_flag": "SH", "candidate_count": 0, "roster_count": 5, "backup_count": 5,
+                                     "has_captain": "on"})
+
+        self.assertEqual(302, res.status_code)
+        self.assertCounters("SH", 11, 0, 0, False)
+
+    def test_unchanged_save_does_not_query_counters(self):
+        player = TournamentPlayer.objects.get(pk=self.tourney_players[0].pk)
+        player.osu_rank_std = 1
+
+        with self.assertNumQueries(1):
+            player.save(update_fields=['osu_rank_std'])
+
+    def test_deletion_counted(self):
+        ids = [player.pk for player in self.tourney_players]
+        self.patch_members(ids[:2], ids[2:3], captain=ids[0])
+
+        User.objects.get(pk=ids[0]).delete()
+        self.assertCounters("SH", 10, 1, 1, False)
+        User.objects.get(pk=ids[2]).delete()
+        self.assertCounters("SH", 9, 1, 0, False)
+
+    def test_refresh_counters(self):
+        TournamentTeam.objects.filter(pk="SH").update(candidate_count=0, roster_count=5, has_captain=True)
+
+        self.assertEqual(1, TournamentTeam.refresh_counters(["SH"]))
+        self.assertCounters("SH", 11, 0, 0, False)
+
+    def test_members_pagination_counts_from_team(self):
+        request = APIRequestFactory().get(f'/teams/{self.tourney_team.osu_flag}/members')
+        members_view = TournamentTeamViewSet.as_view({'get': 'members'}, permission_classes=[])
+
+        res = members_view(request, pk=self.tourney_team.pk)
+
+        self.assertEqual(11, res.data['candidates']['count'])
+        self.assertEqual(11, len(res.data['candidates']['results']))
+
+    def test_members_pagination_lists_players_past_stale_count(self):
+        TournamentTeam.objects.filter(pk="SH").update(candidate_count=0)
+        request = APIRequestFactory().get(f'/teams/{self.tourney_team.osu_flag}/members')
+        members_view = TournamentTeamViewSet.as_view({'get': 'members'}, permission_classes=[])
+
+        res = members_view(request, pk=self.tourney_team.pk)
+
+        self.assertEqual(0, res.data['candidates']['count'])
+        self.assertEqual(11, len(res.data['candidates']['results']))
+
+    def test_teams_list_includes_counters(self):
+        request = APIRequestFactory().get('/teams/')
+        teams_view = TournamentTeamViewSet.as_view({'get': 'list'})
+
+        res = teams_view(request)
+
+        team = next(team for team in res.data['results'] if team['osu_flag'] == "SH")
+        self.assertEqual({"candidate_count": 11, "roster_count": 0, "backup_count": 0, "has_captain": False},
+                         {key: team[key] for key in ("candidate_count", "roster_count", "backup_count",
+                                                     "has_captain")})
@@ -1,7 +1,9 @@
 import datetime
+import functools
 
 from django.conf import settings
 from django.db import transaction, IntegrityError
+from django.db.models import Q
 
 from rest_framework import serializers, viewsets, status
 from rest_framework.decorators import action
@@ -9,8 +11,10 @@ from rest_framework.exceptions import PermissionDenied
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
 
-from discord.views import TournamentPlayerSerializer, PreSharedKeyAuthentication, TeamOrganizer, ReadOnly
-from userauth.authentication import IsSuperUser
+from discord.permissions import PreSharedKeyAuthentication, TeamOrganizer, ReadOnly
+from discord.serializers import TournamentPlayerSerializer
+from kfcrebrand.pagination import CountedPaginator
+from userauth.authentication import IsSuperUser, invalidate_principals
 from teammgmt.models import TournamentTeam
 from userauth.models import TournamentPlayer
 
@@ -18,7 +22,7 @@ from userauth.models import TournamentPlayer
 class TournamentTeamSerializer(serializers.HyperlinkedModelSerializer):
     class Meta:
         model = TournamentTeam
-        fields = ['url', 'osu_flag']
+        fields = ['url', 'osu_flag', 'candidate_count', 'roster_count', 'backup_count', 'has_captain']
 
 
 class TournamentTeamMembersSerializer(serializers.HyperlinkedModelSerializer):
@@ -31,6 +35,10 @@ class TournamentTeamMembersSerializer(serializers.HyperlinkedModelSerializer):
         model = TournamentTeam
         fields = ['url', 'osu_flag', 'captain', 'roster', 'backups', 'candidates']
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._selected_players = {}
+
     def get_candidates(self, team: TournamentTeam):
         qs = TournamentPlayer.objects.filter(team=team)
         pagination_class = viewsets.GenericViewSet.pagination_class
@@ -44,6 +52,8 @@ class TournamentTeamMembersSerializer(serializers.HyperlinkedModelSerializer):
 
         request = self.context['request']
         drf_paginator = pagination_class()
+        # the team counts its candidates, no COUNT(*) needed
+        drf_paginator.django_paginator_class = functools.partial(CountedPaginator, count=team.candidate_count)
 
         paginated_qs = drf_paginator.paginate_queryset(queryset=qs, request=request)
 
@@ -51,40 +61,43 @@ class TournamentTeamMembersSerializer(serializers.HyperlinkedModelSerializer):
         if paginated_qs is None:
             return all_candidates_serializer.data
 
-        paginated_response = drf_paginator.get_paginated_response(paginated_qs)
-
-        # get_page_size cannot be None here else paginated_qs would've been None
-        django_paginator = drf_paginator.django_paginator_class(qs, drf_paginator.get_page_size(request))
-        page_num = drf_paginator.get_page_number(self.context['request'], django_paginator)
+        page_serializer = TournamentPlayerSerializer(instance=paginated_qs,
+                                                     context=self.context,
+                                                     many=True,
+                                                     read_only=True)
+        return drf_paginator.get_paginated_response(page_serializer.data).data
 
-        page_results = django_paginator.page(page_num)
-        paginated_response_data = paginated_response.data
-        paginated_response_data['results'] = TournamentPlayerSerializer(instance=page_results,
-                                                                        context=self.context,
-                                                                        many=True,
-                                                                        read_only=True).data
-        return paginated_response_data
+    def selected_players(self, team) -> list[TournamentPlayer]:
+        """
+        Roster and backup players of `team`, fetched once for the roster, backups and captain fields. The captain is
+        always in the roster.
+        """
+        if team.pk not in self._selected_players:
+            self._selected_players[team.pk] = list(
+                TournamentPlayer.objects.filter(Q(in_roster=True) | Q(in_backup_roster=True), team=team)
+            )
+        return self._selected_players[team.pk]
 
     def get_roster(self, team):
-        players = TournamentPlayer.objects.filter(team=team, in_roster=True)
+        players = [player for player in self.selected_players(team) if player.in_roster]
         serializer = TournamentPlayerSerializer(instance=players, context=self.context, many=True)
         return serializer.data
 
     def get_backups(self, team):
-        players = TournamentPlayer.objects.filter(team=team, in_backup_roster=True)
+        players = [player for player in self.selected_players(team) if player.in_backup_roster]
         serializer = TournamentPlayerSerializer(instance=players, context=self.context, many=True)
         return serializer.data
 
     def get_captain(self, team):
-        if (captain := TournamentPlayer.objects.filter(team=team, is_captain=True)).exists():
-            serializer = TournamentPlayerSerializer(instance=captain[0], context=self.context, many=False)
+        if (captain := next((player for player in self.selected_players(team) if player.is_captain), None)) is not None:
+            serializer = TournamentPlayerSerializer(instance=captain, context=self.context, many=False)
             return serializer.data
         return None
 
 
 class TournamentTeamViewSet(viewsets.ModelViewSet):
     serializer_class = TournamentTeamSerializer
-    queryset = TournamentTeam.objects.all()
+    queryset = TournamentTeam.objects.order_by('osu_flag')
     http_method_names = ["get", "patch"]
     permission_classes = [ReadOnly]
 
@@ -162,19 +175,26 @@ class TournamentTeamViewSet(viewsets.ModelViewSet):
 
             try:
                 with transaction.atomic():
-                    for player_to_remove_from_roster in to_remove_from_roster:
-                        player_to_remove_from_roster.in_roster = False
-                        player_to_remove_from_roster.save()
-                    for player_to_remove_from_backup in to_remove_from_backup:
-                        player_to_remove_from_backup.in_backup_roster = False
-                        player_to_remove_from_backup.save()
+                    # a captain must be in the roster, so the captain goes before anyone leaves the roster
+                    team.players.update(is_captain=False)
+                    # pks are read first: MySQL can't UPDATE a table filtered by a subquery on that same table
+                    removed_from_roster = list(to_remove_from_roster.values_list('pk', flat=True))
+                    TournamentPlayer.objects.filter(pk__in=removed_from_roster).update(in_roster=False)
+                    removed_from_backup = list(to_remove_from_backup.values_list('pk', flat=True))
+                    TournamentPlayer.objects.filter(pk__in=removed_from_backup).update(in_backup_roster=False)
                     req_players_qs.update(in_roster=True)
                     req_backups_qs.update(in_backup_roster=True)
-                    team.players.update(is_captain=False)
 
                     # if captain not in new roster, silently drop captain
-                    if captain is not None and req_players_qs.filter(pk=captain).exists():
+                    if captain is not None:
                         req_players_qs.filter(pk=captain).update(is_captain=True)
+
+                    # queryset updates skip the post_save signal
+                    invalidate_principals(*players, *backups, *removed_from_roster, *removed_from_backup)
+                    # requested players from other teams count on theirs
+                    selected_teams = (TournamentPlayer.objects.filter(Q(team=team) | Q(pk__in=[*players, *backups]))
+                                      .values('team_id'))
+                    TournamentTeam.refresh_counters(selected_teams, candidates=False)
             except IntegrityError as e:
                 if str(e) == 'CHECK constraint failed: not_both_roster_and_backup':
                     return Response({"error": "player cannot be both in roster and "
@@ -2,8 +2,14 @@ from django.contrib import admin
 from userauth.models import DisqualifiedUser, TournamentPlayer, TournamentPlayerBadge
 from teammgmt.models import TournamentTeam
 
+
+class TournamentTeamAdmin(admin.ModelAdmin):
+    # counted from the team's players, a form saving them back would overwrite counts changed since it was loaded
+    readonly_fields = ('candidate_count', 'roster_count', 'backup_count', 'has_captain')
+
+
 # Register your models here.
 admin.site.register(TournamentPlayer)
 admin.site.register(TournamentPlayerBadge)
-admin.site.register(TournamentTeam)
+admin.site.register(TournamentTeam, TournamentTeamAdmin)
 admin.site.register(DisqualifiedUser)
@@ -1,20 +1,19 @@
 import datetime
-import json
 import math
 from typing import Iterable
 
 from django.conf import settings
 from django.contrib.auth.backends import BaseBackend
 from django.contrib.auth.models import User
-from django.db import transaction
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, transaction
 from rest_framework.exceptions import PermissionDenied
 from rest_framework.permissions import BasePermission
 
+from discord import events
 from teammgmt.models import TournamentTeam
 from userauth.models import TournamentPlayer, TournamentPlayerBadge
 
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 import logging
 
 
@@ -36,10 +35,47 @@ def filter_badges(badges: list[dict],
             and (cutoff_date is None or datetime.datetime.fromisoformat(badge['awarded_at']) > cutoff_date)]
 
 
+DISCORD_SESSION_FIELDS = ('id', 'username', 'discriminator', 'global_name', 'avatar')
+BADGE_SESSION_FIELDS = ('awarded_at', 'description', 'url', 'image_url', 'image@2x_url')
+
+
+def compact_discord_user(discord_user: dict) -> dict:
+    """
+    Trim a discord /oauth2/@me user down to the fields kept in the session.
+    """
+    return {key: discord_user.get(key) for key in DISCORD_SESSION_FIELDS}
+
+
+def compact_osu_profile(osu_profile: dict) -> dict:
+    """
+    Trim an osu! /me/osu response down to the fields kept in the session: what validate_data and registration read.
+    Badges that would never be saved are dropped.
+    """
+    statistics = osu_profile.get('statistics')
+    badges = osu_profile.get('badges')
+    return {'id': osu_profile.get('id'),
+            'username': osu_profile.get('username'),
+            'country_code': osu_profile.get('country_code'),
+            'statistics': None if statistics is None else {'global_rank': statistics.get('global_rank')},
+            'badges': None if badges is None else [{key: badge.get(key) for key in BADGE_SESSION_FIELDS}
+                                                   for badge in filter_badges(badges, cutoff_date=None)]}
+
+
+def parked_profile_key(provider: str, user_id) -> str:
+    """
+    Cache key of the full API profile parked by the OAuth callbacks, see OAUTH_PROFILE_CACHE_TTL.
+    :param provider: "osu" or "discord"
+    :param user_id: osu! or discord user id
+    """
+    return f"oauth_profile_{provider}_{user_id}"
+
+
+# cutoff_date date of 0 timestamp to keep all badges in DB
+DB_BADGE_CUTOFF_DATE = datetime.datetime.fromtimestamp(0, tz=datetime.timezone.utc)
+
+
 def prep_badges_for_db(osu_data, tourney_player):
-    # cutoff_date date of 0 timestamp to keep all badges in DB
-    all_badges = filter_badges(osu_data['badges'],
-                               cutoff_date=datetime.datetime.fromtimestamp(0, tz=datetime.timezone.utc))
+    all_badges = filter_badges(osu_data['badges'], cutoff_date=DB_BADGE_CUTOFF_DATE)
     db_badges = [TournamentPlayerBadge(user=tourney_player,
                                        description=badge['description'],
                                        award_date=datetime.datetime.fromisoformat(badge['awarded_at']),
@@ -69,6 +105,14 @@ def bws(badges_count: int, global_rank: int) -> int:
 
 
 class DiscordAndOsuAuthBackend(BaseBackend):
+    def __init__(self, background: bool = True):
+        """
+        :param background: False leaves undone what authenticate hands to background workers: the outbox drainer isn't
+            woken for the events it queues, and badges aren't queued to celery but left pending. Used by
+            bench_registrations, whose synthetic registrations are deleted afterwards
+        """
+        self.background = background
+
     @staticmethod
     def validate_data(discord_user_data, osu_user_data):
         if discord_user_data is None or osu_user_data is None:
@@ -84,6 +128,9 @@ class DiscordAndOsuAuthBackend(BaseBackend):
             discord_data['composite_username'] += f"#{discord_data['discriminator']}" \
                 if discord_data['discriminator'] != '0' \
                 else ''
+            # optional, both can be null
+            discord_data['global_name'] = discord_user_data.get('global_name')
+            discord_data['avatar'] = discord_user_data.get('avatar')
 
         osu_data = {'id': None, 'username': None, 'country_code': None, 'statistics': None, 'badges': None}
         for key in osu_data:
@@ -94,6 +141,16 @@ class DiscordAndOsuAuthBackend(BaseBackend):
 
     # todo: split user creation from authentication
     def authenticate(self, request, discord_user_data=None, osu_user_data=None):
+        """
+        Log in a registered player, moving their registration to a new discord account if needed, or register them.
+
+        Query budget per path, excluding transaction/savepoint statements (see AuthenticateQueryBudgetTestCase):
+        - returning player: 1 (user joined with their TournamentPlayer)
+        - discord switch: 5 (user lookup, lookup by osu id joined with user, user update, player update,
+          outbox insert)
+        - new player: 7 (user lookup, lookup by osu id, user insert, team upsert, player insert, team counters
+          update, outbox insert), badges are written after commit by userauth.tasks.save_player_badges
+        """
         discord_data, osu_data = self.validate_data(discord_user_data, osu_user_data)
         if discord_data is None or osu_data is None:
             logger.info("discord or osu session data failed to validate")
@@ -101,107 +158,178 @@ class DiscordAndOsuAuthBackend(BaseBackend):
 
         logger.info(f"attempting auth with discord user id {discord_data['id']}, osu user id {osu_data['id']}")
         username = f"{discord_data['id']}.{osu_data['id']}"
-        try:
-            # check both user and TournamentPlayer exist
-            user = User.objects.get(username=username)
-        except User.DoesNotExist:
-            try:
-                # found existing TournamentPlayer with different discord id
-                tournament_player: TournamentPlayer = TournamentPlayer.objects.filter(osu_user_id=osu_data['id'])[0]
-                logger.info(f"found user {tournament_player} with  discord id {tournament_player.discord_user_id}. "
-                            f"Updating discord id to {discord_data['id']}")
-                old_discord_id = tournament_player.discord_user_id
-
-                tournament_player.discord_user_id = discord_data['id']
-                tournament_player.discord_username = discord_data['composite_username']
-                tournament_player.user.username = username
-                tournament_player.user.save()
-                tournament_player.save()
-                try:
-                    channel_layer = get_channel_layer()
-                    # noinspection PyArgumentList
-                    async_to_sync(channel_layer.group_send)(
-                        settings.CHANNELS_DISCORD_WS_GROUP_NAME,
-                        {
-                            "type": "registration.discord.switch",
-                            "message": json.dumps({
-                                "old_discord_user_id": old_discord_id,
-                                "new_discord_user_id": tournament_player.discord_user_id,
-                                "action": "discord_switch"
-                            })
-                        })
-                finally:
-                    logger.info(f"successfully authenticated user {tournament_player}")
-                    return tournament_player.user
-            except IndexError:
-                pass
-
-            # Create a new user. There's no need to set a password
-            # because only the password from settings.py is checked.
-            user = User(username=username, is_staff=False, is_superuser=False)
-            user.save()
 
-        try:
-            TournamentPlayer.objects.get(discord_user_id=discord_data['id'], osu_user_id=osu_data['id'])
-            logger.info(f"found existing TournamentPlayer {user.tournamentplayer}")
-        except TournamentPlayer.DoesNotExist:
-            request_time = datetime.datetime.now(tz=datetime.timezone.utc)
-            if request_time > settings.USER_REGISTRATION_END:
-                time_delta = (request_time - settings.USER_REGISTRATION_END)
-                time_delta = time_delta - datetime.timedelta(microseconds=time_delta.microseconds)
-                raise PermissionDenied(f"User registrations closed {time_delta} ago "
-                                       f"({time_delta.total_seconds():.0f} seconds).")
-            with transaction.atomic():
-                # create tournament player
-                logger.info(f"no TournamentPlayer found, creating for {user}")
-                tournament_team, _ = TournamentTeam.objects.get_or_create(osu_flag=osu_data['country_code'])
-                tourney_player = TournamentPlayer(user=user,
-                                                  discord_user_id=discord_data['id'],
-                                                  discord_username=discord_data['composite_username'],
-                                                  discord_global_name=discord_data.get('global_name', None),
-                                                  discord_avatar=discord_data.get('avatar', None),
-                                                  osu_user_id=osu_data['id'],
-                                                  osu_username=osu_data['username'],
-                                                  osu_flag=osu_data['country_code'],
-                                                  team=tournament_team,
-                                                  # global_rank can be null, but I'm not sure if global_rank is
-                                                  # always present
-                                                  osu_rank_std=osu_data['statistics'].get('global_rank', None),
-                                                  osu_stats_updated=datetime.datetime.now(datetime.timezone.utc))
-
-                # save user badges
-                all_badges, db_badges = prep_badges_for_db(osu_data, tourney_player)
-
-                TournamentPlayerBadge.objects.bulk_create(db_badges)
-
-                # filter again to filter by cutoff date, calculate BWS
-                tourney_player.osu_rank_std_bws = bws(len(filter_badges(all_badges)),
-                                                      tourney_player.osu_rank_std)
-                tourney_player.save()
-
-                channel_layer = get_channel_layer()
-                # noinspection PyArgumentList
-                async_to_sync(channel_layer.group_send)(
-                    settings.CHANNELS_DISCORD_WS_GROUP_NAME,
-                    {
-                        "type": "registration.new",
-                        "message": json.dumps({"discord_user_id": tourney_player.discord_user_id,
-                                               "osu_user_id": tourney_player.osu_user_id,
-                                               "osu_username": tourney_player.osu_username,
-                                               "osu_global_rank": tourney_player.osu_rank_std,
-                                               "osu_global_rank_bws": tourney_player.osu_rank_std_bws,
-                                               "osu_flag": tourney_player.osu_flag,
-                                               "is_organizer": tourney_player.is_organizer,
-                                               "action": "register"})
-                    })
+        # check both user and TournamentPlayer exist
+        user = User.objects.select_related('tournamentplayer').filter(username=username).first()
+        if user is not None and hasattr(user, 'tournamentplayer'):
+            logger.info(f"successfully authenticated user {user.tournamentplayer}")
+            return user
+
+        if user is None:
+            # found existing TournamentPlayer with different discord id
+            tournament_player = (TournamentPlayer.objects.select_related('user')
+                                 .filter(osu_user_id=osu_data['id'])
+                                 .first())
+            if tournament_player is not None:
+                return self.switch_discord_account(tournament_player, discord_data, username)
+
+        request_time = datetime.datetime.now(tz=datetime.timezone.utc)
+        if request_time > settings.USER_REGISTRATION_END:
+            time_delta = (request_time - settings.USER_REGISTRATION_END)
+            time_delta = time_delta - datetime.timedelta(microseconds=time_delta.microseconds)
+            raise PermissionDenied(f"User registrations closed {time_delta} ago "
+                                   f"({time_delta.total_seconds():.0f} seconds).")
+
+        with transaction.atomic():
+            if user is None:
+                # Create a new user. There's no need to set a password
+                # because only the password from settings.py is checked.
+                user = User.objects.create(username=username, is_staff=False, is_superuser=False)
+
+            # create tournament player
+            logger.info(f"no TournamentPlayer found, creating for {user}")
+            TournamentTeam.objects.bulk_create([TournamentTeam(osu_flag=osu_data['country_code'])],
+                                               ignore_conflicts=True)
+            tourney_player = TournamentPlayer(user=user,
+                                              discord_user_id=discord_data['id'],
+                                              discord_username=discord_data['composite_username'],
+                                              discord_global_name=discord_data.get('global_name', None),
+                                              discord_avatar=discord_data.get('avatar', None),
+                                              osu_user_id=osu_data['id'],
+                                              osu_username=osu_data['username'],
+                                              osu_flag=osu_data['country_code'],
+                                              team_id=osu_data['country_code'],
+                                              # global_rank can be null, but I'm not sure if global_rank is
+                                              # always present
+                                              osu_rank_std=osu_data['statistics'].get('global_rank', None),
+                                              osu_stats_updated=datetime.datetime.now(datetime.timezone.utc))
+
+            all_badges = filter_badges(osu_data['badges'], cutoff_date=DB_BADGE_CUTOFF_DATE)
+
+            # filter again to filter by cutoff date, calculate BWS
+            tourney_player.osu_rank_std_bws = bws(len(filter_badges(all_badges)),
+                                                  tourney_player.osu_rank_std)
+            # badge rows are written by a background task, BWS is already final
+            tourney_player.badges_pending = bool(all_badges)
+            tourney_player.save(force_insert=True)
+            if all_badges and self.background:
+                transaction.on_commit(lambda: self.queue_badges(tourney_player.pk, all_badges))
+
+            events.enqueue("registration.new", {"discord_user_id": tourney_player.discord_user_id,
+                                                "osu_user_id": tourney_player.osu_user_id,
+                                                "osu_username": tourney_player.osu_username,
+                                                "osu_global_rank": tourney_player.osu_rank_std,
+                                                "osu_global_rank_bws": tourney_player.osu_rank_std_bws,
+                                                "osu_flag": tourney_player.osu_flag,
+                                                "is_organizer": tourney_player.is_organizer,
+                                                "action": "register"},
+                           wake=self.background)
         logger.info(f"successfully authenticated user {user.tournamentplayer}")
         return user
 
-    def get_user(self, user_id):
+    @staticmethod
+    def queue_badges(player_pk: int, badges: list[dict]):
+        # imported here, userauth.tasks imports this module
+        from userauth.tasks import save_player_badges
         try:
-            return User.objects.get(pk=user_id)
-        except User.DoesNotExist:
-            return None
+            save_player_badges.delay(player_pk, badges)
+        except Exception as e:
+            logger.warning(f"failed to queue badges for {player_pk}, saving them inline: {repr(e)}")
+            save_player_badges(player_pk, badges)
+
+    def switch_discord_account(self, tournament_player: TournamentPlayer, discord_data: dict, username: str):
+        logger.info(f"found user {tournament_player} with  discord id {tournament_player.discord_user_id}. "
+                    f"Updating discord id to {discord_data['id']}")
+        old_discord_id = tournament_player.discord_user_id
+
+        tournament_player.discord_user_id = discord_data['id']
+        tournament_player.discord_username = discord_data['composite_username']
+        tournament_player.user.username = username
+        with transaction.atomic():
+            tournament_player.user.save(update_fields=['username'])
+            tournament_player.save(update_fields=['discord_user_id', 'discord_username'])
+            events.enqueue("registration.discord.switch", {
+                "old_discord_user_id": old_discord_id,
+                "new_discord_user_id": tournament_player.discord_user_id,
+                "action": "discord_switch"
+            }, wake=self.background)
+        logger.info(f"successfully authenticated user {tournament_player}")
+        return tournament_player.user
+
+    def get_user(self, user_id):
+        """
+        Load the session's user joined with their TournamentPlayer, cached for AUTH_PRINCIPAL_CACHE_TTL seconds.
+
+        Permissions and serializers reach request.user.tournamentplayer, so an authenticated request costs one cache
+        read instead of two queries. Only the fields of PRINCIPAL_USER_FIELDS and PRINCIPAL_PLAYER_FIELDS are cached,
+        cached users are rebuilt from them (see principal_user). Cached entries are dropped whenever the user or player
+        is saved or deleted (see userauth.signals), and by views that change players through queryset updates.
+        """
+        if settings.AUTH_PRINCIPAL_CACHE_TTL <= 0:
+            return User.objects.select_related('tournamentplayer').filter(pk=user_id).first()
+
+        key = principal_cache_key(user_id)
+        if (principal := cache.get(key)) is not None:
+            return principal_user(principal)
+        # from the primary even in requests reading the replica: a lagging replica would have the entry just dropped
+        # by invalidate_principals cached again, stale, for the whole TTL
+        user = User.objects.using(DEFAULT_DB_ALIAS).select_related('tournamentplayer').filter(pk=user_id).first()
+        if user is not None:
+            cache.set(key, principal_of(user), timeout=settings.AUTH_PRINCIPAL_CACHE_TTL)
+        return user
+
+
+# what requests read of request.user and request.user.tournamentplayer: no password hash, no profile
+PRINCIPAL_USER_FIELDS = ('pk', 'username', 'is_active', 'is_staff', 'is_superuser')
+PRINCIPAL_PLAYER_FIELDS = ('team_id', 'is_organizer', 'discord_user_id', 'osu_user_id')
+
+
+def principal_of(user: User) -> dict:
+    """
+    The cached principal of `user`, see DiscordAndOsuAuthBackend.get_user.
+    """
+    player = getattr(user, 'tournamentplayer', None)
+    return {'user': {field: getattr(user, field) for field in PRINCIPAL_USER_FIELDS},
+            # verifying the session compares this HMAC of the password, not the password hash itself
+            'session_auth_hash': user.get_session_auth_hash(),
+            'player': None if player is None else {field: getattr(player, field) for field in PRINCIPAL_PLAYER_FIELDS}}
+
+
+def principal_user(principal: dict) -> User:
+    """
+    A User, and their TournamentPlayer if they have one, holding only the fields of a cached principal. Reading others
+    returns their defaults.
+    """
+    user = User(**principal['user'])
+    user._state.adding = False
+    user._state.db = DEFAULT_DB_ALIAS
+    user.get_session_auth_hash = lambda: principal['session_auth_hash']
+    player = None
+    if principal['player'] is not None:
+        player = TournamentPlayer(user_id=user.pk, **principal['player'])
+        player._state.adding = False
+        player._state.db = DEFAULT_DB_ALIAS
+        TournamentPlayer.user.field.set_cached_value(player, user)
+    # None makes user.tournamentplayer raise DoesNotExist without querying, as for a user loaded without a player
+    User.tournamentplayer.related.set_cached_value(user, player)
+    return user
+
+
+def principal_cache_key(user_id) -> str:
+    return f"auth_principal_{user_id}"
+
+
+def invalidate_principals(*user_ids):
+    """
+    Drop cached principals, now and again once the current transaction commits so a request that read the old rows
+    in between can't leave a stale entry behind.
+    :param user_ids: User pks, which are also TournamentPlayer pks
+    """
+    if not user_ids:
+        return
+    keys = [principal_cache_key(user_id) for user_id in user_ids]
+    cache.delete_many(keys)
+    transaction.on_commit(lambda: cache.delete_many(keys))
 
 
 class IsSuperUser(BasePermission):
@@ -0,0 +1,67 @@
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from userauth.models import DisqualifiedUser
+
+
+VERSION_KEY = "disqualified_users_version"
+
+_lock = threading.Lock()
+_loaded_version: str | None = None
+_checked_at = 0.0
+_disqualified_ids: frozenset[int] = frozenset()
+
+
+def _current_version() -> str:
+    version = cache.get(VERSION_KEY)
+    if version is None:  # never set, or lost with the cache
+        cache.add(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def disqualified_ids() -> frozenset[int]:
+    """
+    osu! ids of disqualified users, held in memory by each worker.
+
+    The set is reloaded from the database when the version key in the cache changes, see bump_version. The version is
+    checked at most every DISQUALIFIED_USERS_CHECK_INTERVAL seconds.
+    :return: frozenset of osu! user ids
+    """
+    global _loaded_version, _checked_at, _disqualified_ids
+    now = time.monotonic()
+    if _loaded_version is not None and now - _checked_at < settings.DISQUALIFIED_USERS_CHECK_INTERVAL:
+        return _disqualified_ids
+
+    with _lock:
+        version = _current_version()
+        if version != _loaded_version:
+            _disqualified_ids = frozenset(DisqualifiedUser.objects.values_list('osu_user_id', flat=True))
+            _loaded_version = version
+        _checked_at = now
+    return _disqualified_ids
+
+
+def is_disqualified(osu_user_id) -> bool:
+    return int(osu_user_id) in disqualified_ids()
+
+
+def bump_version():
+    """
+    Make every worker reload the disqualified set, once the current transaction commits.
+    """
+    global _loaded_version
+
+    def bump():
+        global _loaded_version
+        cache.set(VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        _loaded_version = None
+
+    # don't serve the old set in this process while the transaction is still open either
+    _loaded_version = None
+    transaction.on_commit(bump)
@@ -0,0 +1,78 @@
+"""
+Deterministic synthetic discord/osu! profiles for seeding and scale testing.
+
+Profile i depends only on (seed, i), so any range of profiles can be regenerated exactly, e.g. to resume an
+interrupted seed or to log in as a seeded player from a load test.
+"""
+import datetime
+import random
+from typing import Iterator
+
+SYNTHETIC_OSU_ID_OFFSET = 500_000_000
+SYNTHETIC_DISCORD_ID_OFFSET = 600_000_000_000_000_000
+
+# rough share of 5 digit players per country
+COUNTRY_WEIGHTS = {"US": 14, "RU": 8, "DE": 7, "PL": 7, "BR": 6, "FR": 5, "CA": 4, "KR": 4, "JP": 4, "GB": 4,
+                   "CN": 4, "TW": 3, "AU": 3, "ID": 3, "PH": 3, "UA": 3, "CL": 2, "AR": 2, "MX": 2, "TH": 2,
+                   "FI": 2, "SE": 2, "NL": 2, "IT": 2, "ES": 2, "MY": 2, "SG": 1, "NO": 1, "AT": 1, "CZ": 1}
+_COUNTRIES = list(COUNTRY_WEIGHTS)
+_CUMULATIVE_WEIGHTS = [sum(list(COUNTRY_WEIGHTS.values())[:n + 1]) for n in range(len(COUNTRY_WEIGHTS))]
+
+# (description template, weight); the contributor/mapping ones are filtered out of BWS
+BADGE_KINDS = [("osu! World Cup {year} Participant", 3),
+               ("{name} {year} Winner", 6),
+               ("{name} {year} 2nd Place", 3),
+               ("{name} {year} 3rd Place", 2),
+               ("Beatmap Nominator contribution", 1),
+               ("Mapping Contest #{n} Winner", 1),
+               ("Outstanding contribution to osu!", 1)]
+_TOURNAMENT_NAMES = ("Corsace Open", "osu! Taiko World Cup", "Mappool Cup", "Offline Tournament", "Spring Cup",
+                     "Rank Range Cup", "Country Cup", "5WC")
+
+RANK_MIN = 10_000
+RANK_MAX = 99_999
+
+
+def synthetic_badges(rng: random.Random) -> list[dict]:
+    # most registrants have no badge, a few veterans have dozens
+    if rng.random() < 0.8:
+        return []
+    count = min(int(rng.expovariate(1 / 3)) + 1, 50)
+    badges = []
+    for n in range(count):
+        template = rng.choices([kind for kind, _ in BADGE_KINDS], weights=[w for _, w in BADGE_KINDS])[0]
+        year = rng.randint(2013, 2024)
+        awarded_at = datetime.datetime(year, rng.randint(1, 12), rng.randint(1, 28), tzinfo=datetime.timezone.utc)
+        slug = f"synthetic-{year}-{n}"
+        badges.append({"awarded_at": awarded_at.isoformat(),
+                       "description": template.format(year=year, n=n, name=rng.choice(_TOURNAMENT_NAMES)),
+                       "image@2x_url": f"https://assets.ppy.sh/profile-badges/{slug}@2x.png",
+                       "image_url": f"https://assets.ppy.sh/profile-badges/{slug}.png",
+                       "url": ""})
+    return badges
+
+
+def synthetic_profile(i: int, seed: int = 0) -> tuple[dict, dict]:
+    """
+    :param i: profile index, determines the synthetic discord and osu! ids
+    :param seed: selects a different but equally reproducible population
+    :return: (discord user, osu! /me/osu subset) as stored in the session
+    """
+    rng = random.Random(f"{seed}:{i}")
+    discord_data = {"id": str(SYNTHETIC_DISCORD_ID_OFFSET + i),
+                    "username": f"synthetic_{i}",
+                    "discriminator": "0",
+                    "global_name": f"Synthetic {i}" if rng.random() < 0.7 else None,
+                    "avatar": None}
+    osu_data = {"id": SYNTHETIC_OSU_ID_OFFSET + i,
+                "username": f"synthetic_{i}",
+                "country_code": rng.choices(_COUNTRIES, cum_weights=_CUMULATIVE_WEIGHTS)[0],
+                # registrations skew towards the better end of the rank range
+                "statistics": {"global_rank": int(rng.triangular(RANK_MIN, RANK_MAX, RANK_MIN))},
+                "badges": synthetic_badges(rng)}
+    return discord_data, osu_data
+
+
+def synthetic_profiles(count: int, seed: int = 0, start: int = 0) -> Iterator[tuple[dict, dict]]:
+    for i in range(start, start + count):
+        yield synthetic_profile(i, seed)
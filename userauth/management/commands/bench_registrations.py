@@ -0,0 +1,102 @@
+import datetime
+import json
+import logging
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import override_settings
+
+from discord.models import OutboxEvent
+from userauth.authentication import DiscordAndOsuAuthBackend
+
+
+BENCH_OSU_ID_OFFSET = 900_000_000
+BENCH_DISCORD_ID_OFFSET = 800_000_000_000_000_000
+
+
+def bench_profile(i: int, badge_count: int) -> tuple[dict, dict]:
+    discord_data = {"id": str(BENCH_DISCORD_ID_OFFSET + i), "username": f"bench_{i}", "discriminator": "0"}
+    osu_data = {"id": BENCH_OSU_ID_OFFSET + i,
+                "username": f"bench_{i}",
+                "country_code": ("US", "DE", "JP", "KR", "CA", "PL")[i % 6],
+                "statistics": {"global_rank": 1000 + i},
+                "badges": [{"awarded_at": "2023-01-01T00:00:00+00:00",
+                            "description": f"Bench Tournament #{n} Winner",
+                            "image@2x_url": "https://assets.ppy.sh/profile-badges/bench@2x.png",
+                            "image_url": "https://assets.ppy.sh/profile-badges/bench.png",
+                            "url": ""}
+                           for n in range(badge_count)]}
+    return discord_data, osu_data
+
+
+class Command(BaseCommand):
+    help = ("Measures sustained registrations and returning logins per second through "
+            "DiscordAndOsuAuthBackend.authenticate against the configured database. "
+            "Badge rows are written by a celery task and not measured. Production runs MySQL: take numbers with "
+            "settings whose DATABASES point at a MySQL server, SQLite serializes writes. "
+            "Creates and then deletes synthetic players, do not run against production.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("count", default=500, type=int, nargs='?')
+        parser.add_argument("--threads", default=1, type=int,
+                            help="concurrent logins, each with its own database connection")
+        parser.add_argument("--badges", default=3, type=int, help="badges per synthetic player")
+        parser.add_argument("--keep", action='store_true', help="don't delete the synthetic players afterwards")
+
+    def handle(self, *args, **options):
+        if options['count'] < 1 or options['threads'] < 1:
+            raise CommandError("count and --threads must be positive")
+        profiles = [bench_profile(i, options['badges']) for i in range(options['count'])]
+        if User.objects.filter(username__in=[f"{d['id']}.{o['id']}" for d, o in profiles[:1]]).exists():
+            raise CommandError("synthetic players from a previous run still exist, delete them first")
+
+        last_outbox_pk = OutboxEvent.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        registration_end = datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(days=1)
+        logging.getLogger("userauth.authentication").setLevel(logging.WARNING)
+        with override_settings(USER_REGISTRATION_END=registration_end):
+            try:
+                for phase in ("register", "login"):
+                    elapsed, latencies = self.run_phase(profiles, options['threads'])
+                    self.report(phase, elapsed, latencies)
+            finally:
+                if not options['keep']:
+                    User.objects.filter(username__in=[f"{d['id']}.{o['id']}" for d, o in profiles]).delete()
+                    bench_events = [pk for pk, message
+                                    in OutboxEvent.objects.filter(pk__gt=last_outbox_pk).values_list('pk', 'message')
+                                    if json.loads(message).get("osu_user_id", 0) >= BENCH_OSU_ID_OFFSET]
+                    OutboxEvent.objects.filter(pk__in=bench_events).delete()
+
+    @staticmethod
+    def login_all(profiles: list[tuple[dict, dict]]) -> list[float]:
+        # keeps synthetic registrations off the websocket feed and their badges out of the celery queue
+        backend = DiscordAndOsuAuthBackend(background=False)
+        latencies = []
+        try:
+            for discord_data, osu_data in profiles:
+                start_time = time.perf_counter()
+                if backend.authenticate(None, discord_user_data=discord_data, osu_user_data=osu_data) is None:
+                    raise CommandError(f"failed to authenticate {discord_data['id']}:{osu_data['id']}")
+                latencies.append(time.perf_counter() - start_time)
+        finally:
+            connection.close()
+        return latencies
+
+    def run_phase(self, profiles: list[tuple[dict, dict]], threads: int) -> tuple[float, list[float]]:
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = executor.map(self.login_all, [profiles[i::threads] for i in range(threads)])
+            latencies = [latency for thread_latencies in results for latency in thread_latencies]
+        return time.perf_counter() - start_time, latencies
+
+    def report(self, phase: str, elapsed: float, latencies: list[float]):
+        quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        self.stdout.write(
+            self.style.SUCCESS(f"{phase}: {len(latencies)} in {elapsed:.3f}s ({len(latencies) / elapsed:.1f}/s), "
+                               f"p50 {quantiles[49] * 1000:.2f}ms, "
+                               f"p95 {quantiles[94] * 1000:.2f}ms, "
+                               f"p99 {quantiles[98] * 1000:.2f}ms")
+        )
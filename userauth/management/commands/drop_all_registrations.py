@@ -1,23 +1,109 @@
-from django.core.management.base import BaseCommand, CommandError
-from userauth.models import TournamentPlayer
+import time
+
+from django.conf import settings
+from django.contrib.admin.models import LogEntry
 from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, models, transaction
+
+from teammgmt.models import TournamentTeam
+from userauth.authentication import invalidate_principals
+from userauth.models import TournamentPlayer, TournamentPlayerBadge
 
 import string
 import random
 
 
+def delete_in(cursor, model: type[models.Model], column: str, pks: list) -> int:
+    """
+    DELETE rows of `model` whose `column` is in `pks`, without Django's cascade collector or signals.
+    :return: number of rows deleted
+    """
+    cursor.execute(f"DELETE FROM {connection.ops.quote_name(model._meta.db_table)} "
+                   f"WHERE {connection.ops.quote_name(column)} IN ({', '.join(['%s'] * len(pks))})",
+                   pks)
+    return cursor.rowcount
+
+
 class Command(BaseCommand):
-    help = "Deletes all registrations from database"
+    help = ("Deletes all registrations from database, in pk order and in chunks of one transaction each. "
+            "An interrupted run can be resumed by running the command again")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", default=1000, type=int, help="players deleted per transaction")
+        parser.add_argument("--noinput", "--no-input", action='store_false', dest='interactive',
+                            help="don't ask for the confirmation code")
 
     def handle(self, *args, **options):
-        confirmation_code = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(6))
-        self.stdout.write(f"Please enter confirmation code {confirmation_code} to proceed: ", ending="")
-        user_input = input()
-        if user_input != confirmation_code:
-            raise CommandError("Confirmation code did not match, please try again...")
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size must be positive")
+        if options['interactive']:
+            confirmation_code = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(6))
+            self.stdout.write(f"Please enter confirmation code {confirmation_code} to proceed: ", ending="")
+            user_input = input()
+            if user_input != confirmation_code:
+                raise CommandError("Confirmation code did not match, please try again...")
 
-        User.objects.filter(tournamentplayer__in=TournamentPlayer.objects.all()).delete()
+        total = TournamentPlayer.objects.count()
+        self.stdout.write(
+            self.style.NOTICE(f"deleting all registrations ({total} players)")
+        )
+        start_time = time.perf_counter()
+        deleted = 0
+        while pks := list(TournamentPlayer.objects.order_by('pk').values_list('pk', flat=True)[:options['chunk_size']]):
+            badges = self.delete_chunk(pks)
+            deleted += len(pks)
+            elapsed = time.perf_counter() - start_time
+            self.stdout.write(f"[{deleted}/{total}] deleted players up to pk {pks[-1]} with {badges} badges "
+                              f"({deleted / elapsed:.0f} players/s)")
 
+        sessions = self.delete_orphaned_sessions(options['chunk_size'])
         self.stdout.write(
-            self.style.NOTICE(f"deleting all registrations")
+            self.style.SUCCESS(f"deleted {deleted} registrations and {sessions} sessions "
+                               f"in {time.perf_counter() - start_time:.3f}s")
         )
+
+    @staticmethod
+    def delete_chunk(pks: list[int]) -> int:
+        """
+        Delete players and their users, children first, as the cascade would.
+        :return: number of badges deleted
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            teams = set(TournamentPlayer.objects.filter(pk__in=pks).values_list('team_id', flat=True))
+            badges = delete_in(cursor, TournamentPlayerBadge, 'user_id', pks)
+            delete_in(cursor, TournamentPlayer, 'user_id', pks)
+            delete_in(cursor, User.groups.through, 'user_id', pks)
+            delete_in(cursor, User.user_permissions.through, 'user_id', pks)
+            delete_in(cursor, LogEntry, 'user_id', pks)
+            delete_in(cursor, User, 'id', pks)
+            # no post_delete signals were sent
+            invalidate_principals(*pks)
+            TournamentTeam.refresh_counters(teams)
+        return badges
+
+    @staticmethod
+    def delete_orphaned_sessions(chunk_size: int) -> int:
+        """
+        Delete database sessions logged in as a user that no longer exists. Sessions in the cache backend simply
+        resolve to an anonymous user.
+        :return: number of sessions deleted
+        """
+        if settings.SESSION_ENGINE not in ("django.contrib.sessions.backends.db",
+                                           "django.contrib.sessions.backends.cached_db"):
+            return 0
+
+        deleted = 0
+        last_key = ""
+        while sessions := list(Session.objects.filter(session_key__gt=last_key)
+                               .order_by('session_key')[:chunk_size]):
+            last_key = sessions[-1].session_key
+            user_ids = {session.session_key: session.get_decoded().get('_auth_user_id') for session in sessions}
+            existing = {str(pk) for pk in User.objects.filter(pk__in=[pk for pk in user_ids.values() if pk])
+                        .values_list('pk', flat=True)}
+            orphaned = [key for key, user_id in user_ids.items() if user_id is not None and user_id not in existing]
+            if orphaned:
+                with connection.cursor() as cursor:
+                    deleted += delete_in(cursor, Session, 'session_key', orphaned)
+        return deleted
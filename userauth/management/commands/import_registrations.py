@@ -0,0 +1,228 @@
+import datetime
+import itertools
+import json
+import sys
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Prefetch
+from rest_framework import serializers
+
+from teammgmt.models import TournamentTeam
+from userauth.authentication import bws, filter_badges, invalidate_principals
+from userauth.models import TournamentPlayer, TournamentPlayerBadge
+
+
+class ImportedBadgeSerializer(serializers.Serializer):
+    description = serializers.CharField()
+    awarded_at = serializers.DateTimeField()
+    url = serializers.CharField(allow_blank=True, default="")
+    image_url = serializers.CharField()
+    image_url_2x = serializers.CharField()
+
+
+class ImportedPlayerSerializer(serializers.Serializer):
+    """
+    A line of /registrants/export/?output=ndjson. The exporting instance's user_id is ignored, players are matched as
+    authenticate matches them: on their "<discord id>.<osu! id>" username, else on their osu! id.
+    """
+    discord_user_id = serializers.CharField(max_length=20)
+    discord_username = serializers.CharField(max_length=64)
+    discord_global_name = serializers.CharField(max_length=64, allow_null=True, default=None)
+    discord_avatar = serializers.CharField(max_length=64, allow_null=True, default=None)
+    osu_user_id = serializers.IntegerField()
+    osu_username = serializers.CharField(max_length=64)
+    osu_flag = serializers.CharField(max_length=4)
+    osu_stats_updated = serializers.DateTimeField()
+    rank_standard = serializers.IntegerField(allow_null=True, default=None)
+    is_organizer = serializers.BooleanField(default=False)
+    is_captain = serializers.BooleanField(default=False)
+    in_roster = serializers.BooleanField(default=False)
+    in_backup_roster = serializers.BooleanField(default=False)
+    team_id = serializers.CharField(max_length=4, allow_null=True, default=None)
+    badges_pending = serializers.BooleanField(default=False)
+    badges = ImportedBadgeSerializer(many=True, default=list)
+
+    def validate(self, attrs):
+        # TournamentPlayer's check constraints, which would otherwise fail the whole chunk
+        if attrs['in_roster'] and attrs['in_backup_roster']:
+            raise serializers.ValidationError("in both the roster and the backup roster")
+        if attrs['is_captain'] and not attrs['in_roster']:
+            raise serializers.ValidationError("captain but not in the roster")
+        if attrs['team_id'] is None:
+            attrs['team_id'] = attrs['osu_flag']
+        return attrs
+
+
+# upserted columns, osu_rank_std_bws is rebuilt from the badges once everything is imported
+PLAYER_UPDATE_FIELDS = ['discord_user_id', 'discord_username', 'discord_global_name', 'discord_avatar',
+                        'osu_user_id', 'osu_username', 'osu_flag', 'osu_rank_std', 'osu_stats_updated',
+                        'badges_pending', 'is_organizer', 'is_captain', 'team', 'in_roster', 'in_backup_roster']
+
+
+class Command(BaseCommand):
+    help = ("Imports players and their badges from an NDJSON file written by /registrants/export/, e.g. to move "
+            "registrations between tournament instances. Export with ?badge_cutoff_date=0 to keep every badge. "
+            "Existing players are updated and their badges replaced, so an interrupted import can be repeated. "
+            "No websocket events are sent")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="NDJSON file to import, - for stdin")
+        parser.add_argument("--chunk-size", default=1000, type=int,
+                            help="players validated and upserted per transaction")
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size must be positive")
+        try:
+            infile = sys.stdin if options['path'] == "-" else open(options['path'], "r", encoding="utf-8")
+        except OSError as e:
+            raise CommandError(f"Can't read '{options['path']}': {e}")
+
+        self.stdout.write(self.style.NOTICE(f"importing registrations from {options['path']}"))
+        start_time = time.perf_counter()
+        imported_pks = []
+        created = updated = invalid = 0
+        with infile:
+            lines = ((number, line) for number, line in enumerate(infile, start=1) if line.strip())
+            while chunk := list(itertools.islice(lines, options['chunk_size'])):
+                rows, errors = self.validate_chunk(chunk)
+                pks, chunk_created, conflicts = self.upsert_chunk(rows)
+                for number, error in sorted(errors + conflicts):
+                    self.stderr.write(f"line {number}: {error}")
+                invalid += len(errors) + len(conflicts)
+                imported_pks.extend(pks)
+                created += chunk_created
+                updated += len(pks) - chunk_created
+                elapsed = time.perf_counter() - start_time
+                self.stdout.write(f"[{chunk[-1][0]} lines] {created} created, {updated} updated, {invalid} invalid "
+                                  f"({(created + updated) / elapsed:.0f} players/s)")
+
+        self.stdout.write(self.style.NOTICE(f"rebuilding BWS of {len(imported_pks)} players"))
+        for i in range(0, len(imported_pks), options['chunk_size']):
+            self.rebuild_bws(imported_pks[i:i + options['chunk_size']])
+
+        elapsed = time.perf_counter() - start_time
+        self.stdout.write(
+            self.style.SUCCESS(f"Imported {created + updated} registrations ({created} created, {updated} updated, "
+                               f"{invalid} invalid) in {elapsed:.3f}s "
+                               f"({(created + updated) / elapsed:.0f} players/s)")
+        )
+
+    @staticmethod
+    def validate_chunk(chunk: list[tuple[int, str]]) -> tuple[dict[str, dict], list[tuple[int, str]]]:
+        """
+        :param chunk: line numbers and lines
+        :return: valid rows by username with their line number under "line", the last row of an osu! id appearing more
+            than once winning, and the line numbers and errors of invalid ones
+        """
+        rows = {}
+        errors = []
+        for number, line in chunk:
+            try:
+                serializer = ImportedPlayerSerializer(data=json.loads(line))
+            except json.JSONDecodeError as e:
+                errors.append((number, f"invalid JSON: {e}"))
+                continue
+            if not serializer.is_valid():
+                errors.append((number, json.dumps(serializer.errors)))
+                continue
+            row = serializer.validated_data
+            row['line'] = number
+            rows[row['osu_user_id']] = row
+        return {f"{row['discord_user_id']}.{row['osu_user_id']}": row for row in rows.values()}, errors
+
+    @staticmethod
+    def upsert_chunk(rows: dict[str, dict]) -> tuple[list[int], int, list[tuple[int, str]]]:
+        """
+        Insert or update the players of `rows` with one bulk query per table, replacing their badges.
+
+        A player already registered with the osu! id of a row under another discord account is moved to the row's
+        username, as switch_discord_account moves them when they log in, unless a user already has that username.
+        :return: pks of the players upserted, number of them created, and the line numbers and errors of rows that
+            conflict with existing users
+        """
+        if not rows:
+            return [], 0, []
+        conflicts = []
+        with transaction.atomic():
+            registered = {osu_user_id: (pk, username) for pk, osu_user_id, username in
+                          TournamentPlayer.objects.filter(osu_user_id__in=[row['osu_user_id'] for row in rows.values()])
+                          .values_list('pk', 'osu_user_id', 'user__username')}
+            switched = {username: registered[row['osu_user_id']] for username, row in rows.items()
+                        if row['osu_user_id'] in registered and registered[row['osu_user_id']][1] != username}
+            for username in User.objects.filter(username__in=switched).values_list('username', flat=True):
+                row = rows.pop(username)
+                conflicts.append((row['line'], f"osu! id {row['osu_user_id']} is registered as "
+                                               f"{switched.pop(username)[1]}, but user {username} already exists"))
+            User.objects.bulk_update([User(pk=pk, username=username) for username, (pk, _) in switched.items()],
+                                     ['username'])
+
+            TournamentTeam.objects.bulk_create([TournamentTeam(osu_flag=flag)
+                                                for flag in {row['team_id'] for row in rows.values()}],
+                                               ignore_conflicts=True)
+            User.objects.bulk_create([User(username=username, is_staff=False, is_superuser=False)
+                                      for username in rows], ignore_conflicts=True)
+            # MySQL doesn't return the inserted pks
+            user_pks = dict(User.objects.filter(username__in=rows).values_list('username', 'pk'))
+            # teams players are moved out of need recounting too
+            previous_teams = dict(TournamentPlayer.objects.filter(pk__in=user_pks.values())
+                                  .values_list('pk', 'team_id'))
+
+            players = [TournamentPlayer(user_id=user_pks[username],
+                                        discord_user_id=row['discord_user_id'],
+                                        discord_username=row['discord_username'],
+                                        discord_global_name=row['discord_global_name'],
+                                        discord_avatar=row['discord_avatar'],
+                                        osu_user_id=row['osu_user_id'],
+                                        osu_username=row['osu_username'],
+                                        osu_flag=row['osu_flag'],
+                                        osu_rank_std=row['rank_standard'],
+                                        osu_stats_updated=row['osu_stats_updated'],
+                                        badges_pending=row['badges_pending'],
+                                        is_organizer=row['is_organizer'],
+                                        is_captain=row['is_captain'],
+                                        team_id=row['team_id'],
+                                        in_roster=row['in_roster'],
+                                        in_backup_roster=row['in_backup_roster'])
+                       for username, row in rows.items()]
+            # MySQL's ON DUPLICATE KEY UPDATE takes no conflict target
+            unique_fields = ['user'] if connection.features.supports_update_conflicts_with_target else None
+            TournamentPlayer.objects.bulk_create(players, update_conflicts=True, unique_fields=unique_fields,
+                                                 update_fields=PLAYER_UPDATE_FIELDS)
+
+            pks = list(user_pks.values())
+            TournamentPlayerBadge.objects.filter(user_id__in=pks).delete()
+            TournamentPlayerBadge.objects.bulk_create([TournamentPlayerBadge(user_id=user_pks[username],
+                                                                             description=badge['description'],
+                                                                             award_date=badge['awarded_at'],
+                                                                             url=badge['url'],
+                                                                             image_url=badge['image_url'],
+                                                                             image_url_2x=badge['image_url_2x'])
+                                                       for username, row in rows.items()
+                                                       for badge in row['badges']])
+
+            # bulk_create skips the signals counting players into their teams and dropping cached principals
+            TournamentTeam.refresh_counters({player.team_id for player in players} | set(previous_teams.values()))
+            invalidate_principals(*previous_teams)
+        return pks, len(pks) - len(previous_teams), conflicts
+
+    @staticmethod
+    def rebuild_bws(pks: list[int]):
+        """
+        Recompute osu_rank_std_bws of players `pks` from their badges, as authenticate computes it.
+        """
+        players = list(TournamentPlayer.objects.filter(pk__in=pks).only('pk', 'osu_rank_std').prefetch_related(
+            Prefetch('tournamentplayerbadge_set',
+                     queryset=TournamentPlayerBadge.objects.only('user_id', 'description', 'award_date'))
+        ))
+        for player in players:
+            badges = [{'description': badge.description,
+                       'awarded_at': datetime.datetime.isoformat(badge.award_date)}
+                      for badge in player.tournamentplayerbadge_set.all()]
+            player.osu_rank_std_bws = (None if player.osu_rank_std is None
+                                       else bws(len(filter_badges(badges)), player.osu_rank_std))
+        with transaction.atomic():
+            TournamentPlayer.objects.bulk_update(players, ['osu_rank_std_bws'])
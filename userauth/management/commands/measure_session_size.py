@@ -0,0 +1,101 @@
+import json
+import pickle
+
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand
+
+from userauth.authentication import compact_discord_user, compact_osu_profile
+
+
+def sample_osu_profile(badge_count: int = 12) -> dict:
+    """
+    /me/osu response shaped like a typical tournament player's, for when no real profile is given.
+    """
+    return {
+        "avatar_url": "https://a.ppy.sh/2155578?1700000000.jpeg", "country_code": "CA", "default_group": "default",
+        "id": 2155578, "is_active": True, "is_bot": False, "is_deleted": False, "is_online": True,
+        "is_supporter": True, "last_visit": "2024-01-20T18:00:00+00:00", "pm_friends_only": False,
+        "profile_colour": None, "username": "Azer", "cover_url": "https://assets.ppy.sh/user-profile-covers/x.jpeg",
+        "discord": "azer", "has_supported": True, "interests": None, "join_date": "2012-12-24T20:00:00+00:00",
+        "location": "Canada", "max_blocks": 100, "max_friends": 500, "occupation": None, "playmode": "osu",
+        "playstyle": ["mouse", "keyboard", "tablet"], "post_count": 1234, "profile_hue": None,
+        "profile_order": ["me", "recent_activity", "top_ranks", "medals", "historical", "beatmaps", "kudosu"],
+        "title": None, "title_url": None, "twitter": "azer", "website": None,
+        "country": {"code": "CA", "name": "Canada"},
+        "cover": {"custom_url": "https://assets.ppy.sh/user-profile-covers/x.jpeg",
+                  "url": "https://assets.ppy.sh/user-profile-covers/x.jpeg", "id": None},
+        "kudosu": {"available": 10, "total": 10},
+        "account_history": [], "active_tournament_banner": None, "active_tournament_banners": [],
+        "badges": [{"awarded_at": f"20{10 + n % 14}-0{1 + n % 9}-01T00:00:00+00:00",
+                    "description": ("osu! World Cup", "Beatmap Nominator contribution", "Mapping Contest")[n % 3]
+                    + f" #{n} Winner",
+                    "image@2x_url": f"https://assets.ppy.sh/profile-badges/badge-{n}@2x.png",
+                    "image_url": f"https://assets.ppy.sh/profile-badges/badge-{n}.png",
+                    "url": f"https://osu.ppy.sh/wiki/en/Tournaments/{n}"}
+                   for n in range(badge_count)],
+        "beatmap_playcounts_count": 8000, "comments_count": 50, "favourite_beatmapset_count": 300,
+        "follower_count": 20000, "graveyard_beatmapset_count": 3, "groups": [],
+        "guest_beatmapset_count": 0, "loved_beatmapset_count": 0, "mapping_follower_count": 10,
+        "monthly_playcounts": [{"start_date": f"{2013 + n // 12}-{1 + n % 12:02}-01", "count": 1000 + n}
+                               for n in range(130)],
+        "nominated_beatmapset_count": 0,
+        "page": {"html": "<div class='bbcode'>" + "hello " * 200 + "</div>", "raw": "hello " * 200},
+        "pending_beatmapset_count": 0, "previous_usernames": ["azer_old"],
+        "rank_highest": {"rank": 1, "updated_at": "2019-01-01T00:00:00Z"},
+        "ranked_beatmapset_count": 0,
+        "replays_watched_counts": [{"start_date": f"{2013 + n // 12}-{1 + n % 12:02}-01", "count": 50 + n}
+                                   for n in range(130)],
+        "scores_best_count": 100, "scores_first_count": 500, "scores_pinned_count": 5, "scores_recent_count": 0,
+        "statistics": {"count_100": 2000000, "count_300": 20000000, "count_50": 100000, "count_miss": 300000,
+                       "level": {"current": 102, "progress": 50}, "global_rank": 1292, "global_rank_exp": None,
+                       "pp": 12000.5, "pp_exp": 0, "ranked_score": 100000000000, "hit_accuracy": 98.9,
+                       "play_count": 150000, "play_time": 10000000, "total_score": 500000000000,
+                       "total_hits": 22400000, "maximum_combo": 5000, "replays_watched_by_others": 100000,
+                       "is_ranked": True, "grade_counts": {"ss": 100, "ssh": 2000, "s": 300, "sh": 5000, "a": 3000},
+                       "country_rank": 50, "rank": {"country": 50}},
+        "support_level": 3,
+        "user_achievements": [{"achieved_at": "2020-01-01T00:00:00+00:00", "achievement_id": n} for n in range(250)],
+        "rank_history": {"mode": "osu", "data": [1292 + n for n in range(90)]},
+        "rankHistory": {"mode": "osu", "data": [1292 + n for n in range(90)]},
+        "ranked_and_approved_beatmapset_count": 0, "unranked_beatmapset_count": 0,
+    }
+
+
+def sample_discord_user() -> dict:
+    return {"id": "109274120794127402", "username": "james", "avatar": "8342729096ea3675442027381ff50dfe",
+            "discriminator": "0", "public_flags": 64, "premium_type": 2, "flags": 64, "banner": None,
+            "accent_color": 2105893, "global_name": "James", "avatar_decoration_data": None,
+            "banner_color": "#202225", "mfa_enabled": True, "locale": "en-US"}
+
+
+class Command(BaseCommand):
+    help = ("Compares the size of the OAuth session payload with the full osu!/discord profiles "
+            "against the compact one the callbacks store.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--osu-profile", help="path to a saved /me/osu response, defaults to a sample profile")
+        parser.add_argument("--discord-user", help="path to a saved discord user, defaults to a sample user")
+        parser.add_argument("--badges", default=12, type=int, help="badges on the sample osu! profile")
+
+    def handle(self, *args, **options):
+        osu_profile = sample_osu_profile(options['badges'])
+        if options['osu_profile']:
+            with open(options['osu_profile']) as f:
+                osu_profile = json.load(f)
+        discord_user = sample_discord_user()
+        if options['discord_user']:
+            with open(options['discord_user']) as f:
+                discord_user = json.load(f)
+
+        full = {"osu_user_data": osu_profile, "discord_user_data": discord_user}
+        compact = {"osu_user_data": compact_osu_profile(osu_profile),
+                   "discord_user_data": compact_discord_user(discord_user)}
+        for encoding, size in (("json", lambda data: len(json.dumps(data))),
+                               # what the db and cached_db backends store in django_session.session_data
+                               ("db session_data", lambda data: len(SessionStore().encode(data))),
+                               # the cache backend stores the session dict pickled by django-redis
+                               ("cache pickle", lambda data: len(pickle.dumps(data, pickle.HIGHEST_PROTOCOL)))):
+            full_size, compact_size = size(full), size(compact)
+            self.stdout.write(self.style.SUCCESS(
+                f"{encoding}: {full_size} -> {compact_size} bytes ({1 - compact_size / full_size:.1%} smaller)"
+            ))
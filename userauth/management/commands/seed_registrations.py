@@ -1,12 +1,20 @@
+import datetime
+import itertools
 import json
 import random
 
 from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 import pathlib
 import time
 from django.contrib.auth import authenticate
 
+from discord import events
+from teammgmt.models import TournamentTeam
+from userauth.authentication import DB_BADGE_CUTOFF_DATE, DiscordAndOsuAuthBackend, bws, filter_badges
+from userauth.management.commands._synthetic import synthetic_profiles
+from userauth.models import TournamentPlayer, TournamentPlayerBadge
 from userauth.views import login_signal
 
 
@@ -16,6 +24,14 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument("count", default=100, type=int, nargs='?')
         parser.add_argument("--shuffle", action='store_true')
+        parser.add_argument("--synthetic", action='store_true',
+                            help="generate profiles instead of reading _guild_data.json and _osu_data.json")
+        parser.add_argument("--seed", default=0, type=int, help="synthetic population to generate")
+        parser.add_argument("--start", default=0, type=int, help="index of the first synthetic profile")
+        parser.add_argument("--bulk", action='store_true',
+                            help="insert with bulk_create in chunks, skipping authenticate and websocket events. "
+                                 "Players that already exist are skipped, so an interrupted run can be repeated")
+        parser.add_argument("--chunk-size", default=2000, type=int, help="players per transaction with --bulk")
 
     def handle(self, *args, **options):
         self.stdout.write(
@@ -23,15 +39,27 @@ class Command(BaseCommand):
         )
         start_time = time.perf_counter()
 
-        discord_data = self.load_data_file("_guild_data.json", options)
-        osu_data = self.load_data_file("_osu_data.json", options)
+        if options['synthetic']:
+            profiles = synthetic_profiles(options['count'], options['seed'], options['start'])
+        else:
+            discord_data = self.load_data_file("_guild_data.json", options)
+            osu_data = self.load_data_file("_osu_data.json", options)
+            profiles = zip(discord_data[:options['count']], osu_data[:options['count']])
 
-        for i in range(options['count']):
-            # todo: manually create users instead of relying on `authenticate`?
-            # todo: use [bulk_create](https://docs.djangoproject.com/en/4.2/ref/models/querysets/#bulk-create)
-            user: User = authenticate(None, **{"discord_user_data": discord_data[i], "osu_user_data": osu_data[i]})
+        if options['bulk']:
+            if options['chunk_size'] < 1:
+                raise CommandError("--chunk-size must be positive")
+            created = self.bulk_seed(profiles, options['count'], options['chunk_size'])
+            self.stdout.write(
+                self.style.SUCCESS(f"Seeded {created} registrations in {time.perf_counter() - start_time:.3f}s "
+                                   f"({options['count'] - created} already existed)")
+            )
+            return
+
+        for i, (discord_user_data, osu_user_data) in enumerate(profiles):
+            user: User = authenticate(None, **{"discord_user_data": discord_user_data, "osu_user_data": osu_user_data})
             if user is None:
-                raise CommandError(f"failed to register user with {discord_data[i]} and {osu_data[i]}")
+                raise CommandError(f"failed to register user with {discord_user_data} and {osu_user_data}")
             # noinspection PyUnresolvedReferences
             login_signal.send("login",
                               payload={"user_id": user.tournamentplayer.discord_user_id,
@@ -39,12 +67,82 @@ class Command(BaseCommand):
                                        "action": "register"})
             self.stdout.write(
                 self.style.SUCCESS(f"[{i+1}/{options['count']}] "
-                                   f"Created user {discord_data[i]['id']}:{osu_data[i]['id']}")
+                                   f"Created user {discord_user_data['id']}:{osu_user_data['id']}")
             )
+        # the drainer thread enqueue woke dies with the command, send whatever it hasn't yet
+        events.drain_outbox(wait=events.OUTBOX_DRAIN_LOCK_TIMEOUT)
         self.stdout.write(
             self.style.SUCCESS(f"Seeded {options['count']} registrations in {time.perf_counter() - start_time:.3f}s")
         )
 
+    def bulk_seed(self, profiles, count: int, chunk_size: int) -> int:
+        created = 0
+        done = 0
+        profiles = iter(profiles)
+        while chunk := list(itertools.islice(profiles, chunk_size)):
+            created += self.bulk_create_chunk(chunk)
+            done += len(chunk)
+            self.stdout.write(self.style.SUCCESS(f"[{done}/{count}] {created} created"))
+        return created
+
+    @staticmethod
+    def bulk_create_chunk(chunk: list[tuple[dict, dict]]) -> int:
+        """
+        Registers a chunk of players with one bulk insert per table, as authenticate would register them one by one.
+        :return: number of players created
+        """
+        validated = {}
+        for discord_user_data, osu_user_data in chunk:
+            discord_data, osu_data = DiscordAndOsuAuthBackend.validate_data(discord_user_data, osu_user_data)
+            if discord_data is None or osu_data is None:
+                raise CommandError(f"failed to register user with {discord_user_data} and {osu_user_data}")
+            validated[f"{discord_data['id']}.{osu_data['id']}"] = discord_data, osu_data
+
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        with transaction.atomic():
+            existing = set(User.objects.filter(username__in=validated).values_list('username', flat=True))
+            validated = {username: data for username, data in validated.items() if username not in existing}
+            if not validated:
+                return 0
+
+            TournamentTeam.objects.bulk_create([TournamentTeam(osu_flag=flag)
+                                                for flag in {osu['country_code'] for _, osu in validated.values()}],
+                                               ignore_conflicts=True)
+            User.objects.bulk_create([User(username=username, is_staff=False, is_superuser=False)
+                                      for username in validated])
+            # MySQL doesn't return the inserted pks
+            user_pks = dict(User.objects.filter(username__in=validated).values_list('username', 'pk'))
+
+            players = []
+            badges = []
+            for username, (discord_data, osu_data) in validated.items():
+                all_badges = filter_badges(osu_data['badges'], cutoff_date=DB_BADGE_CUTOFF_DATE)
+                global_rank = osu_data['statistics'].get('global_rank', None)
+                players.append(TournamentPlayer(user_id=user_pks[username],
+                                                discord_user_id=discord_data['id'],
+                                                discord_username=discord_data['composite_username'],
+                                                discord_global_name=discord_data['global_name'],
+                                                discord_avatar=discord_data['avatar'],
+                                                osu_user_id=osu_data['id'],
+                                                osu_username=osu_data['username'],
+                                                osu_flag=osu_data['country_code'],
+                                                team_id=osu_data['country_code'],
+                                                osu_rank_std=global_rank,
+                                                osu_rank_std_bws=bws(len(filter_badges(all_badges)), global_rank),
+                                                osu_stats_updated=now))
+                badges.extend(TournamentPlayerBadge(user_id=user_pks[username],
+                                                    description=badge['description'],
+                                                    award_date=datetime.datetime.fromisoformat(badge['awarded_at']),
+                                                    url=badge['url'],
+                                                    image_url=badge['image_url'],
+                                                    image_url_2x=badge['image@2x_url'])
+                              for badge in all_badges)
+            TournamentPlayer.objects.bulk_create(players)
+            TournamentPlayerBadge.objects.bulk_create(badges)
+            # bulk_create skips the signals counting players into their teams
+            TournamentTeam.refresh_counters({player.team_id for player in players})
+        return len(players)
+
     @staticmethod
     def load_data_file(filename, options):
         file_dir = pathlib.Path(__file__).parent.resolve()
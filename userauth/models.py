@@ -20,6 +20,7 @@ class TournamentPlayer(models.Model):
     osu_rank_std = models.IntegerField(null=True)
     osu_rank_std_bws = models.IntegerField(null=True)  # global_rank ^ (0.9937 ^ (badge_count ^ 2))
     osu_stats_updated = models.DateTimeField()
+    badges_pending = models.BooleanField(default=False)  # badge rows not yet written by userauth.tasks
 
     is_organizer = models.BooleanField(default=False)
     is_captain = models.BooleanField(default=False)
@@ -30,6 +31,28 @@ class TournamentPlayer(models.Model):
     in_roster = models.BooleanField(default=False)
     in_backup_roster = models.BooleanField(default=False)
 
+    # fields TournamentTeam counts the player by
+    TEAM_COUNTED_FIELDS = ('team_id', 'in_roster', 'in_backup_roster', 'is_captain')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.counted_as = instance.team_counted_as()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        if fields is None or {'team', 'team_id', *self.TEAM_COUNTED_FIELDS} & set(fields):
+            self.counted_as = self.team_counted_as()
+
+    def team_counted_as(self) -> tuple | None:
+        """
+        :return: the player's TEAM_COUNTED_FIELDS values, None if any of them is deferred
+        """
+        if self.get_deferred_fields() & set(self.TEAM_COUNTED_FIELDS):
+            return None
+        return tuple(getattr(self, field) for field in self.TEAM_COUNTED_FIELDS)
+
     def __str__(self):
         return (f"{self.osu_username} ({self.osu_flag}|"
                 f"{self.discord_global_name if self.discord_global_name is not None else self.discord_username})")
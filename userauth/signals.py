@@ -0,0 +1,64 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from teammgmt.models import TournamentTeam
+from userauth import disqualification
+from userauth.authentication import invalidate_principals
+from userauth.models import DisqualifiedUser, TournamentPlayer
+
+
+@receiver([post_save, post_delete], sender=User)
+@receiver([post_save, post_delete], sender=TournamentPlayer)
+def invalidate_cached_principal(sender, instance, **kwargs):
+    # TournamentPlayer's pk is its user's pk
+    invalidate_principals(instance.pk)
+
+
+def count_in_teams(old: tuple | None, new: tuple | None):
+    """
+    Move a player's contribution to the team counters from `old` to `new`, both TournamentPlayer.team_counted_as()
+    values or None when the player didn't or doesn't exist.
+    """
+    if old == new:
+        return
+    if old is not None and new is not None and old[0] == new[0]:
+        team_id, in_roster, in_backup_roster, is_captain = new
+        TournamentTeam.adjust_counters(team_id,
+                                       roster=in_roster - old[1],
+                                       backups=in_backup_roster - old[2],
+                                       recount_captain=is_captain != old[3])
+        return
+    if old is not None:
+        team_id, in_roster, in_backup_roster, is_captain = old
+        TournamentTeam.adjust_counters(team_id, candidates=-1, roster=-in_roster, backups=-in_backup_roster,
+                                       recount_captain=is_captain)
+    if new is not None:
+        team_id, in_roster, in_backup_roster, is_captain = new
+        TournamentTeam.adjust_counters(team_id, candidates=1, roster=in_roster, backups=in_backup_roster,
+                                       recount_captain=is_captain)
+
+
+@receiver(post_save, sender=TournamentPlayer)
+def count_saved_player(sender, instance: TournamentPlayer, created, raw=False, **kwargs):
+    if raw:
+        # loaddata, fixtures come with their counters
+        return
+    old = getattr(instance, 'counted_as', None)
+    if not created and old is None:
+        # saved over an existing row without having loaded it, what it was counted as is unknown
+        TournamentTeam.refresh_counters([instance.team_id])
+    else:
+        count_in_teams(None if created else old, instance.team_counted_as())
+    instance.counted_as = instance.team_counted_as()
+
+
+@receiver(post_delete, sender=TournamentPlayer)
+def count_deleted_player(sender, instance: TournamentPlayer, **kwargs):
+    count_in_teams(getattr(instance, 'counted_as', None) or instance.team_counted_as(), None)
+    instance.counted_as = None
+
+
+@receiver([post_save, post_delete], sender=DisqualifiedUser)
+def reload_disqualified_users(sender, **kwargs):
+    disqualification.bump_version()
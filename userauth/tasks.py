@@ -0,0 +1,40 @@
+import logging
+
+from celery import shared_task
+from django.db import transaction
+
+# the app shared_task binds to, it isn't loaded with Django
+import kfcrebrand.celery  # noqa: F401
+
+from userauth.authentication import invalidate_principals, prep_badges_for_db
+from userauth.models import TournamentPlayer, TournamentPlayerBadge
+
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def save_player_badges(player_pk: int, badges: list[dict]):
+    """
+    Write the badge rows of a newly registered player, queued by DiscordAndOsuAuthBackend.authenticate once the
+    registration commits. BWS was already calculated from the same badges.
+
+    :param player_pk: TournamentPlayer pk
+    :param badges: osu! API badges, as kept in the session
+    :return: None
+    """
+    try:
+        tourney_player = TournamentPlayer.objects.get(pk=player_pk)
+    except TournamentPlayer.DoesNotExist:
+        logger.info(f"[save_player_badges] player {player_pk} deleted before their badges were saved")
+        return
+
+    _, db_badges = prep_badges_for_db({'badges': badges}, tourney_player)
+    with transaction.atomic():
+        # replace rather than add so a retried task doesn't duplicate badges
+        TournamentPlayerBadge.objects.filter(user=tourney_player).delete()
+        TournamentPlayerBadge.objects.bulk_create(db_badges)
+        TournamentPlayer.objects.filter(pk=player_pk).update(badges_pending=False)
+        # queryset update skips the post_save signal
+        invalidate_principals(player_pk)
+    logger.info(f"[save_player_badges] saved {len(db_badges)} badges for {tourney_player}")
@@ -1,15 +1,35 @@
 import datetime
+import io
+import json
+import os
+import tempfile
+from unittest.mock import patch
 
+import httpx
 from django.conf import settings
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import AsyncRequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
 from parameterized import parameterized
 from rest_framework.exceptions import PermissionDenied
 
-from userauth.authentication import filter_badges, bws, DiscordAndOsuAuthBackend
-from rest_framework.test import APIRequestFactory
+from discord.models import OutboxEvent
+from teammgmt.models import TournamentTeam
+from userauth.authentication import (filter_badges, bws, compact_discord_user, compact_osu_profile,
+                                     parked_profile_key, principal_cache_key, DiscordAndOsuAuthBackend)
+from rest_framework.test import APIClient, APIRequestFactory
 from django.contrib.auth import authenticate
 
-from userauth.models import DisqualifiedUser
+from userauth.models import DisqualifiedUser, TournamentPlayer, TournamentPlayerBadge
+from userauth.tasks import save_player_badges
+from userauth import disqualification, views
+from userauth.management.commands import drop_all_registrations
+from userauth.management.commands._synthetic import synthetic_profile, synthetic_profiles
 from userauth.views import DiscordAuth, OsuAuth, SessionDetails
 
 
@@ -31,6 +51,7 @@ class DiscordAndOsuLoginTestCase(TestCase):
     def setUp(self):
         settings.USER_REGISTRATION_END = (datetime.datetime.now(tz=datetime.timezone.utc) +
                                           datetime.timedelta(days=2))
+        disqualification.bump_version()  # rolled back rows don't send post_delete
 
     @parameterized.expand([
         ({}, {}),
@@ -802,3 +823,634 @@ class BadgeFilterTestCase(TestCase):
         else:
             filtered_badges = filter_badges(badges, [], cutoff_date=cutoff_date)
         self.assertCountEqual(filtered_badges, expected)
+
+
+class RegistrationEventOutboxTestCase(TestCase):
+    """
+    Registration events are written to the outbox in the same transaction as the change, not sent inline.
+    """
+    valid_discord_data = {"id": "0", "username": "0", "discriminator": "0"}
+    valid_osu_data = {
+        'id': 2155578,
+        'username': 'Azer',
+        'country_code': 'CA',
+        'statistics': {"global_rank": 1292},
+        'badges': []
+    }
+
+    def setUp(self):
+        settings.USER_REGISTRATION_END = (datetime.datetime.now(tz=datetime.timezone.utc) +
+                                          datetime.timedelta(days=2))
+
+    def test_register_queues_event(self):
+        with patch("discord.events._group_send") as group_send:
+            user = authenticate(None, discord_user_data=self.valid_discord_data, osu_user_data=self.valid_osu_data)
+        self.assertIsNotNone(user)
+        self.assertEqual(0, group_send.call_count)
+
+        event = OutboxEvent.objects.get()
+        self.assertEqual("registration.new", event.event_type)
+        self.assertEqual("register", json.loads(event.message)["action"])
+        self.assertEqual(self.valid_osu_data['id'], json.loads(event.message)["osu_user_id"])
+
+    def test_discord_switch_queues_event(self):
+        authenticate(None, discord_user_data=self.valid_discord_data, osu_user_data=self.valid_osu_data)
+        OutboxEvent.objects.all().delete()
+
+        new_discord_data = {"id": "1", "username": "1", "discriminator": "0"}
+        user = authenticate(None, discord_user_data=new_discord_data, osu_user_data=self.valid_osu_data)
+
+        self.assertEqual("1", user.tournamentplayer.discord_user_id)
+        event = OutboxEvent.objects.get()
+        self.assertEqual("registration.discord.switch", event.event_type)
+        self.assertEqual({"old_discord_user_id": "0", "new_discord_user_id": "1", "action": "discord_switch"},
+                         json.loads(event.message))
+
+    def test_delete_account_queues_event(self):
+        user = authenticate(None, discord_user_data=self.valid_discord_data, osu_user_data=self.valid_osu_data)
+        OutboxEvent.objects.all().delete()
+
+        client = APIClient()
+        client.force_login(user)
+        response = client.delete('/auth/session/delete_account/')
+
+        self.assertEqual(204, response.status_code)
+        self.assertFalse(User.objects.filter(pk=user.pk).exists())
+        self.assertFalse(TournamentPlayer.objects.filter(pk=user.pk).exists())
+        event = OutboxEvent.objects.get()
+        self.assertEqual("registration.delete", event.event_type)
+        self.assertEqual(self.valid_osu_data['id'], json.loads(event.message)["osu_user_id"])
+
+
+class AuthenticateQueryBudgetTestCase(TestCase):
+    """
+    Query budgets documented on DiscordAndOsuAuthBackend.authenticate. Savepoints are not counted since they depend on
+    whether the caller is already in a transaction.
+    """
+    discord_data = {"id": "0", "username": "0", "discriminator": "0"}
+    osu_data = {
+        'id': 2155578,
+        'username': 'Azer',
+        'country_code': 'CA',
+        'statistics': {"global_rank": 1292},
+        'badges': [{"awarded_at": "2020-12-06T19:38:15+00:00",
+                    "description": "osu! World Cup 2020 3rd Place (Canada)",
+                    "image@2x_url": "https://assets.ppy.sh/profile-badges/badge_owc2020_3rd@2x.png",
+                    "image_url": "https://assets.ppy.sh/profile-badges/badge_owc2020_3rd.png",
+                    "url": "https://osu.ppy.sh/wiki/en/Tournaments/OWC/2020"}]
+    }
+
+    def setUp(self):
+        settings.USER_REGISTRATION_END = (datetime.datetime.now(tz=datetime.timezone.utc) +
+                                          datetime.timedelta(days=2))
+
+    def count_queries(self, discord_data, osu_data):
+        with CaptureQueriesContext(connection) as queries:
+            user = authenticate(None, discord_user_data=discord_data, osu_user_data=osu_data)
+        self.assertIsNotNone(user)
+        return len([query for query in queries.captured_queries if 'SAVEPOINT' not in query['sql']])
+
+    def test_new_player_budget(self):
+        self.assertEqual(7, self.count_queries(self.discord_data, self.osu_data))
+
+    def test_new_player_without_badges_budget(self):
+        self.assertEqual(7, self.count_queries(self.discord_data, {**self.osu_data, 'badges': []}))
+
+    def test_new_player_existing_team_budget(self):
+        authenticate(None, discord_user_data={"id": "1", "username": "1", "discriminator": "0"},
+                     osu_user_data={**self.osu_data, 'id': 1})
+        self.assertEqual(7, self.count_queries(self.discord_data, self.osu_data))
+
+    def test_returning_player_budget(self):
+        authenticate(None, discord_user_data=self.discord_data, osu_user_data=self.osu_data)
+        self.assertEqual(1, self.count_queries(self.discord_data, self.osu_data))
+
+    def test_discord_switch_budget(self):
+        authenticate(None, discord_user_data=self.discord_data, osu_user_data=self.osu_data)
+        new_discord_data = {"id": "1", "username": "1", "discriminator": "0"}
+        self.assertEqual(5, self.count_queries(new_discord_data, self.osu_data))
+
+
+class AsyncOauthCallbackTestCase(TestCase):
+    osu_user = {'id': 2155578, 'username': 'Azer', 'country_code': 'CA', 'statistics': {"global_rank": 1292},
+                'badges': []}
+    discord_user = {'id': "109274120794127402", 'username': 'james', 'discriminator': '0'}
+
+    @staticmethod
+    def upstream(request: httpx.Request):
+        if request.url.path.endswith("/token"):
+            return httpx.Response(200, json={"access_token": "TEST_ACCESS_TOKEN"})
+        if request.headers.get("Authorization") != "Bearer TEST_ACCESS_TOKEN":
+            return httpx.Response(401, json={"error": "bad token"})
+        if request.url.path.endswith("/me/osu"):
+            return httpx.Response(200, json=AsyncOauthCallbackTestCase.osu_user)
+        if request.url.path.endswith("/oauth2/@me"):
+            return httpx.Response(200, json={"user": AsyncOauthCallbackTestCase.discord_user})
+        return httpx.Response(404)
+
+    async def call_view(self, view, path, handler=None):
+        request = AsyncRequestFactory().get(path)
+        request.session = SessionStore()
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler or self.upstream))
+        with patch("userauth.views.get_async_client", return_value=client):
+            response = await view(request)
+        await client.aclose()
+        return request, response
+
+    async def test_osu_code_missing_code(self):
+        _, response = await self.call_view(views.osu_code, '/auth/osu/code/')
+        self.assertEqual(400, response.status_code)
+
+    async def test_osu_code_stores_session(self):
+        request, response = await self.call_view(views.osu_code, '/auth/osu/code/?code=abc')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.osu_user, json.loads(response.content))
+        self.assertEqual(self.osu_user, request.session["osu_user_data"])
+
+    async def test_osu_code_redirects_to_return_page(self):
+        _, response = await self.call_view(views.osu_code, '/auth/osu/code/?code=abc&state=%2Fregister')
+        self.assertEqual(302, response.status_code)
+        self.assertEqual("/register", response.url)
+
+    async def test_discord_code_stores_session(self):
+        discord_user = {**self.discord_user, 'locale': 'en-US', 'mfa_enabled': True}
+        with patch.object(AsyncOauthCallbackTestCase, 'discord_user', discord_user):
+            request, response = await self.call_view(views.discord_code, '/auth/discord/discord_code/?code=abc')
+        self.assertEqual(200, response.status_code)
+        # the response is the full profile, like osu_code's
+        self.assertEqual(discord_user, json.loads(response.content))
+        self.assertEqual({**self.discord_user, 'global_name': None, 'avatar': None},
+                         request.session["discord_user_data"])
+
+    async def test_full_profiles_parked_in_cache(self):
+        osu_user = {**self.osu_user, 'page': {'raw': 'hello'}, 'statistics': {'global_rank': 1292, 'pp': 727}}
+        with patch.object(AsyncOauthCallbackTestCase, 'osu_user', osu_user):
+            request, _ = await self.call_view(views.osu_code, '/auth/osu/code/?code=abc')
+        await self.call_view(views.discord_code, '/auth/discord/discord_code/?code=abc')
+
+        self.assertEqual(self.osu_user, request.session["osu_user_data"])
+        self.assertEqual(osu_user, await cache.aget(parked_profile_key("osu", 2155578)))
+        self.assertEqual(self.discord_user, await cache.aget(parked_profile_key("discord", "109274120794127402")))
+
+    def test_session_details_returns_parked_profiles(self):
+        osu_user = {**self.osu_user, 'avatar_url': 'https://a.ppy.sh/2155578', 'cover': {'url': 'cover.jpg'},
+                    'statistics': {'global_rank': 1292, 'pp': 727}}
+        discord_user = {**self.discord_user, 'locale': 'en-US'}
+        cache.set(parked_profile_key("osu", osu_user['id']), osu_user)
+        cache.set(parked_profile_key("discord", discord_user['id']), discord_user)
+        session = SessionStore()
+        session["osu_user_data"] = compact_osu_profile(osu_user)
+        session["discord_user_data"] = compact_discord_user(discord_user)
+        session_view = SessionDetails.as_view({'get': 'list'})
+
+        def session_details():
+            request = APIRequestFactory().get('/auth/session/')
+            request.session = session
+            return session_view(request).data
+
+        self.assertEqual((osu_user, discord_user), (session_details()["osu"], session_details()["discord"]))
+
+        # expired from the cache, the session's subset is all there is left
+        cache.delete_many([parked_profile_key("osu", osu_user['id']),
+                           parked_profile_key("discord", discord_user['id'])])
+        self.assertEqual((session["osu_user_data"], session["discord_user_data"]),
+                         (session_details()["osu"], session_details()["discord"]))
+
+    async def test_upstream_timeout(self):
+        def timeout(request):
+            raise httpx.ReadTimeout("timed out", request=request)
+
+        request, response = await self.call_view(views.osu_code, '/auth/osu/code/?code=abc', timeout)
+        self.assertEqual(504, response.status_code)
+        self.assertNotIn("osu_user_data", request.session)
+
+    async def test_token_exchange_failure_forwarded(self):
+        def reject(request):
+            return httpx.Response(400, json={"error": "invalid_grant"})
+
+        request, response = await self.call_view(views.discord_code, '/auth/discord/discord_code/?code=abc', reject)
+        self.assertEqual(400, response.status_code)
+        self.assertEqual("<redacted>", json.loads(response.content)["payload"]["code"])
+
+    async def test_non_json_token_exchange_failure_logged(self):
+        def bad_gateway(request):
+            return httpx.Response(502, content=b"<html>bad gateway</html>")
+
+        with self.assertLogs("userauth.views", level="ERROR") as logs:
+            _, response = await self.call_view(views.osu_code, '/auth/osu/code/?code=abc', bad_gateway)
+        self.assertEqual(502, response.status_code)
+        self.assertEqual(b"<html>bad gateway</html>", response.content)
+        self.assertIn("bad gateway", logs.output[0])
+
+
+class CompactSessionPayloadTestCase(TestCase):
+    badge = {"awarded_at": "2021-06-01T00:00:00+00:00",
+             "description": "osu! World Cup 2021 Winner",
+             "image@2x_url": "https://assets.ppy.sh/profile-badges/owc2021@2x.png",
+             "image_url": "https://assets.ppy.sh/profile-badges/owc2021.png",
+             "url": "https://osu.ppy.sh/wiki/en/Tournaments/OWC/2021",
+             "id": 1234}
+    contributor_badge = {**badge, "description": "Beatmap Nominator contribution"}
+
+    def test_compact_osu_profile(self):
+        profile = {'id': 2155578, 'username': 'Azer', 'country_code': 'CA', 'is_supporter': True,
+                   'statistics': {'global_rank': 1292, 'pp': 12000.5, 'grade_counts': {'ss': 100}},
+                   'badges': [self.badge, self.contributor_badge],
+                   'user_achievements': [{'achievement_id': 1}]}
+        compact = compact_osu_profile(profile)
+
+        self.assertEqual({'id', 'username', 'country_code', 'statistics', 'badges'}, set(compact))
+        self.assertEqual({'global_rank': 1292}, compact['statistics'])
+        self.assertEqual([{k: v for k, v in self.badge.items() if k != 'id'}], compact['badges'])
+
+    def test_compact_osu_profile_keeps_missing_fields_missing(self):
+        discord_data, osu_data = DiscordAndOsuAuthBackend.validate_data(
+            {'id': "1", 'username': 'james', 'discriminator': '0'},
+            compact_osu_profile({'id': 2155578, 'username': 'Azer', 'country_code': 'CA'}))
+        self.assertIsNotNone(discord_data)
+        self.assertIsNone(osu_data)
+
+    def test_compact_profiles_register(self):
+        discord_user = {'id': "109274120794127402", 'username': 'james', 'discriminator': '0',
+                        'global_name': 'James', 'avatar': '8342729096ea3675442027381ff50dfe', 'locale': 'en-US'}
+        osu_profile = {'id': 2155578, 'username': 'Azer', 'country_code': 'CA', 'statistics': {'global_rank': 1292},
+                       'badges': [self.badge, self.contributor_badge]}
+        registration_end = datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(days=1)
+        with (self.settings(USER_REGISTRATION_END=registration_end), patch("discord.events.outbox_drainer.wake"),
+              patch("userauth.tasks.save_player_badges.delay", side_effect=save_player_badges),
+              self.captureOnCommitCallbacks(execute=True)):
+            user = authenticate(None,
+                                discord_user_data=compact_discord_user(discord_user),
+                                osu_user_data=compact_osu_profile(osu_profile))
+
+        self.assertEqual('James', user.tournamentplayer.discord_global_name)
+        self.assertEqual('8342729096ea3675442027381ff50dfe', user.tournamentplayer.discord_avatar)
+        self.assertEqual(1, user.tournamentplayer.tournamentplayerbadge_set.count())
+
+
+class PrincipalCacheTestCase(TestCase):
+    def setUp(self):
+        self.backend = DiscordAndOsuAuthBackend()
+        self.user = User.objects.create(username="109274120794127402.2155578")
+        self.player = TournamentPlayer.objects.create(user=self.user,
+                                                      team=TournamentTeam.objects.create(osu_flag="CA"),
+                                                      osu_user_id=2155578,
+                                                      discord_user_id="109274120794127402",
+                                                      osu_stats_updated=datetime.datetime.now(tz=datetime.timezone.utc))
+        cache.delete(principal_cache_key(self.user.pk))
+
+    def test_cached_user_includes_player(self):
+        with self.assertNumQueries(1):
+            self.backend.get_user(self.user.pk)
+        with self.assertNumQueries(0):
+            user = self.backend.get_user(self.user.pk)
+            self.assertEqual("CA", user.tournamentplayer.team_id)
+
+    def test_player_save_invalidates(self):
+        self.backend.get_user(self.user.pk)
+        self.player.is_organizer = True
+        self.player.save()
+        self.assertTrue(self.backend.get_user(self.user.pk).tournamentplayer.is_organizer)
+
+    def test_user_save_invalidates(self):
+        self.backend.get_user(self.user.pk)
+        self.user.is_staff = True
+        self.user.save()
+        self.assertTrue(self.backend.get_user(self.user.pk).is_staff)
+
+    def test_deleted_user_not_returned(self):
+        self.backend.get_user(self.user.pk)
+        user_pk = self.user.pk
+        self.user.delete()
+        self.assertIsNone(self.backend.get_user(user_pk))
+
+    def test_user_without_player(self):
+        user = User.objects.create(username="admin")
+        self.backend.get_user(user.pk)
+        with self.assertNumQueries(0):
+            self.assertFalse(hasattr(self.backend.get_user(user.pk), 'tournamentplayer'))
+
+    def test_cached_principal_is_small(self):
+        self.user.set_password("hunter2")
+        self.user.save()
+        self.backend.get_user(self.user.pk)
+
+        principal = cache.get(principal_cache_key(self.user.pk))
+        self.assertNotIn(self.user.password, str(principal))
+        self.assertEqual({'user', 'session_auth_hash', 'player'}, set(principal))
+        with self.assertNumQueries(0):
+            user = self.backend.get_user(self.user.pk)
+            self.assertEqual((self.user.pk, self.user.username, False), (user.pk, user.username, user.is_staff))
+            self.assertEqual((self.player.pk, "CA", False),
+                             (user.tournamentplayer.pk, user.tournamentplayer.team_id,
+                              user.tournamentplayer.is_organizer))
+            self.assertEqual(self.user.get_session_auth_hash(), user.get_session_auth_hash())
+
+    def test_cached_session_stays_logged_in(self):
+        client = APIClient()
+        client.force_login(self.user)
+        for _ in range(2):
+            response = client.get("/auth/session/")
+            self.assertEqual(self.user.pk, response.data["logged_in_user_id"])
+        # a password change logs sessions out, cached or not
+        self.user.set_password("hunter2")
+        self.user.save()
+        self.assertIsNone(client.get("/auth/session/").data["logged_in_user_id"])
+
+    def test_cache_disabled(self):
+        with self.settings(AUTH_PRINCIPAL_CACHE_TTL=0):
+            self.backend.get_user(self.user.pk)
+            with self.assertNumQueries(1):
+                self.backend.get_user(self.user.pk)
+
+
+class DisqualifiedUserSetTestCase(TestCase):
+    def setUp(self):
+        disqualification.bump_version()
+
+    def test_check_is_in_memory(self):
+        DisqualifiedUser.objects.create(osu_user_id=1234727)
+        self.assertTrue(disqualification.is_disqualified(1234727))
+        with self.assertNumQueries(0):
+            self.assertTrue(disqualification.is_disqualified("1234727"))
+            self.assertFalse(disqualification.is_disqualified(2155578))
+
+    def test_admin_changes_reload(self):
+        self.assertFalse(disqualification.is_disqualified(1234727))
+        dq_user = DisqualifiedUser.objects.create(osu_user_id=1234727)
+        self.assertTrue(disqualification.is_disqualified(1234727))
+        dq_user.delete()
+        self.assertFalse(disqualification.is_disqualified(1234727))
+
+    def test_version_change_from_other_worker_reloads(self):
+        with self.settings(DISQUALIFIED_USERS_CHECK_INTERVAL=0):
+            self.assertFalse(disqualification.is_disqualified(1234727))
+            # insert without signals, as another process would look to this one
+            DisqualifiedUser.objects.bulk_create([DisqualifiedUser(osu_user_id=1234727)])
+            self.assertFalse(disqualification.is_disqualified(1234727))
+            cache.set(disqualification.VERSION_KEY, "bumped elsewhere", timeout=None)
+            self.assertTrue(disqualification.is_disqualified(1234727))
+
+
+@patch("discord.events.outbox_drainer.wake")
+class DeferredBadgeTestCase(TestCase):
+    discord_data = AuthenticateQueryBudgetTestCase.discord_data
+    osu_data = AuthenticateQueryBudgetTestCase.osu_data
+
+    def setUp(self):
+        settings.USER_REGISTRATION_END = (datetime.datetime.now(tz=datetime.timezone.utc) +
+                                          datetime.timedelta(days=2))
+
+    def register(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return authenticate(None, discord_user_data=self.discord_data, osu_user_data=self.osu_data)
+
+    def test_registration_queues_badges(self, _):
+        with patch("userauth.tasks.save_player_badges.delay") as delay:
+            user = self.register()
+        delay.assert_called_once_with(user.pk, self.osu_data['badges'])
+
+        player = TournamentPlayer.objects.get(pk=user.pk)
+        self.assertTrue(player.badges_pending)
+        self.assertEqual(bws(len(filter_badges(self.osu_data['badges'])), 1292), player.osu_rank_std_bws)
+        self.assertFalse(TournamentPlayerBadge.objects.filter(user=player).exists())
+
+    def test_no_badges_not_pending(self, _):
+        with patch("userauth.tasks.save_player_badges.delay") as delay, self.captureOnCommitCallbacks(execute=True):
+            user = authenticate(None, discord_user_data=self.discord_data,
+                                osu_user_data={**self.osu_data, 'badges': []})
+        delay.assert_not_called()
+        self.assertFalse(TournamentPlayer.objects.get(pk=user.pk).badges_pending)
+
+    def test_task_saves_badges(self, _):
+        with patch("userauth.tasks.save_player_badges.delay"):
+            user = self.register()
+        for _ in range(2):  # retries replace the badges
+            save_player_badges(user.pk, self.osu_data['badges'])
+
+        player = TournamentPlayer.objects.get(pk=user.pk)
+        self.assertFalse(player.badges_pending)
+        self.assertEqual(1, TournamentPlayerBadge.objects.filter(user=player).count())
+
+    def test_task_for_deleted_player(self, _):
+        with patch("userauth.tasks.save_player_badges.delay"):
+            user = self.register()
+        user_pk = user.pk
+        user.delete()
+        save_player_badges(user_pk, self.osu_data['badges'])
+        self.assertFalse(TournamentPlayerBadge.objects.exists())
+
+    def test_broker_down_saves_inline(self, _):
+        with patch("userauth.tasks.save_player_badges.delay", side_effect=OSError("connection refused")):
+            user = self.register()
+        self.assertFalse(TournamentPlayer.objects.get(pk=user.pk).badges_pending)
+        self.assertEqual(1, TournamentPlayerBadge.objects.filter(user_id=user.pk).count())
+
+    def test_retrieve_shows_badges_pending(self, _):
+        with patch("userauth.tasks.save_player_badges.delay"):
+            user = self.register()
+        response = APIClient().get(f'/registrants/{user.pk}/')
+        self.assertTrue(response.data['badges_pending'])
+        self.assertEqual([], response.data['badges'])
+
+        save_player_badges(user.pk, self.osu_data['badges'])
+        response = APIClient().get(f'/registrants/{user.pk}/?badge_cutoff_date=0')
+        self.assertFalse(response.data['badges_pending'])
+        self.assertEqual(1, len(response.data['badges']))
+
+
+    def test_without_background_work(self, wake):
+        with patch("userauth.tasks.save_player_badges.delay") as delay, self.captureOnCommitCallbacks(execute=True):
+            user = DiscordAndOsuAuthBackend(background=False).authenticate(None, discord_user_data=self.discord_data,
+                                                                           osu_user_data=self.osu_data)
+        delay.assert_not_called()
+        wake.assert_not_called()
+        self.assertTrue(TournamentPlayer.objects.get(pk=user.pk).badges_pending)
+        # the event still goes out, with the next sweep
+        self.assertEqual(1, OutboxEvent.objects.count())
+
+
+class SeedRegistrationsTestCase(TestCase):
+    def test_synthetic_profiles_are_deterministic(self):
+        self.assertEqual(list(synthetic_profiles(5, seed=1)), list(synthetic_profiles(5, seed=1)))
+        self.assertEqual(synthetic_profile(3, seed=1), list(synthetic_profiles(2, seed=1, start=2))[1])
+        self.assertNotEqual(synthetic_profile(3, seed=1), synthetic_profile(3, seed=2))
+
+    def test_synthetic_profiles_validate(self):
+        for discord_user_data, osu_user_data in synthetic_profiles(50):
+            discord_data, osu_data = DiscordAndOsuAuthBackend.validate_data(discord_user_data, osu_user_data)
+            self.assertIsNotNone(discord_data)
+            self.assertIsNotNone(osu_data)
+            self.assertTrue(10_000 <= osu_data['statistics']['global_rank'] <= 99_999)
+
+    def test_bulk_seed_matches_authenticate(self):
+        call_command("seed_registrations", 50, synthetic=True, bulk=True, chunk_size=20, stdout=io.StringIO())
+        # rerunning skips existing players
+        call_command("seed_registrations", 60, synthetic=True, bulk=True, chunk_size=20, stdout=io.StringIO())
+        self.assertEqual(60, TournamentPlayer.objects.count())
+        self.assertEqual(60, sum(TournamentTeam.objects.values_list('candidate_count', flat=True)))
+
+        for i in (0, 17, 59):
+            discord_user_data, osu_user_data = synthetic_profile(i)
+            player = TournamentPlayer.objects.get(osu_user_id=osu_user_data['id'])
+            self.assertEqual(discord_user_data['id'], player.discord_user_id)
+            self.assertEqual(osu_user_data['country_code'], player.team_id)
+            expected_bws = bws(len(filter_badges(osu_user_data['badges'])), osu_user_data['statistics']['global_rank'])
+            self.assertEqual(expected_bws, player.osu_rank_std_bws)
+            self.assertEqual(len(filter_badges(osu_user_data['badges'], cutoff_date=None)),
+                             TournamentPlayerBadge.objects.filter(user=player).count())
+            # seeded players can log in
+            self.assertEqual(player.pk, authenticate(None, discord_user_data=discord_user_data,
+                                                     osu_user_data=osu_user_data).pk)
+
+
+    @patch("discord.events._group_send")
+    @patch("discord.events.outbox_drainer.wake")
+    def test_seed_drains_outbox(self, wake, group_send):
+        call_command("seed_registrations", 3, synthetic=True, stdout=io.StringIO())
+
+        # sent before the command returns, not by a drainer thread that would die with it
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertEqual(3, sum(len(call.args[0]["frames"]) for call in group_send.call_args_list))
+
+
+class DropAllRegistrationsTestCase(TestCase):
+    def test_drop_in_chunks(self):
+        call_command("seed_registrations", 30, synthetic=True, bulk=True, stdout=io.StringIO())
+        admin = User.objects.create(username="admin", is_staff=True)
+        sessions = {}
+        for user in (admin, TournamentPlayer.objects.last().user):
+            session = SessionStore()
+            session['_auth_user_id'] = str(user.pk)
+            session.create()
+            sessions[user.pk] = session.session_key
+        anonymous_session = SessionStore()
+        anonymous_session.create()
+        player_pk = TournamentPlayer.objects.first().pk
+        backend = DiscordAndOsuAuthBackend()
+        backend.get_user(player_pk)
+
+        out = io.StringIO()
+        call_command("drop_all_registrations", chunk_size=7, interactive=False, stdout=out)
+
+        self.assertFalse(TournamentPlayer.objects.exists())
+        self.assertFalse(TournamentPlayerBadge.objects.exists())
+        self.assertEqual([admin.pk], list(User.objects.values_list('pk', flat=True)))
+        self.assertEqual({sessions[admin.pk], anonymous_session.session_key},
+                         set(Session.objects.values_list('session_key', flat=True)))
+        self.assertIsNone(backend.get_user(player_pk))
+        self.assertIn("[30/30]", out.getvalue())
+        self.assertFalse(TournamentTeam.objects.filter(candidate_count__gt=0).exists())
+
+    def test_resume_after_interruption(self):
+        call_command("seed_registrations", 10, synthetic=True, bulk=True, stdout=io.StringIO())
+        delete_chunk = drop_all_registrations.Command.delete_chunk
+
+        def interrupt_second_chunk(pks):
+            if TournamentPlayer.objects.count() < 10:
+                raise KeyboardInterrupt
+            return delete_chunk(pks)
+
+        with patch.object(drop_all_registrations.Command, 'delete_chunk', side_effect=interrupt_second_chunk):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command("drop_all_registrations", chunk_size=4, interactive=False, stdout=io.StringIO())
+        self.assertEqual(6, TournamentPlayer.objects.count())
+
+        call_command("drop_all_registrations", chunk_size=4, interactive=False, stdout=io.StringIO())
+        self.assertFalse(TournamentPlayer.objects.exists())
+
+
+class ImportRegistrationsTestCase(TestCase):
+    def setUp(self):
+        call_command("seed_registrations", 25, synthetic=True, bulk=True, stdout=io.StringIO())
+        response = APIClient().get("/registrants/export/?badge_cutoff_date=0",
+                                   HTTP_AUTHORIZATION=f"Token {settings.DISCORD_PSK}")
+        self.lines = b"".join(response.streaming_content).decode().splitlines()
+        self.path = self.write_file(self.lines)
+
+    def write_file(self, lines):
+        with tempfile.NamedTemporaryFile("w", suffix=".ndjson", delete=False) as outfile:
+            outfile.write("\n".join(lines) + "\n")
+        self.addCleanup(os.unlink, outfile.name)
+        return outfile.name
+
+    @staticmethod
+    def snapshot():
+        players = TournamentPlayer.objects.order_by('osu_user_id')
+        return (list(players.values_list('discord_user_id', 'discord_username', 'osu_user_id', 'osu_rank_std',
+                                         'osu_rank_std_bws', 'team_id', 'user__username')),
+                [sorted(player.tournamentplayerbadge_set.values_list('description', 'award_date')) for player in
+                 players],
+                list(TournamentTeam.objects.order_by('pk').values_list('pk', 'candidate_count')))
+
+    def test_import_export_round_trip(self):
+        before = self.snapshot()
+        call_command("drop_all_registrations", interactive=False, stdout=io.StringIO())
+
+        out = io.StringIO()
+        call_command("import_registrations", self.path, chunk_size=10, stdout=out)
+
+        self.assertEqual(before, self.snapshot())
+        self.assertIn("25 created, 0 updated, 0 invalid", out.getvalue())
+        self.assertIn("players/s", out.getvalue())
+
+    def test_reimport_updates(self):
+        before = self.snapshot()
+        out = io.StringIO()
+        call_command("import_registrations", self.path, chunk_size=10, stdout=out)
+
+        self.assertEqual(before, self.snapshot())
+        self.assertIn("0 created, 25 updated", out.getvalue())
+
+    def test_moved_players_recounted(self):
+        row = json.loads(self.lines[0])
+        old_team = row['team_id']
+        row['team_id'] = "ZZ"
+        row['rank_standard'] = 5
+        row['badges'] = []
+        call_command("import_registrations", self.write_file([json.dumps(row)]), stdout=io.StringIO())
+
+        player = TournamentPlayer.objects.get(osu_user_id=row['osu_user_id'])
+        self.assertEqual(("ZZ", 5, 5), (player.team_id, player.osu_rank_std, player.osu_rank_std_bws))
+        self.assertFalse(player.tournamentplayerbadge_set.exists())
+        self.assertEqual(1, TournamentTeam.objects.get(pk="ZZ").candidate_count)
+        self.assertEqual(TournamentPlayer.objects.filter(team_id=old_team).count(),
+                         TournamentTeam.objects.get(pk=old_team).candidate_count)
+
+    def test_switched_discord_account_updates_player(self):
+        row = json.loads(self.lines[0])
+        row['discord_user_id'] = "727"
+        out = io.StringIO()
+        call_command("import_registrations", self.write_file([json.dumps(row)]), stdout=out)
+
+        player = TournamentPlayer.objects.select_related('user').get(osu_user_id=row['osu_user_id'])
+        self.assertEqual(("727", f"727.{row['osu_user_id']}"), (player.discord_user_id, player.user.username))
+        self.assertEqual(25, TournamentPlayer.objects.count())
+        self.assertIn("0 created, 1 updated", out.getvalue())
+
+    def test_switched_discord_account_conflict_reported(self):
+        row = json.loads(self.lines[0])
+        row['discord_user_id'] = "727"
+        User.objects.create(username=f"727.{row['osu_user_id']}")
+        out, err = io.StringIO(), io.StringIO()
+        call_command("import_registrations", self.write_file([json.dumps(row)]), stdout=out, stderr=err)
+
+        self.assertEqual(1, TournamentPlayer.objects.filter(osu_user_id=row['osu_user_id']).count())
+        self.assertNotEqual("727", TournamentPlayer.objects.get(osu_user_id=row['osu_user_id']).discord_user_id)
+        self.assertIn("0 created, 0 updated, 1 invalid", out.getvalue())
+        self.assertTrue(err.getvalue().startswith("line 1: osu! id"))
+
+    def test_invalid_rows_skipped(self):
+        row = json.loads(self.lines[0])
+        row['is_captain'] = True
+        row['in_roster'] = False
+        path = self.write_file(["{", json.dumps({'osu_user_id': 1}), json.dumps(row), self.lines[1]])
+        call_command("drop_all_registrations", interactive=False, stdout=io.StringIO())
+
+        out, err = io.StringIO(), io.StringIO()
+        call_command("import_registrations", path, stdout=out, stderr=err)
+
+        self.assertEqual([json.loads(self.lines[1])['osu_user_id']],
+                         list(TournamentPlayer.objects.values_list('osu_user_id', flat=True)))
+        self.assertIn("1 created, 0 updated, 3 invalid", out.getvalue())
+        self.assertEqual(["line 1", "line 2", "line 3"], [line.split(":")[0] for line in err.getvalue().splitlines()])
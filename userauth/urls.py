@@ -1,4 +1,4 @@
-from django.urls import path, include
+from django.urls import path, include, re_path
 from rest_framework import routers
 from . import views
 
@@ -13,6 +13,9 @@ router.register('users', views.UserViewSet)
 
 
 urlpatterns = [
+    # registered ahead of the router: the OAuth callbacks are async views, not viewset actions
+    re_path(r'^osu/code/?$', views.osu_code, name='osu-code'),
+    re_path(r'^discord/discord_code/?$', views.discord_code, name='discord-discord-code'),
     path('', include(router.urls)),
     path('login', views.login_frontend)
 ]
@@ -1,12 +1,14 @@
 import json
+import logging
 
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
+import httpx
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import User
-from django.http import HttpResponseRedirect
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.shortcuts import render, redirect
 from rest_framework import viewsets, status, serializers
-import requests
 import urllib.parse
 from django.conf import settings
 from rest_framework.response import Response
@@ -14,13 +16,17 @@ from rest_framework.decorators import action
 from django.contrib.auth import authenticate, login, logout
 import django.dispatch
 
-from userauth.models import DisqualifiedUser
+from discord import events
+from kfcrebrand.http import get_async_client
+from userauth.authentication import compact_discord_user, compact_osu_profile, parked_profile_key
+from userauth.disqualification import is_disqualified
 
+logger = logging.getLogger(__name__)
 login_signal = django.dispatch.Signal()
 
 
 def parse_return_page(request):
-    return_page: str | None = request.query_params.get("state", "")  # default retval will cause "starts with /" to fail
+    return_page: str | None = request.GET.get("state", "")  # default retval will cause "starts with /" to fail
     return_page = urllib.parse.unquote(return_page)
 
     # TODO: add this back when frontend/backend are hosted together or add FRONTEND_BASEURL env var and check against it
@@ -34,11 +40,20 @@ def parse_return_page(request):
 class SessionDetails(viewsets.ViewSet):
     @staticmethod
     def list(request):
+        # the full profiles parked by the OAuth callbacks, the session's subset once they expired
+        discord_user_data = request.session.get("discord_user_data")
+        osu_user_data = request.session.get("osu_user_data")
+        keys = {}
+        if discord_user_data is not None:
+            keys["discord"] = parked_profile_key("discord", discord_user_data.get("id"))
+        if osu_user_data is not None:
+            keys["osu"] = parked_profile_key("osu", osu_user_data.get("id"))
+        parked = cache.get_many(keys.values()) if keys else {}
         return Response({
             "logged_in_user": request.user.username,
             "logged_in_user_id": request.user.pk,
-            "discord": request.session.get("discord_user_data"),
-            "osu": request.session.get("osu_user_data")})
+            "discord": parked.get(keys.get("discord"), discord_user_data),
+            "osu": parked.get(keys.get("osu"), osu_user_data)})
 
     @action(methods=['get', 'post'], detail=False)
     def logout(self, request):
@@ -56,8 +71,7 @@ class SessionDetails(viewsets.ViewSet):
         if request.session.get("discord_user_data") is None or osu_user_data is None:
             return Response({"error": "failed to authenticate", "msg": "required discord or osu! session missing"},
                             status=status.HTTP_401_UNAUTHORIZED)
-        is_user_disqualified = DisqualifiedUser.objects.filter(osu_user_id=osu_user_data['id']).exists()
-        if is_user_disqualified:
+        if is_disqualified(osu_user_data['id']):
             return Response({"error": "user disqualified",
                              "msg": f"osu user id {osu_user_data['id']} has been disqualified by an administrator"},
                             status=status.HTTP_403_FORBIDDEN)
@@ -77,23 +91,17 @@ class SessionDetails(viewsets.ViewSet):
             return Response({"error": "not logged in"}, status=status.HTTP_401_UNAUTHORIZED)
         user = request.user
 
-        try:
-            channel_layer = get_channel_layer()
-            # noinspection PyArgumentList
-            async_to_sync(channel_layer.group_send)(settings.CHANNELS_DISCORD_WS_GROUP_NAME,
-                                                    {
-                                                        "type": "registration.delete",
-                                                        "message": json.dumps({
-                                                            "discord_user_id": user.tournamentplayer.discord_user_id,
-                                                            "osu_user_id": user.tournamentplayer.osu_user_id,
-                                                            "action": "delete"  # errr... this should really be done at
-                                                            # the consumer.py side of things
-                                                        })
-                                                    })
-        finally:
-            logout(request)
+        logout(request)
+        with transaction.atomic():
+            # queued in the same transaction so the event only goes out if the account is actually deleted
+            if hasattr(user, 'tournamentplayer'):
+                events.enqueue("registration.delete", {
+                    "discord_user_id": user.tournamentplayer.discord_user_id,
+                    "osu_user_id": user.tournamentplayer.osu_user_id,
+                    "action": "delete"  # errr... this should really be done at the consumer.py side of things
+                })
             user.delete()
-            return Response(None, status=status.HTTP_204_NO_CONTENT)
+        return Response(None, status=status.HTTP_204_NO_CONTENT)
 
 
 class OauthWithRedirect:
@@ -102,10 +110,11 @@ class OauthWithRedirect:
     def __init__(self):
         pass
 
-    def get_redirect_url(self, request):
-        if self.REDIRECT_SUFFIX is None:
+    @classmethod
+    def get_redirect_url(cls, request):
+        if cls.REDIRECT_SUFFIX is None:
             raise NotImplementedError("REDIRECT_SUFFIX was not specified")
-        return f"{request.scheme}://{request.get_host()}{self.REDIRECT_SUFFIX}"
+        return f"{request.scheme}://{request.get_host()}{cls.REDIRECT_SUFFIX}"
 
 
 # todo: on osu login, invalidate previous logged-in user
@@ -125,38 +134,6 @@ class OsuAuth(viewsets.ViewSet, OauthWithRedirect):
             uri += f"&state={return_page}"
         return HttpResponseRedirect(redirect_to=uri)
 
-    @action(methods=['get'], detail=False)
-    def code(self, request):
-        code = request.query_params.get("code", None)
-        return_page = parse_return_page(request)
-        if code is None:
-            return Response({"error": "missing `code` query param"}, status=status.HTTP_400_BAD_REQUEST)
-
-        r = requests.post(f'{settings.OSU_OAUTH_ENDPOINT}/token',
-                          data={'grant_type': 'authorization_code',
-                                'code': code,
-                                'redirect_uri': self.get_redirect_url(request)},
-                          headers={'Content-Type': 'application/x-www-form-urlencoded'},
-                          auth=(settings.OSU_CLIENT_ID, settings.OSU_CLIENT_SECRET))
-        if r.status_code != 200:
-            try:
-                return Response(r.json(), status=r.status_code)
-            except json.JSONDecodeError:
-                print(r.content)
-                return Response(r.content, status=r.status_code)
-
-        auth_data = r.json()
-        # fetch user information
-        r = requests.get(f"{settings.OSU_API_ENDPOINT}/me/osu",
-                         headers={"Authorization": f"Bearer {auth_data.get('access_token')}"})
-        if r.status_code != 200:
-            return Response(r.json(), status=r.status_code)
-        user_data = r.json()
-        request.session["osu_user_data"] = user_data
-        if return_page is not None:
-            return redirect(return_page)
-        return Response(user_data, status=r.status_code)
-
     @staticmethod
     def list(request):
         return Response({"727": "when you see it"})
@@ -178,44 +155,6 @@ class DiscordAuth(viewsets.ViewSet, OauthWithRedirect):
             uri += f"&state={return_page}"
         return HttpResponseRedirect(redirect_to=uri)
 
-    @action(methods=['get'], detail=False)
-    def discord_code(self, request):
-        code = request.query_params.get("code", None)
-        return_page = parse_return_page(request)
-        if code is None:
-            return Response({"error": "missing `code` query param"}, status=status.HTTP_400_BAD_REQUEST)
-
-        # access token exchange
-        data = {
-            'grant_type': 'authorization_code',
-            'code': code,
-            'redirect_uri': self.get_redirect_url(request)
-        }
-        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-        r = requests.post(f'{settings.DISCORD_API_ENDPOINT}/oauth2/token',
-                          data=data,
-                          headers=headers,
-                          auth=(settings.DISCORD_CLIENT_ID, settings.DISCORD_CLIENT_SECRET))
-        if r.status_code != 200:
-            return Response({"message": "failed trading code for token",
-                             "payload": {k: v if k != 'code' else '<redacted>' for k, v in data.items()},
-                             "error": r.json()}, status=r.status_code)
-        auth_data = r.json()
-
-        # fetch user information
-        r = requests.get(f"{settings.DISCORD_API_ENDPOINT}/oauth2/@me",
-                         headers={"Authorization": f"Bearer {auth_data.get('access_token')}"})
-        if r.status_code != 200:
-            return Response(r.json(), status=r.status_code)
-        user_data = r.json().get("user")
-        request.session["discord_user_data"] = user_data
-        if return_page is not None:
-            return redirect(return_page)
-        return Response(user_data, status=r.status_code)
-
-        # check if user exists
-        # if TournamentPlayer.objects.filter(discord_user_id)
-
     @action(methods=['get'], detail=False)
     def token(self, request):
         print(request.query_params.get("access_token"))
@@ -226,6 +165,96 @@ class DiscordAuth(viewsets.ViewSet, OauthWithRedirect):
         return Response({"727": "when you see it"})
 
 
+def upstream_error_response(api_name: str, exc: httpx.HTTPError):
+    if isinstance(exc, httpx.TimeoutException):
+        return JsonResponse({"error": f"{api_name} API timed out"}, status=status.HTTP_504_GATEWAY_TIMEOUT)
+    return JsonResponse({"error": f"{api_name} API request failed: {repr(exc)}"}, status=status.HTTP_502_BAD_GATEWAY)
+
+
+# OAuth callbacks are async views so a slow osu!/discord API doesn't hold a worker thread for the whole round trip
+async def osu_code(request):
+    code = request.GET.get("code", None)
+    return_page = parse_return_page(request)
+    if code is None:
+        return JsonResponse({"error": "missing `code` query param"}, status=status.HTTP_400_BAD_REQUEST)
+
+    client = get_async_client()
+    try:
+        r = await client.post(f'{settings.OSU_OAUTH_ENDPOINT}/token',
+                              data={'grant_type': 'authorization_code',
+                                    'code': code,
+                                    'redirect_uri': OsuAuth.get_redirect_url(request)},
+                              headers={'Content-Type': 'application/x-www-form-urlencoded'},
+                              auth=(settings.OSU_CLIENT_ID or '', settings.OSU_CLIENT_SECRET or ''))
+        if r.status_code != 200:
+            try:
+                return JsonResponse(r.json(), status=r.status_code, safe=False)
+            except json.JSONDecodeError:
+                logger.error(f"[osu_code] token exchange got status code {r.status_code}: {r.content[:500]!r}")
+                return HttpResponse(r.content, status=r.status_code)
+
+        auth_data = r.json()
+        # fetch user information
+        r = await client.get(f"{settings.OSU_API_ENDPOINT}/me/osu",
+                             headers={"Authorization": f"Bearer {auth_data.get('access_token')}"})
+    except httpx.HTTPError as e:
+        return upstream_error_response("osu!", e)
+    if r.status_code != 200:
+        return JsonResponse(r.json(), status=r.status_code, safe=False)
+    user_data = r.json()
+    await cache.aset(parked_profile_key("osu", user_data.get("id")), user_data,
+                     timeout=settings.OAUTH_PROFILE_CACHE_TTL)
+    await sync_to_async(request.session.__setitem__)("osu_user_data", compact_osu_profile(user_data))
+    if return_page is not None:
+        return redirect(return_page)
+    return JsonResponse(user_data, status=r.status_code)
+
+
+async def discord_code(request):
+    code = request.GET.get("code", None)
+    return_page = parse_return_page(request)
+    if code is None:
+        return JsonResponse({"error": "missing `code` query param"}, status=status.HTTP_400_BAD_REQUEST)
+
+    client = get_async_client()
+    # access token exchange
+    data = {
+        'grant_type': 'authorization_code',
+        'code': code,
+        'redirect_uri': DiscordAuth.get_redirect_url(request)
+    }
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    try:
+        r = await client.post(f'{settings.DISCORD_API_ENDPOINT}/oauth2/token',
+                              data=data,
+                              headers=headers,
+                              auth=(settings.DISCORD_CLIENT_ID or '', settings.DISCORD_CLIENT_SECRET or ''))
+        if r.status_code != 200:
+            return JsonResponse({"message": "failed trading code for token",
+                                 "payload": {k: v if k != 'code' else '<redacted>' for k, v in data.items()},
+                                 "error": r.json()}, status=r.status_code)
+        auth_data = r.json()
+
+        # fetch user information
+        r = await client.get(f"{settings.DISCORD_API_ENDPOINT}/oauth2/@me",
+                             headers={"Authorization": f"Bearer {auth_data.get('access_token')}"})
+    except httpx.HTTPError as e:
+        return upstream_error_response("discord", e)
+    if r.status_code != 200:
+        return JsonResponse(r.json(), status=r.status_code, safe=False)
+    user_data = r.json().get("user")
+    session_data = None
+    if user_data is not None:
+        await cache.aset(parked_profile_key("discord", user_data.get("id")), user_data,
+                         timeout=settings.OAUTH_PROFILE_CACHE_TTL)
+        session_data = compact_discord_user(user_data)
+    await sync_to_async(request.session.__setitem__)("discord_user_data", session_data)
+    if return_page is not None:
+        return redirect(return_page)
+    # the full profile, as osu_code responds with, only the session holds the compacted one
+    return JsonResponse(user_data, status=r.status_code, safe=False)
+
+
 # todo: remove
 def login_frontend(request):
     return render(request, "login.html", {})